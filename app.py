@@ -1,38 +1,49 @@
 import streamlit as st
 import cv2
 import numpy as np
-import pytesseract
 from PIL import Image
 import io
 import os
 import re
-import random
-import string
+import html
+import time
+import tempfile
 from datetime import datetime
+from itertools import groupby
 from auth import (
     init_db, 
     register_user, 
     login_user, 
     verify_token, 
-    create_discount_code,
+    issue_discount_code,
     validate_discount_code,
     register_mr,
     get_mr_details,
     get_mr_statistics,
+    get_visit_history,
     record_doctor_visit,
     update_mr_profile
 )
-import sqlite3
+from image_pipeline import enhance_image, preview_cache, bytes_digest, image_digest
+from ocr_cache import ocr_cache, settings_key
+from ocr_pipeline import LOW_CONFIDENCE
+from db import connection
+from rollups import territory_leaderboard, scope_leaderboard
+from doctor_directory import doctor_directory, doctor_label
+from bulk_import import import_visits
+from reports import FORMATS, export_report, report_filename
+from batch_processing import (
+    extraction_job,
+    process_prescription_file,
+    build_results_archive
+)
+from job_queue import QUEUED, RUNNING, DONE, CANCELLED, get_job_queue
 
 # Initialize the database
 init_db()
 
-# Function to generate unique doctor discount code
-def generate_doctor_code(doctor_id):
-    """Generate a unique discount code for a doctor"""
-    prefix = "DR"
-    random_digits = ''.join(random.choices(string.digits, k=5))
-    return f"{prefix}{random_digits}"
+# Seconds between automatic refreshes while a background job is pending
+JOB_POLL_INTERVAL = 1
 
 # Function to validate and apply discount
 def apply_discount_code(code):
@@ -47,26 +58,20 @@ def save_discount_code(username):
     """Store generated discount code in database"""
     if 'discount_code' not in st.session_state:
         # Get doctor's ID from database
-        conn = sqlite3.connect('app.db')
-        c = conn.cursor()
-        try:
-            c.execute('SELECT id FROM users WHERE username = ?', (username,))
-            result = c.fetchone()
-            if result:
-                doctor_id = result[0]
-                # Generate new code
-                new_code = generate_doctor_code(doctor_id)
-                success, message = create_discount_code(doctor_id, new_code)
-                if success:
-                    st.session_state.discount_code = new_code
-                else:
-                    st.error(message)
-                    return None
+        with connection() as conn:
+            result = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+        if result:
+            doctor_id = result[0]
+            # Allocate a new code; allocated codes never collide
+            success, result = issue_discount_code(doctor_id)
+            if success:
+                st.session_state.discount_code = result
             else:
-                st.error("Doctor not found in database")
+                st.error(result)
                 return None
-        finally:
-            conn.close()
+        else:
+            st.error("Doctor not found in database")
+            return None
     
     return st.session_state.discount_code
 
@@ -314,6 +319,7 @@ def register_page():
     st.markdown('<h2>Register</h2>', unsafe_allow_html=True)
     
     username = st.text_input("Username")
+    full_name = st.text_input("Full Name")
     email = st.text_input("Email")
     password = st.text_input("Password", type="password",
                            help="Password must be at least 8 characters and contain uppercase, lowercase, numbers, and special characters")
@@ -326,7 +332,7 @@ def register_page():
                 if password != confirm_password:
                     st.error("Passwords do not match")
                 else:
-                    success, message = register_user(username, password, email)
+                    success, message = register_user(username, password, email, full_name)
                     if success:
                         st.success(message)
                         st.info("Please login with your credentials")
@@ -348,123 +354,68 @@ def logout():
             del st.session_state[key]
     st.experimental_rerun()
 
-def enhance_prescription_image(image, denoise_strength, contrast_strength):
+def enhance_prescription_image(image, denoise_strength, contrast_strength, image_key=None):
     try:
-        # Convert to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Apply Gaussian blur to reduce noise
-        blurred = cv2.GaussianBlur(gray, (3, 3), 0)
-        
-        # Apply adaptive thresholding with reduced block size for better detail
-        binary = cv2.adaptiveThreshold(
-            blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY_INV, 21, 10
+        # Stages are memoized per image and slider setting across reruns
+        return enhance_image(
+            image, denoise_strength, contrast_strength,
+            cache=preview_cache, image_key=image_key
         )
-        
-        # Denoise with strength parameter
-        denoised = cv2.fastNlMeansDenoising(binary, None, denoise_strength, 7, 21)
-        
-        # Apply dilation to connect broken text
-        kernel = np.ones((2,2), np.uint8)
-        dilated = cv2.dilate(denoised, kernel, iterations=1)
-        
-        # Enhance edges
-        edges = cv2.Laplacian(dilated, cv2.CV_8U, ksize=3)
-        sharpened = cv2.addWeighted(dilated, 1.5, edges, -0.5, 0)
-        
-        # Apply contrast enhancement
-        enhanced = cv2.convertScaleAbs(sharpened, alpha=contrast_strength, beta=10)
-        
-        # Invert back to black text on white background
-        enhanced = cv2.bitwise_not(enhanced)
-        
-        return enhanced
     except Exception as e:
         st.error(f"Error in image preprocessing: {str(e)}")
         return None
 
-def extract_prescription_text(image, denoise_strength, contrast_strength):
-    try:
-        # Enhance the image
-        processed_image = enhance_prescription_image(image, denoise_strength, contrast_strength)
-        if processed_image is None:
-            return "Error: Image preprocessing failed"
-        
-        # Configure pytesseract for medical text
-        custom_config = '--oem 3 --psm 6'
-        
-        # Extract text
-        text = pytesseract.image_to_string(processed_image, config=custom_config)
-        
-        if not text.strip():
-            return "No text was detected in the prescription. Please try adjusting the image processing parameters."
-        
-        # Process and structure the extracted text
-        structured_text = process_prescription_text(text)
-        
-        return structured_text
-    except Exception as e:
-        return f"Error in text extraction: {str(e)}"
+def cached_prescription_text(image, denoise_strength, contrast_strength, detect_regions=True, image_key=None):
+    """Stored result for the logged-in user's re-upload of this image, else None"""
+    settings = settings_key(denoise_strength, contrast_strength, detect_regions)
+    return ocr_cache.lookup(st.session_state.get('username'), image_key or image_digest(image), image, settings)
 
-def process_prescription_text(text):
-    """Process and structure the prescription text"""
-    try:
-        # Split text into lines
-        lines = text.split('\n')
-        
-        # Initialize sections
-        sections = {
-            'Doctor Info': [],
-            'Patient Info': [],
-            'Medications': [],
-            'Instructions': [],
-            'Other Details': []
-        }
-        
-        current_section = 'Other Details'
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            # Try to categorize the line
-            lower_line = line.lower()
-            
-            # Check for doctor-related information
-            if any(word in lower_line for word in ['dr.', 'dr ', 'doctor', 'clinic', 'hospital']):
-                current_section = 'Doctor Info'
-                sections[current_section].append(line)
-            
-            # Check for patient-related information
-            elif any(word in lower_line for word in ['name:', 'age:', 'patient', 'sex:', 'gender:']):
-                current_section = 'Patient Info'
-                sections[current_section].append(line)
-            
-            # Check for medication-related information
-            elif any(word in lower_line for word in ['tab.', 'tablet', 'cap.', 'capsule', 'mg', 'ml', 'syrup', 'injection']):
-                current_section = 'Medications'
-                sections[current_section].append(line)
-            
-            # Check for instructions
-            elif any(word in lower_line for word in ['take', 'times', 'daily', 'days', 'morning', 'night', 'afternoon']):
-                current_section = 'Instructions'
-                sections[current_section].append(line)
-            
-            else:
-                sections[current_section].append(line)
-        
-        # Format the structured text
-        formatted_text = ""
-        for section, lines in sections.items():
-            if lines:
-                formatted_text += f"\n{section}:\n" + "-" * 40 + "\n"
-                formatted_text += "\n".join(lines) + "\n"
-        
-        return formatted_text.strip()
-    except Exception as e:
-        return text  # Return original text if processing fails
+def poll_job(job_id):
+    """
+    Check on a background job without waiting for it. Returns the job's
+    result once finished, otherwise None and a progress message.
+    """
+    status = get_job_queue().status(job_id)
+    if status is None:
+        return {'success': False, 'error': "This job has expired. Please submit it again."}, None
+    if status['status'] == DONE:
+        return status['result'], None
+    if status['status'] == QUEUED:
+        return None, f"Waiting in queue (position {status['position']})..."
+    if status['status'] == RUNNING:
+        return None, "Processing prescription..."
+    if status['status'] == CANCELLED:
+        return {'success': False, 'error': "This job was cancelled."}, None
+    return {'success': False, 'error': f"Error in text extraction: {status['error']}"}, None
+
+def refresh_while_pending(interval=JOB_POLL_INTERVAL):
+    """Rerun shortly so pending jobs are picked up without a click"""
+    time.sleep(interval)
+    st.experimental_rerun()
+
+def highlight_uncertain_words(words, threshold=LOW_CONFIDENCE):
+    """HTML of the recognised lines with uncertain words marked"""
+    lines = []
+    for _, line_words in groupby(words, key=lambda word: word.line):
+        rendered = []
+        for word in line_words:
+            text = html.escape(word.text)
+            if word.confidence < threshold:
+                text = f'<mark title="{word.confidence:.0f}% confident">{text}</mark>'
+            rendered.append(text)
+        lines.append(" ".join(rendered))
+    return "<br>".join(lines)
+
+def draw_uncertain_words(processed_image, words, threshold=LOW_CONFIDENCE):
+    """Outline uncertain words in red on the processed image"""
+    annotated = cv2.cvtColor(processed_image, cv2.COLOR_GRAY2RGB)
+    for word in words:
+        if word.confidence < threshold:
+            cv2.rectangle(
+                annotated, (word.left, word.top),
+                (word.left + word.width, word.top + word.height), (220, 0, 0), 2
+            )
+    return annotated
 
 def mr_registration_page():
     st.markdown("""
@@ -534,35 +485,33 @@ def mr_dashboard():
         st.metric("Territory", mr_details[3])  # territory field
     
     # Tabs for different sections
-    tab1, tab2, tab3 = st.tabs(["Record Visit", "Visit History", "Profile"])
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["Record Visit", "Visit History", "Profile", "Leaderboard", "Reports"])
     
     with tab1:
         st.subheader("Record New Doctor Visit")
-        doctor_id = st.selectbox("Select Doctor", ["Dr. Smith", "Dr. Johnson"])  # This should be populated from database
+        doctor_id = doctor_picker(mr_details[0])
         visit_purpose = st.text_input("Visit Purpose")
         discussion_points = st.text_area("Discussion Points")
         feedback = st.text_area("Feedback/Notes")
         next_visit_date = st.date_input("Next Visit Date")
         
         if st.button("Record Visit"):
-            success, message = record_doctor_visit(
-                mr_details[0], doctor_id, visit_purpose,
-                discussion_points, feedback, next_visit_date
-            )
-            if success:
-                st.success(message)
+            if doctor_id is None:
+                st.error("Please select a doctor")
             else:
-                st.error(message)
+                success, message = record_doctor_visit(
+                    mr_details[0], doctor_id, visit_purpose,
+                    discussion_points, feedback, next_visit_date
+                )
+                if success:
+                    st.success(message)
+                else:
+                    st.error(message)
     
     with tab2:
         st.subheader("Visit History")
-        # Display visit history in a table
-        st.dataframe({
-            "Date": ["2024-01-01", "2024-01-15"],
-            "Doctor": ["Dr. Smith", "Dr. Johnson"],
-            "Purpose": ["Product Introduction", "Follow-up"],
-            "Next Visit": ["2024-02-01", "2024-02-15"]
-        })
+        import_visits_section(mr_details[0])
+        visit_history_section(mr_details[0])
     
     with tab3:
         st.subheader("Profile Information")
@@ -583,6 +532,306 @@ def mr_dashboard():
                     st.success(message)
                 else:
                     st.error(message)
+    
+    with tab4:
+        # Both rankings are read straight from the visit rollups
+        territory = mr_details[4]  # territory field
+        st.subheader(f"{territory} This Month")
+        ranking = territory_leaderboard(territory)
+        st.dataframe({
+            "Rank": list(range(1, len(ranking) + 1)),
+            "Representative": [
+                f"{name} (you)" if mr_id == mr_details[0] else name
+                for mr_id, name, _ in ranking
+            ],
+            "Visits": [visits for _, _, visits in ranking]
+        })
+        
+        st.subheader("Territories This Month")
+        territories = scope_leaderboard('territory')
+        st.dataframe({
+            "Territory": [name for name, _ in territories],
+            "Visits": [visits for _, visits in territories]
+        })
+    
+    with tab5:
+        st.subheader("Monthly Reports")
+        reports_section(mr_details)
+
+def doctor_picker(mr_id):
+    """Search the MR's doctors by name and return the chosen doctor's ID"""
+    search = st.text_input("Find Doctor", placeholder="Start typing a name or username",
+                           key="doctor_search")
+    doctors = doctor_directory.search(mr_id, search)
+    if not doctors:
+        st.info("No assigned doctors match" if search.strip() else "No doctors are assigned to you yet")
+        return None
+    labels = {doctor[0]: doctor_label(doctor) for doctor in doctors}
+    return st.selectbox("Select Doctor", list(labels), format_func=labels.get, key="doctor_id")
+
+def import_visits_section(mr_id):
+    """Upload an offline visit log for the MR"""
+    with st.expander("Import visits from a file"):
+        st.caption("CSV or JSON Lines with doctor_id, visit_date and optionally visit_purpose, "
+                   "discussion_points, feedback, next_visit_date and status")
+        uploaded = st.file_uploader("Visit log", type=['csv', 'jsonl'], key="visit_import_file")
+        if uploaded and st.button("Import", key="visit_import_button"):
+            fmt = 'jsonl' if uploaded.name.lower().endswith('.jsonl') else 'csv'
+            with st.spinner("Importing visits..."):
+                result = import_visits(uploaded.getvalue(), fmt, mr_id=mr_id)
+            if result['imported']:
+                st.success(f"Imported {result['imported']} visits")
+            if result['errors']:
+                st.warning(f"{len(result['errors'])} rows were not imported")
+                st.dataframe({
+                    "Line": [line for line, _ in result['errors']],
+                    "Problem": [message for _, message in result['errors']]
+                })
+
+def visit_history_section(mr_id):
+    """Page through the MR's visits, fetching one page per rerun"""
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        # An empty range means all dates; a single pick is a one-day range
+        dates = st.date_input("Dates", value=(), key="history_dates")
+        start_date = dates[0] if dates else None
+        end_date = dates[-1] if dates else None
+    with col2:
+        # Same indexed search as the doctor picker, so only a page of doctors is ever loaded
+        search = st.text_input("Find Doctor", placeholder="Start typing a name or username",
+                               key="history_doctor_search")
+        labels = {doctor[0]: doctor_label(doctor) for doctor in doctor_directory.search(mr_id, search)}
+        doctor_id = st.selectbox(
+            "Doctor", [None] + list(labels),
+            format_func=lambda d: "All doctors" if d is None else labels[d],
+            key="history_doctor"
+        )
+    with col3:
+        status = st.text_input("Status", key="history_status").strip()
+    
+    # Start of each page visited so far; changing a filter starts over
+    filters = (mr_id, start_date, end_date, doctor_id, status)
+    if st.session_state.get('history_filters') != filters:
+        st.session_state['history_filters'] = filters
+        st.session_state['history_cursors'] = [None]
+    cursors = st.session_state['history_cursors']
+    
+    rows, next_cursor = get_visit_history(
+        mr_id, after=cursors[-1], start_date=start_date, end_date=end_date,
+        doctor_id=doctor_id, status=status or None
+    )
+    if not rows:
+        st.info("No visits found")
+    else:
+        st.dataframe({
+            "Date": [row[1] for row in rows],
+            "Doctor": [row[3] or f"#{row[2]}" for row in rows],
+            "Purpose": [row[4] for row in rows],
+            "Next Visit": [row[5] for row in rows],
+            "Status": [row[6] for row in rows]
+        })
+    
+    col1, col2, col3 = st.columns([1, 1, 4])
+    with col1:
+        if st.button("Previous", disabled=len(cursors) == 1, key="history_previous"):
+            cursors.pop()
+            st.experimental_rerun()
+    with col2:
+        if st.button("Next", disabled=next_cursor is None, key="history_next"):
+            cursors.append(next_cursor)
+            st.experimental_rerun()
+    with col3:
+        st.caption(f"Page {len(cursors)}")
+
+def reports_section(mr_details):
+    """Export a month's visits or per-MR totals for the MR's own territory and company"""
+    # Fixed to the MR's profile: MRs of other companies and territories must not see these visits
+    territory = (mr_details[4] or "").strip()  # territory field
+    company = (mr_details[5] or "").strip()  # company field
+    if not territory or not company:
+        st.info("Add your territory and company to your profile to export reports")
+        return
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        month = st.text_input("Month", value=datetime.now().strftime("%Y-%m"), key="report_month")
+        kind = st.radio("Report", ["summary", "visits"], key="report_kind",
+                        format_func=lambda k: {"summary": "Visits per MR", "visits": "Every visit"}[k])
+    with col2:
+        st.text_input("Territory", value=territory, disabled=True, key="report_territory")
+        st.text_input("Company", value=company, disabled=True, key="report_company")
+        fmt = st.radio("Format", list(FORMATS), key="report_format",
+                       format_func=lambda f: {"csv": "CSV", "xls": "Excel"}[f])
+    
+    if st.button("Prepare report", key="report_button"):
+        try:
+            # Rows stream from the database into a temporary file, but
+            # st.download_button keeps whatever it serves in memory; use
+            # reports.py from the command line for very large exports
+            with tempfile.TemporaryFile() as out:
+                with st.spinner("Preparing report..."):
+                    export_report(out, kind, fmt, month.strip(), territory, company)
+                out.seek(0)
+                st.download_button(
+                    "Download report", out.read(),
+                    file_name=report_filename(kind, fmt, month.strip(), territory, company),
+                    mime=FORMATS[fmt][0], key="report_download"
+                )
+        except ValueError as e:
+            st.error(str(e))
+
+def show_batch_result(result, index):
+    """Render a single batch result"""
+    if result['success']:
+        with st.expander(result['name']):
+            st.text_area("", result['text'], height=250, key=f"batch_text_{index}")
+    else:
+        st.error(f"{result['name']}: {result['error']}")
+
+def submit_batch(uploaded_files, denoise_strength, contrast_strength):
+    """Queue one background job per uploaded prescription"""
+    queue = get_job_queue()
+    # A new batch replaces the previous one, so drop whatever of it is still waiting
+    for job in st.session_state.get('batch_jobs', []):
+        queue.cancel(job['job_id'])
+    
+    jobs = []
+    for uploaded in uploaded_files:
+        success, job_id = queue.submit(
+            st.session_state.get('username'), process_prescription_file,
+            uploaded.name, uploaded.getvalue(), denoise_strength, contrast_strength,
+            owner=st.session_state.get('username'), threaded=True
+        )
+        if not success:
+            st.error(f"Queued {len(jobs)} of {len(uploaded_files)} prescriptions. {job_id}")
+            break
+        jobs.append({'name': uploaded.name, 'job_id': job_id, 'result': None})
+    st.session_state['batch_jobs'] = jobs
+
+def batch_upload_section(denoise_strength, contrast_strength):
+    """Process many prescriptions at once through the background job queue"""
+    uploaded_files = st.file_uploader(
+        "Choose prescription images", type=['png', 'jpg', 'jpeg'],
+        accept_multiple_files=True
+    )
+    if uploaded_files and st.button("Process Batch", key="batch_button"):
+        submit_batch(uploaded_files, denoise_strength, contrast_strength)
+    
+    jobs = st.session_state.get('batch_jobs', [])
+    if not jobs:
+        return
+    
+    st.markdown('<div class="section-header">Batch Results</div>', unsafe_allow_html=True)
+    for job in jobs:
+        if job['result'] is None:
+            result, _ = poll_job(job['job_id'])
+            if result is not None:
+                job['result'] = dict(result, name=job['name'])
+    results = [job['result'] for job in jobs if job['result'] is not None]
+    st.progress(len(results) / len(jobs), text=f"Processed {len(results)} of {len(jobs)}")
+    
+    # Show each prescription as soon as its job finishes
+    for index, result in enumerate(results):
+        show_batch_result(result, index)
+    
+    if len(results) < len(jobs):
+        refresh_while_pending()
+    elif results:
+        succeeded = sum(1 for result in results if result['success'])
+        st.write(f"{succeeded} of {len(results)} prescriptions extracted successfully")
+        st.download_button(
+            label="Download All Results",
+            data=build_results_archive(results),
+            file_name="prescriptions.zip",
+            mime="application/zip"
+        )
+
+def start_extraction(image, processed_image, image_key, denoise_strength, contrast_strength,
+                     detect_regions, confidence_mode, auto_tune):
+    """Answer from the OCR cache or queue a background extraction job"""
+    queue = get_job_queue()
+    previous = st.session_state.get('extraction')
+    if previous and previous['job_id']:
+        queue.cancel(previous['job_id'])
+    
+    if not (confidence_mode or auto_tune):
+        cached = cached_prescription_text(
+            image, denoise_strength, contrast_strength, detect_regions, image_key
+        )
+        if cached is not None:
+            st.session_state['extraction'] = {
+                'image_key': image_key,
+                'job_id': None,
+                'result': {'success': True, 'text': cached, 'words': [], 'tuning': None}
+            }
+            return
+    
+    success, job_id = queue.submit(
+        st.session_state.get('username'), extraction_job,
+        image, denoise_strength, contrast_strength,
+        detect_regions=detect_regions,
+        confidence_mode=confidence_mode,
+        auto_tune=auto_tune,
+        # The preview is already enhanced at these settings unless auto-tune picks others
+        processed_image=None if auto_tune else processed_image,
+        image_key=image_key,
+        owner=st.session_state.get('username'),
+        threaded=True
+    )
+    if not success:
+        st.error(job_id)
+        return
+    st.session_state['extraction'] = {'image_key': image_key, 'job_id': job_id, 'result': None}
+
+def show_extraction(image_key):
+    """Show the extraction for the current upload, polling its job while it runs"""
+    extraction = st.session_state.get('extraction')
+    if not extraction or extraction['image_key'] != image_key:
+        return
+    
+    if extraction['result'] is None:
+        result, message = poll_job(extraction['job_id'])
+        if result is None:
+            st.info(message)
+            refresh_while_pending()
+        extraction['result'] = result
+    result = extraction['result']
+    
+    tuning = result.get('tuning')
+    if tuning is not None:
+        st.info(
+            f"Auto-tune picked Denoise {tuning.denoise_strength} and Contrast {tuning.contrast_strength} "
+            f"({tuning.confidence:.0f}% mean confidence, {tuning.evaluated} settings tried)"
+        )
+    if not result['success']:
+        st.error(result['error'])
+        return
+    
+    extracted_text = result['text']
+    st.markdown('<div class="section-header">Extracted Details</div>', unsafe_allow_html=True)
+    st.markdown('<div class="prescription-box">', unsafe_allow_html=True)
+    st.text_area("", extracted_text, height=400)
+    st.markdown('</div>', unsafe_allow_html=True)
+    
+    words = result['words']
+    if words:
+        uncertain = sum(1 for word in words if word.confidence < LOW_CONFIDENCE)
+        st.markdown('<div class="section-header">Uncertain Words</div>', unsafe_allow_html=True)
+        st.write(f"{uncertain} of {len(words)} words are below {LOW_CONFIDENCE}% confidence")
+        st.markdown(
+            f'<div class="prescription-box">{highlight_uncertain_words(words)}</div>',
+            unsafe_allow_html=True
+        )
+        st.image(draw_uncertain_words(result['processed_image'], words), use_column_width=True)
+    
+    col1, col2, col3 = st.columns([1,2,1])
+    with col2:
+        st.download_button(
+            label="Download Prescription Text",
+            data=extracted_text,
+            file_name="prescription.txt",
+            mime="text/plain"
+        )
 
 def main_app():
     st.markdown("""
@@ -637,10 +886,27 @@ def main_app():
     st.sidebar.markdown('<div class="section-header">Image Settings</div>', unsafe_allow_html=True)
     denoise_strength = st.sidebar.slider("Denoise Strength", 5, 30, 15)
     contrast_strength = st.sidebar.slider("Contrast Enhancement", 1.0, 4.0, 2.0, 0.1)
+    detect_regions = st.sidebar.checkbox(
+        "Detect Text Regions", value=True,
+        help="OCR the letterhead, patient block and Rx lines separately"
+    )
+    auto_tune = st.sidebar.checkbox(
+        "Auto-tune Settings", value=False,
+        help="Search denoise and contrast automatically when extracting"
+    )
+    confidence_mode = st.sidebar.checkbox(
+        "Highlight Uncertain Words", value=False,
+        help="Re-read low-confidence words and mark the ones that stay uncertain"
+    )
     
     # Main content
     st.markdown('<div class="section-header">Upload Prescription</div>', unsafe_allow_html=True)
-    uploaded_file = st.file_uploader("Choose a prescription image", type=['png', 'jpg', 'jpeg'])
+    upload_mode = st.radio("Upload Mode", ["Single Prescription", "Batch Upload"], horizontal=True)
+    if upload_mode == "Batch Upload":
+        batch_upload_section(denoise_strength, contrast_strength)
+        uploaded_file = None
+    else:
+        uploaded_file = st.file_uploader("Choose a prescription image", type=['png', 'jpg', 'jpeg'])
     
     if uploaded_file is not None:
         try:
@@ -649,6 +915,7 @@ def main_app():
             with col1:
                 st.markdown('<div class="section-header">Original Image</div>', unsafe_allow_html=True)
                 st.markdown('<div class="image-container">', unsafe_allow_html=True)
+                image_key = bytes_digest(uploaded_file.getvalue())
                 image = Image.open(uploaded_file)
                 st.image(image, use_column_width=True)
                 st.markdown('</div>', unsafe_allow_html=True)
@@ -656,30 +923,21 @@ def main_app():
             with col2:
                 st.markdown('<div class="section-header">Processed Image</div>', unsafe_allow_html=True)
                 opencv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-                processed_image = enhance_prescription_image(opencv_image, denoise_strength, contrast_strength)
+                processed_image = enhance_prescription_image(
+                    opencv_image, denoise_strength, contrast_strength, image_key=image_key
+                )
                 if processed_image is not None:
                     st.markdown('<div class="image-container">', unsafe_allow_html=True)
                     st.image(processed_image, use_column_width=True)
                     st.markdown('</div>', unsafe_allow_html=True)
             
+            # OCR runs in the background job queue; this rerun only submits and polls
             if st.button("Extract Prescription Details", key="extract_button"):
-                with st.spinner("Processing prescription..."):
-                    extracted_text = extract_prescription_text(opencv_image, denoise_strength, contrast_strength)
-                    
-                    st.markdown('<div class="section-header">Extracted Details</div>', unsafe_allow_html=True)
-                    st.markdown('<div class="prescription-box">', unsafe_allow_html=True)
-                    st.text_area("", extracted_text, height=400)
-                    st.markdown('</div>', unsafe_allow_html=True)
-                    
-                    if extracted_text and not extracted_text.startswith("Error"):
-                        col1, col2, col3 = st.columns([1,2,1])
-                        with col2:
-                            st.download_button(
-                                label="Download Prescription Text",
-                                data=extracted_text,
-                                file_name="prescription.txt",
-                                mime="text/plain"
-                            )
+                start_extraction(
+                    opencv_image, processed_image, image_key, denoise_strength, contrast_strength,
+                    detect_regions, confidence_mode, auto_tune
+                )
+            show_extraction(image_key)
         
         except Exception as e:
             st.error(f"An error occurred while processing the prescription: {str(e)}")
@@ -0,0 +1,231 @@
+"""
+Monthly archives for old MR visits.
+
+Visits older than ``ARCHIVE_AFTER_MONTHS`` are moved out of mr_visits into
+one SQLite file per month under ``ARCHIVE_DIR``, which keeps the hot table,
+its indexes, VACUUM and backups small. archive_state in app.db lists the
+archived months, and readers ATTACH an archive only when the date range
+they were asked for reaches into it. The dashboards' counts come from the
+rollups, which keep every visit, archived or not.
+
+Moving a month takes two transactions. The first copies the month's
+visits into the archive with INSERT OR IGNORE and commits there. The
+second deletes from mr_visits only the rows the archive now holds and
+records the month in archive_state. A crash between the two leaves rows in
+both places, and rerunning finishes the move without duplicating anything.
+Readers query mr_visits before the archives and drop repeated IDs, so a
+read racing an archive run neither misses nor repeats visits. Visits that
+arrive late for an archived month, for example from a bulk import, stay
+in mr_visits until the next run moves them.
+
+    python archive.py run [--months 12]
+    python archive.py month 2023-05
+    python archive.py status
+"""
+import argparse
+import os
+import sqlite3
+from contextlib import contextmanager
+
+from db import connection
+
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('ARCHIVE_AFTER_MONTHS', '12'))
+ARCHIVE_SCHEMA = 'visit_archive'
+
+# Copied column for column; id is kept so a rerun can tell what it already has
+COLUMNS = ('id', 'mr_id', 'doctor_id', 'visit_date', 'visit_purpose', 'discussion_points',
+           'feedback', 'next_visit_date', 'status')
+
+
+def archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"mr_visits_{month.replace('-', '_')}.db")
+
+
+def month_end(month):
+    """First day of the month after 'YYYY-MM'"""
+    year, number = (int(part) for part in month.split('-'))
+    return f"{year + number // 12:04d}-{number % 12 + 1:02d}-01"
+
+
+def archived_months(c, start=None, end=None):
+    """
+    (month, path) of archived months overlapping visit dates from ``start``
+    up to ``end``, newest first. Either bound may be None.
+    """
+    rows = c.execute('SELECT month, path FROM archive_state ORDER BY month DESC').fetchall()
+    return [
+        (month, path) for month, path in rows
+        if (start is None or month_end(month) > str(start))
+        and (end is None or f"{month}-01" <= str(end))
+    ]
+
+
+def attach(conn, path, schema=ARCHIVE_SCHEMA):
+    """ATTACH an archive to ``conn`` and return its schema name"""
+    # ATTACH would quietly create an empty database in place of a lost archive
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Visit archive {path} is missing")
+    conn.execute('ATTACH DATABASE ? AS ' + schema, (path,))
+    return schema
+
+
+@contextmanager
+def attached(conn, path, schema=ARCHIVE_SCHEMA):
+    """Attach an archive to a pooled connection for the duration of a ``with`` block"""
+    attach(conn, path, schema)
+    try:
+        yield schema
+    finally:
+        conn.execute('DETACH DATABASE ' + schema)
+
+
+def newest_first(conn, run, limit, key, start=None, end=None):
+    """
+    Up to ``limit`` visit rows, newest first, from mr_visits and the archives.
+
+    ``run(table)`` runs the caller's query against one visits table and
+    returns at most ``limit`` rows in newest-first order; ``key(row)`` gives
+    (visit_date, id). ``start`` and ``end`` bound the visit dates the query
+    can return, so archives outside them are never opened.
+    """
+    rows = run('mr_visits')
+    # Listed after mr_visits was read, so a month archived meanwhile is included
+    for month, path in archived_months(conn, start, end):
+        # Everything in this archive and older ones sorts after a full page
+        if len(rows) >= limit and key(rows[limit - 1])[0] >= month_end(month):
+            break
+        with attached(conn, path) as schema:
+            rows = _newest_unique(rows + run(f'{schema}.mr_visits'), key, limit)
+    return rows
+
+
+def _newest_unique(rows, key, limit):
+    # A visit caught mid-move can come back from both tables
+    unique, seen = [], set()
+    for row in sorted(rows, key=key, reverse=True):
+        if key(row)[1] not in seen:
+            seen.add(key(row)[1])
+            unique.append(row)
+    return unique[:limit]
+
+
+def _prepare(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS mr_visits (
+                id INTEGER PRIMARY KEY,
+                mr_id INTEGER NOT NULL,
+                doctor_id INTEGER NOT NULL,
+                visit_date TIMESTAMP,
+                visit_purpose TEXT,
+                discussion_points TEXT,
+                feedback TEXT,
+                next_visit_date TIMESTAMP,
+                status TEXT
+            )
+        ''')
+        # The same indexes readers rely on in mr_visits
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_mr_visits_mr_date ON mr_visits (mr_id, visit_date)')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_mr_visits_mr_doctor_date
+            ON mr_visits (mr_id, doctor_id, visit_date)
+        ''')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def archive_month(month):
+    """Move one month ('YYYY-MM') of visits into its archive; returns the number of rows moved"""
+    start, end = f"{month}-01", month_end(month)
+    path = archive_path(month)
+    _prepare(path)
+    columns = ', '.join(COLUMNS)
+    with connection() as conn:
+        with attached(conn, path) as schema:
+            # Rows are deleted from app.db once this commits, so it must survive a power cut
+            conn.execute(f'PRAGMA {schema}.synchronous=FULL')
+            # Only the archive is written, so this holds no lock on app.db's writers
+            conn.execute('BEGIN')
+            try:
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO {schema}.mr_visits ({columns})
+                    SELECT {columns} FROM main.mr_visits
+                    WHERE visit_date >= ? AND visit_date < ?
+                ''', (start, end))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                moved = conn.execute(f'''
+                    DELETE FROM main.mr_visits
+                    WHERE visit_date >= ? AND visit_date < ?
+                    AND id IN (SELECT id FROM {schema}.mr_visits)
+                ''', (start, end)).rowcount
+                conn.execute(f'''
+                    INSERT INTO archive_state (month, path, visits)
+                    VALUES (?, ?, (SELECT COUNT(*) FROM {schema}.mr_visits))
+                    ON CONFLICT (month) DO UPDATE
+                    SET path = excluded.path, visits = excluded.visits, archived_at = CURRENT_TIMESTAMP
+                ''', (month, path))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    return moved
+
+
+def archive_old_visits(months=ARCHIVE_AFTER_MONTHS):
+    """Archive every month that ended more than ``months`` months ago; returns [(month, moved)]"""
+    with connection() as conn:
+        cutoff, oldest = conn.execute(f'''
+            SELECT date('now', 'start of month', '-{int(months)} months'),
+                   (SELECT MIN(visit_date) FROM mr_visits)
+        ''').fetchone()
+    results = []
+    while oldest is not None and oldest < cutoff:
+        month = oldest[:7]
+        results.append((month, archive_month(month)))
+        with connection() as conn:
+            oldest = conn.execute(
+                'SELECT MIN(visit_date) FROM mr_visits WHERE visit_date >= ?', (month_end(month),)
+            ).fetchone()[0]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old MR visits into monthly databases")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run = subparsers.add_parser('run', help="Archive every month older than the horizon")
+    run.add_argument('--months', type=int, default=ARCHIVE_AFTER_MONTHS)
+    month = subparsers.add_parser('month', help="Archive one month")
+    month.add_argument('month', help="e.g. 2023-05")
+    subparsers.add_parser('status', help="List archived months")
+    args = parser.parse_args()
+
+    # Imported here because auth imports this module
+    from auth import init_db
+    init_db()
+    if args.command == 'run':
+        results = archive_old_visits(args.months)
+        for archived, moved in results:
+            print(f"{archived}: moved {moved} visits")
+        if not results:
+            print("Nothing to archive")
+    elif args.command == 'month':
+        print(f"{args.month}: moved {archive_month(args.month)} visits")
+    else:
+        with connection() as conn:
+            for archived, path, visits, archived_at in conn.execute(
+                    'SELECT month, path, visits, archived_at FROM archive_state ORDER BY month'):
+                print(f"{archived}: {visits} visits in {path} (last run {archived_at})")
+
+
+if __name__ == "__main__":
+    main()
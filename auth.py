@@ -1,164 +1,35 @@
 import sqlite3
-import hashlib
-import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import jwt
 
-# Secret key for JWT tokens
-SECRET_KEY = os.urandom(32)
+from db import transaction, connection
+from migrations import migrate
+import archive
+import rollups
+from code_allocator import discount_codes
+from write_behind import get_write_behind
+from password_hashing import HasherBusy, hash_password, verify_password, needs_rehash
+from jwt_keys import TOKEN_LIFETIME, get_key_ring
+from doctor_directory import doctor_directory
 
-def init_db():
-    """Initialize the database with all required tables"""
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
-    
-    # Check if user_type column exists in users table
-    c.execute("PRAGMA table_info(users)")
-    columns = [column[1] for column in c.fetchall()]
-    
-    # If users table doesn't exist or needs to be updated
-    if 'user_type' not in columns:
-        # Create temporary table with new schema
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users_new (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                user_type TEXT DEFAULT 'doctor',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP
-            )
-        ''')
-        
-        # Copy data from old table if it exists
-        try:
-            c.execute('''
-                INSERT INTO users_new (id, username, password, email, created_at, last_login)
-                SELECT id, username, password, email, created_at, last_login FROM users
-            ''')
-            # Drop old table
-            c.execute('DROP TABLE users')
-            # Rename new table to users
-            c.execute('ALTER TABLE users_new RENAME TO users')
-        except sqlite3.OperationalError:
-            # If old table doesn't exist, just rename the new table
-            c.execute('ALTER TABLE users_new RENAME TO users')
-    else:
-        # Create users table if it doesn't exist
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                user_type TEXT DEFAULT 'doctor',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP
-            )
-        ''')
-    
-    # Create medical_representatives table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS medical_representatives (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            full_name TEXT NOT NULL,
-            phone TEXT NOT NULL,
-            territory TEXT NOT NULL,
-            company TEXT NOT NULL,
-            specialization TEXT,
-            target_doctors INTEGER DEFAULT 0,
-            current_doctors INTEGER DEFAULT 0,
-            monthly_visits INTEGER DEFAULT 0,
-            status TEXT DEFAULT 'active',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_updated TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Create mr_doctor_assignments table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS mr_doctor_assignments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            mr_id INTEGER NOT NULL,
-            doctor_id INTEGER NOT NULL,
-            assignment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            status TEXT DEFAULT 'active',
-            last_visit_date TIMESTAMP,
-            notes TEXT,
-            FOREIGN KEY (mr_id) REFERENCES medical_representatives (id),
-            FOREIGN KEY (doctor_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Create mr_visits table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS mr_visits (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            mr_id INTEGER NOT NULL,
-            doctor_id INTEGER NOT NULL,
-            visit_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            visit_purpose TEXT,
-            discussion_points TEXT,
-            feedback TEXT,
-            next_visit_date TIMESTAMP,
-            status TEXT DEFAULT 'completed',
-            FOREIGN KEY (mr_id) REFERENCES medical_representatives (id),
-            FOREIGN KEY (doctor_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Create discount_codes table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS discount_codes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT UNIQUE NOT NULL,
-            doctor_id INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            expiry_date TIMESTAMP,
-            times_used INTEGER DEFAULT 0,
-            max_uses INTEGER DEFAULT 100,
-            discount_percentage INTEGER DEFAULT 20,
-            is_active BOOLEAN DEFAULT 1,
-            FOREIGN KEY (doctor_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Update any existing users without user_type to have 'doctor' as default
-    c.execute('''
-        UPDATE users 
-        SET user_type = 'doctor' 
-        WHERE user_type IS NULL
-    ''')
-    
-    conn.commit()
-    conn.close()
+# Tokens already verified by this process, kept until they expire
+VERIFIED_TOKEN_CACHE_SIZE = 10000
+_verified_tokens = OrderedDict()
+_verified_tokens_lock = threading.Lock()
 
-def hash_password(password):
-    """Hash password using SHA-256 with salt"""
-    salt = os.urandom(32)
-    key = hashlib.pbkdf2_hmac(
-        'sha256',
-        password.encode('utf-8'),
-        salt,
-        100000
-    )
-    return salt + key
+# Set once migrations have run in this process; Streamlit reruns skip them
+_schema_ready = False
 
-def verify_password(stored_password, provided_password):
-    """Verify the provided password against stored hash"""
-    salt = stored_password[:32]
-    stored_key = stored_password[32:]
-    key = hashlib.pbkdf2_hmac(
-        'sha256',
-        provided_password.encode('utf-8'),
-        salt,
-        100000
-    )
-    return key == stored_key
+def init_db():
+    """Bring the database schema up to date, once per process"""
+    global _schema_ready
+    if not _schema_ready:
+        migrate()
+        _schema_ready = True
 
 def is_valid_email(email):
     """Validate email format"""
@@ -185,7 +56,7 @@ def is_valid_password(password):
         return False
     return True
 
-def register_user(username, password, email):
+def register_user(username, password, email, full_name=None):
     """Register a new user"""
     try:
         # Validate input
@@ -202,53 +73,80 @@ def register_user(username, password, email):
         hashed_password = hash_password(password)
         
         # Store in database
-        conn = sqlite3.connect('app.db')
-        c = conn.cursor()
-        c.execute('INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
-                 (username, hashed_password, email))
-        conn.commit()
-        conn.close()
+        with transaction() as conn:
+            conn.execute('INSERT INTO users (username, password, email, full_name) VALUES (?, ?, ?, ?)',
+                         (username, hashed_password, email, full_name or None))
         
         return True, "Registration successful"
     except sqlite3.IntegrityError:
         return False, "Username or email already exists"
+    except HasherBusy as e:
+        return False, str(e)
     except Exception as e:
         return False, f"Registration failed: {str(e)}"
 
 def login_user(username, password):
     """Login user and return JWT token if successful"""
     try:
-        conn = sqlite3.connect('app.db')
-        c = conn.cursor()
-        c.execute('SELECT id, password, user_type FROM users WHERE username = ?', (username,))
-        user = c.fetchone()
+        with connection() as conn:
+            c = conn.cursor()
+            c.execute('SELECT id, password, user_type FROM users WHERE username = ?', (username,))
+            user = c.fetchone()
         
+        # The connection goes back to the pool before the slow password check
         if user and verify_password(user[1], password):
-            # Update last login
-            c.execute('UPDATE users SET last_login = ? WHERE id = ?',
-                     (datetime.now(), user[0]))
-            conn.commit()
+            # Now that we have the password, move legacy or weaker hashes to the current format
+            if needs_rehash(user[1]):
+                try:
+                    upgraded = hash_password(password)
+                    with transaction() as conn:
+                        conn.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?',
+                                     (upgraded, user[0], user[1]))
+                except HasherBusy:
+                    pass
             
-            # Generate JWT token
-            token = jwt.encode({
+            # Update last login, batched with other logins when write-behind is on
+            write_behind = get_write_behind()
+            if write_behind:
+                write_behind.record_login(user[0], datetime.now())
+            else:
+                with transaction() as conn:
+                    conn.execute('UPDATE users SET last_login = ? WHERE id = ?',
+                                 (datetime.now(), user[0]))
+            
+            # Generate JWT token, signed with the shared key ring
+            token = get_key_ring().sign({
                 'user_id': user[0],
                 'username': username,
                 'user_type': user[2],
-                'exp': datetime.utcnow() + timedelta(hours=24)
-            }, SECRET_KEY, algorithm='HS256')
+                'exp': datetime.utcnow() + timedelta(seconds=TOKEN_LIFETIME)
+            })
             
             return True, token, user[0], user[2]  # Return user_id and user_type
         else:
             return False, "Invalid username or password", None, None
+    except HasherBusy as e:
+        return False, str(e), None, None
     except Exception as e:
         return False, f"Login failed: {str(e)}", None, None
-    finally:
-        conn.close()
 
 def verify_token(token):
     """Verify JWT token"""
+    with _verified_tokens_lock:
+        payload = _verified_tokens.get(token)
+        if payload is not None:
+            if payload['exp'] > time.time():
+                _verified_tokens.move_to_end(token)
+                return True, payload
+            del _verified_tokens[token]
+            return False, "Token has expired"
+    
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+        payload = get_key_ring().decode(token)
+        with _verified_tokens_lock:
+            _verified_tokens[token] = payload
+            if len(_verified_tokens) > VERIFIED_TOKEN_CACHE_SIZE:
+                _verified_tokens.popitem(last=False)
         return True, payload
     except jwt.ExpiredSignatureError:
         return False, "Token has expired"
@@ -257,68 +155,93 @@ def verify_token(token):
 
 def create_discount_code(doctor_id, code, expiry_days=30, max_uses=100, discount_percentage=20):
     """Create a new discount code for a doctor"""
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
-    
     try:
         expiry_date = datetime.now() + timedelta(days=expiry_days)
-        c.execute('''
-            INSERT INTO discount_codes 
-            (code, doctor_id, expiry_date, max_uses, discount_percentage)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (code, doctor_id, expiry_date, max_uses, discount_percentage))
-        conn.commit()
+        with transaction() as conn:
+            conn.execute('''
+                INSERT INTO discount_codes 
+                (code, doctor_id, expiry_date, expiry_ts, max_uses, discount_percentage)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (code, doctor_id, expiry_date, int(expiry_date.timestamp()), max_uses, discount_percentage))
         return True, "Discount code created successfully"
     except sqlite3.IntegrityError:
         return False, "Discount code already exists"
-    finally:
-        conn.close()
+
+def issue_discount_codes(doctor_ids, expiry_days=30, max_uses=100, discount_percentage=20):
+    """
+    Allocate and store a new discount code for each doctor in one
+    transaction. Returns (True, {doctor_id: code}) or (False, message).
+    """
+    try:
+        doctor_ids = list(doctor_ids)
+        expiry_date = datetime.now() + timedelta(days=expiry_days)
+        with transaction() as conn:
+            c = conn.cursor()
+            codes = discount_codes.reserve(c, len(doctor_ids))
+            c.executemany('''
+                INSERT INTO discount_codes 
+                (code, doctor_id, expiry_date, expiry_ts, max_uses, discount_percentage)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [
+                (code, doctor_id, expiry_date, int(expiry_date.timestamp()), max_uses, discount_percentage)
+                for code, doctor_id in zip(codes, doctor_ids)
+            ])
+        return True, dict(zip(doctor_ids, codes))
+    except Exception as e:
+        return False, f"Failed to create discount codes: {str(e)}"
+
+def issue_discount_code(doctor_id, expiry_days=30, max_uses=100, discount_percentage=20):
+    """Allocate and store a new discount code for a doctor; returns (True, code) or (False, message)"""
+    success, result = issue_discount_codes([doctor_id], expiry_days, max_uses, discount_percentage)
+    if not success:
+        return False, result
+    return True, result[doctor_id]
 
 def validate_discount_code(code):
     """Validate a discount code and return discount percentage if valid"""
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
-    
-    try:
-        c.execute('''
-            SELECT discount_percentage, times_used, max_uses, expiry_date, is_active
-            FROM discount_codes
-            WHERE code = ?
-        ''', (code,))
-        
-        result = c.fetchone()
-        
-        if not result:
-            return False, "Invalid discount code"
-            
-        discount_percentage, times_used, max_uses, expiry_date, is_active = result
-        
-        if not is_active:
-            return False, "This discount code is no longer active"
-            
-        if times_used >= max_uses:
-            return False, "This discount code has reached its maximum usage limit"
+    now = int(time.time())
+    write_behind = get_write_behind()
+    if write_behind:
+        # Redeemed from a leased block of uses, written back in batches
+        result = write_behind.redeem(code, now)
+    else:
+        with transaction() as conn:
+            c = conn.cursor()
             
-        expiry = datetime.strptime(expiry_date, '%Y-%m-%d %H:%M:%S.%f')
-        if expiry < datetime.now():
-            return False, "This discount code has expired"
+            # Check every rule and count the use in one statement, so concurrent
+            # redemptions cannot overshoot max_uses, counting uses leased out to
+            # write-behind buffers. The old row values feed both SET expressions;
+            # RETURNING gives what is needed to explain a rejection.
+            c.execute('''
+                UPDATE discount_codes
+                SET last_attempt_ok = (is_active AND times_used + reserved_uses < max_uses
+                                       AND COALESCE(expiry_ts > ?, 1)),
+                    times_used = times_used + (is_active AND times_used + reserved_uses < max_uses
+                                               AND COALESCE(expiry_ts > ?, 1))
+                WHERE code = ?
+                RETURNING discount_percentage, last_attempt_ok, is_active, times_used + reserved_uses, max_uses
+            ''', (now, now, code))
             
-        # Update usage count
-        c.execute('''
-            UPDATE discount_codes
-            SET times_used = times_used + 1
-            WHERE code = ?
-        ''', (code,))
+            result = c.fetchone()
+        
+    if not result:
+        return False, "Invalid discount code"
         
-        conn.commit()
+    discount_percentage, redeemed, is_active, uses, max_uses = result
+    
+    if redeemed:
         return True, f"{discount_percentage}% discount applied successfully!"
+    
+    if not is_active:
+        return False, "This discount code is no longer active"
+        
+    if uses >= max_uses:
+        return False, "This discount code has reached its maximum usage limit"
         
-    finally:
-        conn.close()
+    return False, "This discount code has expired"
 
 def register_mr(username, password, email, full_name, phone, territory, company, specialization):
     """Register a new Medical Representative"""
-    conn = None
     try:
         if not all([username, password, email, full_name, phone, territory, company]):
             return False, "All required fields must be filled"
@@ -329,45 +252,40 @@ def register_mr(username, password, email, full_name, phone, territory, company,
         if not is_valid_password(password):
             return False, "Password must be at least 8 characters and contain uppercase, lowercase, numbers, and special characters"
         
-        conn = sqlite3.connect('app.db')
-        c = conn.cursor()
-        
-        # First create user account
         hashed_password = hash_password(password)
-        c.execute('''
-            INSERT INTO users (username, password, email, user_type)
-            VALUES (?, ?, ?, 'mr')
-        ''', (username, hashed_password, email))
         
-        user_id = c.lastrowid
-        
-        # Then create MR profile
-        c.execute('''
-            INSERT INTO medical_representatives 
-            (user_id, full_name, phone, territory, company, specialization)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, full_name, phone, territory, company, specialization))
+        # The user account and MR profile are created together or not at all
+        with transaction() as conn:
+            c = conn.cursor()
+            
+            # First create user account
+            c.execute('''
+                INSERT INTO users (username, password, email, user_type)
+                VALUES (?, ?, ?, 'mr')
+            ''', (username, hashed_password, email))
+            
+            user_id = c.lastrowid
+            
+            # Then create MR profile
+            c.execute('''
+                INSERT INTO medical_representatives 
+                (user_id, full_name, phone, territory, company, specialization)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, full_name, phone, territory, company, specialization))
         
-        conn.commit()
         return True, "Medical Representative registered successfully"
     
     except sqlite3.IntegrityError:
-        if conn:
-            conn.rollback()
         return False, "Username or email already exists"
+    except HasherBusy as e:
+        return False, str(e)
     except Exception as e:
-        if conn:
-            conn.rollback()
         return False, f"Registration failed: {str(e)}"
-    finally:
-        if conn:
-            conn.close()
 
 def get_mr_details(user_id):
     """Get Medical Representative details"""
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
-    try:
+    with connection() as conn:
+        c = conn.cursor()
         c.execute('''
             SELECT mr.*, u.email, u.username
             FROM medical_representatives mr
@@ -375,77 +293,179 @@ def get_mr_details(user_id):
             WHERE u.id = ?
         ''', (user_id,))
         return c.fetchone()
-    finally:
-        conn.close()
 
 def update_mr_profile(user_id, full_name, phone, territory, company, specialization):
     """Update Medical Representative profile"""
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
     try:
-        c.execute('''
-            UPDATE medical_representatives
-            SET full_name = ?, phone = ?, territory = ?, 
-                company = ?, specialization = ?, last_updated = CURRENT_TIMESTAMP
-            WHERE user_id = ?
-        ''', (full_name, phone, territory, company, specialization, user_id))
-        conn.commit()
+        with transaction() as conn:
+            conn.execute('''
+                UPDATE medical_representatives
+                SET full_name = ?, phone = ?, territory = ?, 
+                    company = ?, specialization = ?, last_updated = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+            ''', (full_name, phone, territory, company, specialization, user_id))
         return True, "Profile updated successfully"
     except Exception as e:
         return False, f"Update failed: {str(e)}"
-    finally:
-        conn.close()
 
 def record_doctor_visit(mr_id, doctor_id, visit_purpose, discussion_points, feedback, next_visit_date):
     """Record a doctor visit by MR"""
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
     try:
-        c.execute('''
-            INSERT INTO mr_visits 
-            (mr_id, doctor_id, visit_purpose, discussion_points, feedback, next_visit_date)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (mr_id, doctor_id, visit_purpose, discussion_points, feedback, next_visit_date))
-        
-        # Update last visit date in assignments
-        c.execute('''
-            UPDATE mr_doctor_assignments
-            SET last_visit_date = CURRENT_TIMESTAMP
-            WHERE mr_id = ? AND doctor_id = ?
-        ''', (mr_id, doctor_id))
+        with transaction() as conn:
+            c = conn.cursor()
+            c.execute('''
+                INSERT INTO mr_visits 
+                (mr_id, doctor_id, visit_purpose, discussion_points, feedback, next_visit_date)
+                VALUES (?, ?, ?, ?, ?, ?)
+                RETURNING visit_date
+            ''', (mr_id, doctor_id, visit_purpose, discussion_points, feedback, next_visit_date))
+            visit_date = c.fetchone()[0]
+            
+            # Count it in the MR, territory and company rollups
+            rollups.record_visits(c, mr_id, visit_date)
+            
+            # Update last visit date in assignments
+            c.execute('''
+                UPDATE mr_doctor_assignments
+                SET last_visit_date = CURRENT_TIMESTAMP
+                WHERE mr_id = ? AND doctor_id = ?
+            ''', (mr_id, doctor_id))
         
-        conn.commit()
         return True, "Visit recorded successfully"
     except Exception as e:
         return False, f"Failed to record visit: {str(e)}"
-    finally:
-        conn.close()
+
+def assign_doctor(mr_id, doctor_id, notes=None):
+    """Assign a doctor to an MR"""
+    try:
+        with transaction() as conn:
+            c = conn.cursor()
+            c.execute('''
+                INSERT INTO mr_doctor_assignments (mr_id, doctor_id, notes)
+                VALUES (?, ?, ?)
+            ''', (mr_id, doctor_id, notes))
+            rollups.change_current_doctors(c, mr_id, 1)
+        doctor_directory.invalidate(mr_id)
+        return True, "Doctor assigned successfully"
+    except Exception as e:
+        return False, f"Failed to assign doctor: {str(e)}"
+
+def update_assignment_status(assignment_id, status):
+    """Change an assignment's status, e.g. to 'inactive' when a doctor is handed over"""
+    try:
+        with transaction() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT mr_id, status FROM mr_doctor_assignments WHERE id = ?
+            ''', (assignment_id,))
+            assignment = c.fetchone()
+            if not assignment:
+                return False, "Assignment not found"
+            
+            mr_id, old_status = assignment
+            c.execute('''
+                UPDATE mr_doctor_assignments SET status = ? WHERE id = ?
+            ''', (status, assignment_id))
+            # Only moves into or out of 'active' change the doctor count
+            delta = (status == 'active') - (old_status == 'active')
+            if delta:
+                rollups.change_current_doctors(c, mr_id, delta)
+        doctor_directory.invalidate(mr_id)
+        return True, "Assignment updated successfully"
+    except Exception as e:
+        return False, f"Failed to update assignment: {str(e)}"
+
+# Statistics queries, kept here so benchmarks.py can check their query plans
+CURRENT_DOCTORS_QUERY = '''
+    SELECT current_doctors 
+    FROM medical_representatives 
+    WHERE id = ?
+'''
+
+MONTHLY_VISITS_QUERY = '''
+    SELECT visits 
+    FROM mr_visit_rollups 
+    WHERE scope = 'mr' AND scope_key = ? 
+    AND period = 'month' AND period_start = date('now', 'start of month')
+'''
+
+# Visits shown per page of an MR's history
+VISIT_HISTORY_PAGE_SIZE = 50
 
 def get_mr_statistics(mr_id):
     """Get MR performance statistics"""
-    conn = sqlite3.connect('app.db')
-    c = conn.cursor()
-    try:
-        # Get total assigned doctors
-        c.execute('''
-            SELECT COUNT(*) 
-            FROM mr_doctor_assignments 
-            WHERE mr_id = ? AND status = 'active'
-        ''', (mr_id,))
-        total_doctors = c.fetchone()[0]
+    with connection() as conn:
+        c = conn.cursor()
+        # Both come from rollups kept current by the writers
+        c.execute(CURRENT_DOCTORS_QUERY, (mr_id,))
+        row = c.fetchone()
+        total_doctors = row[0] if row else 0
         
-        # Get total visits this month
-        c.execute('''
-            SELECT COUNT(*) 
-            FROM mr_visits 
-            WHERE mr_id = ? 
-            AND strftime('%Y-%m', visit_date) = strftime('%Y-%m', 'now')
-        ''', (mr_id,))
-        monthly_visits = c.fetchone()[0]
+        c.execute(MONTHLY_VISITS_QUERY, (str(mr_id),))
+        row = c.fetchone()
+        monthly_visits = row[0] if row else 0
         
         return {
             'total_doctors': total_doctors,
             'monthly_visits': monthly_visits
         }
-    finally:
-        conn.close() 
\ No newline at end of file
+
+def visit_history_query(mr_id, after=None, limit=VISIT_HISTORY_PAGE_SIZE,
+                        start_date=None, end_date=None, doctor_id=None, status=None, table='mr_visits'):
+    """SQL and parameters for one page of get_visit_history from one visits table"""
+    conditions = ['v.mr_id = ?']
+    params = [mr_id]
+    if doctor_id is not None:
+        conditions.append('v.doctor_id = ?')
+        params.append(doctor_id)
+    if status:
+        conditions.append('v.status = ?')
+        params.append(status)
+    if start_date:
+        conditions.append('v.visit_date >= ?')
+        params.append(str(start_date))
+    if end_date:
+        conditions.append("v.visit_date < date(?, '+1 day')")
+        params.append(str(end_date))
+    if after:
+        # Keyset: resume strictly after the last row of the previous page
+        conditions.append('(v.visit_date, v.id) < (?, ?)')
+        params.extend(after)
+    query = f'''
+        SELECT v.id, v.visit_date, v.doctor_id, COALESCE(u.full_name, u.username), v.visit_purpose,
+               v.next_visit_date, v.status
+        FROM {table} v
+        LEFT JOIN main.users u ON u.id = v.doctor_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY v.visit_date DESC, v.id DESC
+        LIMIT ?
+    '''
+    # One extra row tells us whether there is a next page
+    params.append(limit + 1)
+    return query, params
+
+def get_visit_history(mr_id, after=None, limit=VISIT_HISTORY_PAGE_SIZE,
+                      start_date=None, end_date=None, doctor_id=None, status=None):
+    """
+    One page of an MR's visits, newest first, as (rows, next_cursor).
+
+    Rows are (id, visit_date, doctor_id, doctor_name, visit_purpose,
+    next_visit_date, status). Pass next_cursor back as ``after`` for the
+    following page; it is None on the last page. Pages are read by keyset
+    on (visit_date, id), so every page costs the same however deep it is,
+    and monthly archives are only opened once a page reaches back into them.
+    """
+    def page(table):
+        query, params = visit_history_query(mr_id, after, limit, start_date, end_date,
+                                            doctor_id, status, table)
+        return conn.execute(query, params).fetchall()
+
+    # Newest visit date the page can hold
+    bounds = [str(value) for value in (end_date, after and after[0]) if value]
+    with connection() as conn:
+        rows = archive.newest_first(conn, page, limit + 1, key=lambda row: (row[1], row[0]),
+                                    start=start_date, end=min(bounds) if bounds else None)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1][1], rows[-1][0])
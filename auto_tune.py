@@ -0,0 +1,81 @@
+import os
+from collections import namedtuple
+
+import cv2
+
+from image_pipeline import StageCache, enhance_image
+from ocr_pipeline import ocr_words_stage, run_in_threads
+
+# Candidate settings, spanning the sidebar slider ranges
+DENOISE_CANDIDATES = (10, 15, 20, 5, 25, 30)
+CONTRAST_CANDIDATES = (2.0, 1.5, 2.5, 3.0, 1.0, 4.0)
+DEFAULT_SETTINGS = (15, 2.0)
+
+# Stop searching once a candidate reaches this mean word confidence
+TARGET_CONFIDENCE = 85
+
+# Long side of the downscaled copy the candidates are scored on
+SEARCH_SIDE = 1200
+
+TuningResult = namedtuple(
+    'TuningResult', ['denoise_strength', 'contrast_strength', 'confidence', 'evaluated']
+)
+
+
+def downscale_for_search(image, max_side=SEARCH_SIDE):
+    height, width = image.shape[:2]
+    scale = max_side / float(max(height, width))
+    if scale >= 1.0:
+        return image
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def candidate_grid(denoise_values=DENOISE_CANDIDATES, contrast_values=CONTRAST_CANDIDATES,
+                   start=DEFAULT_SETTINGS):
+    """All (denoise, contrast) pairs, closest to the default settings first"""
+    grid = [(d, c) for d in denoise_values for c in contrast_values]
+    return sorted(grid, key=lambda p: (abs(p[0] - start[0]) / 5.0 + abs(p[1] - start[1]) / 0.5, p))
+
+
+def score_parameters(image, denoise_strength, contrast_strength, cache=None):
+    """Mean word confidence, weighted by word length, for one setting"""
+    processed = enhance_image(image, denoise_strength, contrast_strength, cache=cache)
+    # Candidates already run in parallel, so keep each one single-threaded
+    words = ocr_words_stage(processed, parallel=False)
+    words = [word for word in words if any(ch.isalnum() for ch in word.text)]
+    if not words:
+        return 0.0
+    total = sum(len(word.text) for word in words)
+    return sum(word.confidence * len(word.text) for word in words) / total
+
+
+def search_parameters(image, candidates=None, target_confidence=TARGET_CONFIDENCE, wave_size=None,
+                      parallel=True):
+    """
+    Score candidate settings on a downscaled copy, a wave at a time in
+    parallel, and stop as soon as one reaches ``target_confidence``.
+    Returns the best setting found; only the winner needs a full-resolution pass.
+    ``parallel`` is as for run_in_threads: a job queue worker passes its
+    thread budget, and False scores one candidate at a time inline.
+    """
+    small = downscale_for_search(image)
+    candidates = list(candidates or candidate_grid())
+    if parallel is True:
+        wave_size = wave_size or os.cpu_count() or 1
+    else:
+        wave_size = max(1, int(parallel))
+
+    # Candidates sharing a denoise value reuse its denoised stage
+    cache = StageCache(max_bytes=64 * 1024 * 1024)
+    best = TuningResult(*DEFAULT_SETTINGS, confidence=-1.0, evaluated=0)
+    evaluated = 0
+    for start in range(0, len(candidates), wave_size):
+        wave = candidates[start:start + wave_size]
+        scores = run_in_threads(lambda p: score_parameters(small, p[0], p[1], cache), wave, wave_size)
+        for (denoise_strength, contrast_strength), confidence in zip(wave, scores):
+            evaluated += 1
+            if confidence > best.confidence:
+                best = TuningResult(denoise_strength, contrast_strength, confidence, evaluated)
+        if best.confidence >= target_confidence:
+            break
+    return best._replace(evaluated=evaluated)
@@ -0,0 +1,89 @@
+"""
+Headless bulk prescription OCR.
+
+Runs the same preprocessing, OCR and text structuring as the Streamlit app
+over a directory tree or a list of paths, writing one JSON line per
+prescription as soon as it is processed:
+
+    python batch_ocr.py scans/ -o results.jsonl
+    find scans -name '*.jpg' | python batch_ocr.py --list - -o results.jsonl
+
+An existing output file is overwritten unless --append is given.
+"""
+import argparse
+import json
+import os
+import sys
+
+from batch_processing import create_executor, default_worker_count, iter_path_results
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def iter_image_paths(inputs, list_file=None):
+    """Yield image paths from files, directory trees and an optional list file"""
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, name)
+        else:
+            yield item
+
+    if list_file:
+        f = sys.stdin if list_file == '-' else open(list_file, encoding='utf-8')
+        try:
+            for line in f:
+                path = line.strip()
+                if path:
+                    yield path
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk prescription OCR to JSON lines")
+    parser.add_argument('inputs', nargs='*', help="Image files or directories to walk")
+    parser.add_argument('--list', dest='list_file', help="File with one image path per line ('-' for stdin)")
+    parser.add_argument('-o', '--output', default='-', help="Output JSONL file (default: stdout)")
+    parser.add_argument('--append', action='store_true',
+                        help="Add to the output file instead of overwriting it")
+    parser.add_argument('--workers', type=int, default=default_worker_count(), help="Worker processes")
+    parser.add_argument('--denoise', type=int, default=15, help="Denoise strength")
+    parser.add_argument('--contrast', type=float, default=2.0, help="Contrast enhancement")
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.list_file:
+        parser.error("Provide image paths, directories or --list")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    out = sys.stdout if args.output == '-' else open(args.output, 'a' if args.append else 'w', encoding='utf-8')
+    processed = failed = 0
+    executor = create_executor(args.workers)
+    try:
+        paths = iter_image_paths(args.inputs, args.list_file)
+        results = iter_path_results(
+            paths, args.denoise, args.contrast, executor, max_pending=args.workers * 2
+        )
+        for result in results:
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            processed += 1
+            if not result['success']:
+                failed += 1
+    finally:
+        executor.shutdown()
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"Processed {processed} prescriptions ({failed} failed)", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
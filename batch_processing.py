@@ -0,0 +1,207 @@
+import io
+import json
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from auto_tune import search_parameters
+from image_pipeline import bytes_digest, enhance_image, normalized_grayscale
+from ocr_cache import ocr_cache, settings_key
+from ocr_engine import get_ocr_backend
+from ocr_pipeline import (
+    extract_structured_text,
+    extract_structured_words,
+    ocr_regions_stage,
+    process_prescription_text,
+    region_lines_to_text
+)
+
+NO_TEXT_MESSAGE = "No text was detected in the prescription. Please try adjusting the image processing parameters."
+
+
+def default_worker_count():
+    """Size the pool to the available cores"""
+    return os.cpu_count() or 1
+
+
+def _init_worker():
+    # Jobs already share out the cores between them, so keep OpenCV from
+    # spawning its own thread pool on top of that
+    cv2.setNumThreads(1)
+    # Load the OCR language data once per worker, before the first job
+    get_ocr_backend()
+
+
+def create_executor(max_workers=None):
+    """Create a process pool for prescription processing"""
+    # The same goes for Tesseract's OpenMP threads. Workers import tesserocr,
+    # and libgomp reads this, before _init_worker runs, so it has to be in
+    # the environment the spawned workers inherit
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    return ProcessPoolExecutor(
+        max_workers=max_workers or default_worker_count(),
+        # Streamlit runs scripts on threads, which makes fork unsafe
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker
+    )
+
+
+def decode_image_bytes(data):
+    """Decode uploaded image bytes into a BGR array"""
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+    return cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+
+
+def process_prescription_file(name, data, denoise_strength, contrast_strength, owner=None, parallel=False):
+    """
+    Preprocess, OCR and structure a single prescription image. Cached
+    results are only shared between calls with the same ``owner``; without
+    one, as in batch_ocr runs, the OCR cache is not used.
+    ``parallel`` is the job's thread budget for reading regions.
+    """
+    try:
+        image = decode_image_bytes(data)
+        
+        # Skip denoise and OCR for prescriptions this owner has already uploaded
+        content_hash = bytes_digest(data)
+        settings = settings_key(denoise_strength, contrast_strength)
+        cached = ocr_cache.lookup(owner, content_hash, image, settings)
+        if cached is not None:
+            return {'name': name, 'success': True, 'cached': True, 'text': cached}
+        
+        processed_image = enhance_image(image, denoise_strength, contrast_strength)
+        region_lines = ocr_regions_stage(processed_image, parallel=parallel)
+        if not region_lines:
+            return {
+                'name': name,
+                'success': False,
+                'error': "No text was detected in the prescription"
+            }
+        text = process_prescription_text(region_lines)
+        ocr_cache.store(owner, content_hash, image, settings, text)
+        return {
+            'name': name,
+            'success': True,
+            'cached': False,
+            'raw_text': region_lines_to_text(region_lines),
+            'text': text
+        }
+    except Exception as e:
+        return {'name': name, 'success': False, 'error': str(e)}
+
+
+def extraction_job(image, denoise_strength, contrast_strength, detect_regions=True,
+                   confidence_mode=False, auto_tune=False, processed_image=None, image_key=None,
+                   owner=None, parallel=False):
+    """
+    Single-prescription extraction as run by the job queue. ``processed_image``
+    skips enhancing again when the preview is already at these settings, and
+    ``image_key`` stores plain extraction results in ``owner``'s OCR cache.
+    ``parallel`` is the thread budget the queue gave the job, used for
+    auto-tune candidates, regions and re-read words alike.
+    """
+    try:
+        tuning = None
+        if auto_tune:
+            tuning = search_parameters(image, parallel=parallel)
+            denoise_strength = tuning.denoise_strength
+            contrast_strength = tuning.contrast_strength
+            processed_image = None
+        if processed_image is None:
+            processed_image = enhance_image(image, denoise_strength, contrast_strength)
+        
+        words = []
+        if confidence_mode:
+            gray_image = normalized_grayscale(image)
+            text, words = extract_structured_words(
+                processed_image, gray_image, detect_regions=detect_regions, parallel=parallel
+            )
+        else:
+            text = extract_structured_text(processed_image, detect_regions=detect_regions, parallel=parallel)
+        if text is None:
+            return {'success': False, 'error': NO_TEXT_MESSAGE, 'tuning': tuning}
+        
+        if image_key and not (auto_tune or confidence_mode):
+            settings = settings_key(denoise_strength, contrast_strength, detect_regions)
+            ocr_cache.store(owner, image_key, image, settings, text)
+        return {
+            'success': True,
+            'text': text,
+            'words': words,
+            'tuning': tuning,
+            # Uncertain words are drawn on the image they were read from
+            'processed_image': processed_image if words else None
+        }
+    except Exception as e:
+        return {'success': False, 'error': f"Error in text extraction: {str(e)}"}
+
+
+def process_prescription_path(path, denoise_strength, contrast_strength):
+    """Read a prescription image from disk and process it"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        return {'name': path, 'success': False, 'error': str(e)}
+    return process_prescription_file(path, data, denoise_strength, contrast_strength)
+
+
+def iter_path_results(paths, denoise_strength, contrast_strength, executor, max_pending=None):
+    """
+    Process image paths across the pool, keeping at most ``max_pending``
+    jobs in flight so memory stays flat however many paths are given.
+    Workers read the files themselves; results arrive in completion order.
+    """
+    max_pending = max_pending or default_worker_count() * 2
+    pending = {}
+    paths = iter(paths)
+    exhausted = False
+    while pending or not exhausted:
+        while not exhausted and len(pending) < max_pending:
+            path = next(paths, None)
+            if path is None:
+                exhausted = True
+                break
+            future = executor.submit(process_prescription_path, path, denoise_strength, contrast_strength)
+            pending[future] = path
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            path = pending.pop(future)
+            try:
+                yield future.result()
+            except Exception as e:
+                yield {'name': path, 'success': False, 'error': str(e)}
+
+
+def build_results_archive(results):
+    """Bundle batch results into a zip with one text file per prescription"""
+    buffer = io.BytesIO()
+    used_names = set()
+    summary = []
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for result in results:
+            stem = os.path.splitext(os.path.basename(result['name']))[0] or 'prescription'
+            file_name = f"{stem}.txt"
+            counter = 1
+            while file_name in used_names:
+                counter += 1
+                file_name = f"{stem}_{counter}.txt"
+            used_names.add(file_name)
+
+            if result['success']:
+                archive.writestr(file_name, result['text'])
+            summary.append({
+                'name': result['name'],
+                'file': file_name if result['success'] else None,
+                'success': result['success'],
+                'error': result.get('error')
+            })
+        archive.writestr('summary.json', json.dumps(summary, indent=2))
+    return buffer.getvalue()
@@ -0,0 +1,843 @@
+"""
+Performance benchmarks for the prescription app.
+
+    python benchmarks.py normalization --scales 1 2 4
+    python benchmarks.py ocr-backends --calls 20
+    python benchmarks.py ocr-cache
+    python benchmarks.py db-concurrency --threads 8
+    python benchmarks.py query-plans --visits 200000
+    python benchmarks.py discount-redemption --processes 8 --max-uses 100
+    python benchmarks.py discount-codes --doctors 10000
+    python benchmarks.py logins --threads 32
+    python benchmarks.py archive --visits 200000
+"""
+import argparse
+import difflib
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from io import BytesIO
+
+import cv2
+import numpy as np
+import pytesseract
+
+import rollups
+from archive import archive_old_visits, archived_months
+from auth import (
+    CURRENT_DOCTORS_QUERY,
+    MONTHLY_VISITS_QUERY,
+    assign_doctor,
+    create_discount_code,
+    get_visit_history,
+    init_db,
+    issue_discount_codes,
+    login_user,
+    record_doctor_visit,
+    register_mr,
+    register_user,
+    validate_discount_code,
+    visit_history_query
+)
+from bulk_import import import_visits
+from db import ConnectionPool, transaction
+from reports import export_report, visit_report_query
+from doctor_directory import (
+    ASSIGNED_DOCTORS_QUERY,
+    FULL_NAME_SEARCH_QUERY,
+    USERNAME_SEARCH_QUERY,
+    DoctorDirectory,
+    doctor_directory,
+    doctor_label
+)
+from write_behind import get_write_behind
+from migrations import migrate
+from image_pipeline import DEFAULT_NORMALIZATION, enhance_image, image_digest
+from ocr_cache import OcrResultCache, hamming_distance, ink_difference, ink_mask, perceptual_hash, settings_key
+from ocr_engine import PytesseractBackend, TesserocrBackend, tesserocr
+from ocr_pipeline import ocr_stage
+
+SAMPLE_LINES = [
+    "Dr. A. Sharma MBBS MD",
+    "City Clinic, Main Road",
+    "Patient Name: Ravi Kumar Age: 42",
+    "Tab. Amoxicillin 500mg",
+    "Take one tablet three times daily for 5 days",
+    "Tab. Paracetamol 650mg",
+    "Take one tablet at night if fever",
+    "Syrup Benadryl 10ml twice daily",
+]
+
+# Other prescriptions on the same letterhead as SAMPLE_LINES
+OTHER_PATIENT_LINES = SAMPLE_LINES[:2] + [
+    "Patient Name: Sunita Rao Age: 67",
+    "Cap. Omeprazole 20mg",
+    "One capsule before breakfast for 14 days",
+    "Tab. Metformin 500mg",
+    "Twice daily after meals",
+    "Review after one month",
+]
+OTHER_DOSES_LINES = SAMPLE_LINES[:2] + [
+    "Patient Name: Ravi Kumar Age: 24",
+    "Tab. Amoxicillin 250mg",
+    "Take one tablet twice daily for 3 days",
+    "Tab. Paracetamol 500mg",
+    "Take one tablet at night if fever",
+    "Syrup Benadryl 5ml twice daily",
+]
+
+
+def render_prescription(scale, seed=0, lines=SAMPLE_LINES):
+    """Render a noisy synthetic prescription whose text is ``scale`` times the base size"""
+    rng = np.random.default_rng(seed)
+    height, width = int(1100 * scale), int(1400 * scale)
+    image = np.full((height, width, 3), 235, np.uint8)
+    for index, line in enumerate(lines):
+        origin = (int(60 * scale), int((90 + index * 115) * scale))
+        cv2.putText(image, line, origin, cv2.FONT_HERSHEY_SIMPLEX,
+                    1.1 * scale, (30, 30, 30), max(1, int(2 * scale)), cv2.LINE_AA)
+    noise = rng.normal(0, 12, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def ocr_accuracy(processed_image):
+    """Similarity of the OCR output to the rendered text, or None without Tesseract"""
+    try:
+        text = ocr_stage(processed_image)
+    except pytesseract.TesseractNotFoundError:
+        return None
+    expected = " ".join(SAMPLE_LINES).lower()
+    found = re.sub(r'\s+', ' ', text).strip().lower()
+    return difflib.SequenceMatcher(None, found, expected).ratio()
+
+
+def bench_normalization(args):
+    """Preprocessing latency and OCR accuracy with and without normalization"""
+    modes = [('original', None), ('normalized', DEFAULT_NORMALIZATION)]
+    print(f"{'input MP':>9} {'mode':>11} {'latency s':>10} {'output MP':>10} {'accuracy':>9}")
+    for scale in args.scales:
+        image = render_prescription(scale)
+        input_mp = image.shape[0] * image.shape[1] / 1e6
+        for label, settings in modes:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                processed = enhance_image(image, args.denoise, args.contrast, normalization=settings)
+                timings.append(time.perf_counter() - start)
+            output_mp = processed.shape[0] * processed.shape[1] / 1e6
+            accuracy = ocr_accuracy(processed)
+            accuracy = 'n/a' if accuracy is None else f"{accuracy:.3f}"
+            print(f"{input_mp:9.1f} {label:>11} {min(timings):10.3f} {output_mp:10.1f} {accuracy:>9}")
+
+
+def bench_ocr_backends(args):
+    """Per-call OCR latency of the warm in-process engine vs a tesseract subprocess"""
+    processed = enhance_image(render_prescription(1), args.denoise, args.contrast)
+    backends = [PytesseractBackend()]
+    if tesserocr is not None:
+        backends.append(TesserocrBackend())
+
+    print(f"{'backend':>12} {'first call s':>13} {'mean s':>8} {'calls/s':>8}")
+    for backend in backends:
+        try:
+            start = time.perf_counter()
+            backend.image_to_string(processed)
+            first = time.perf_counter() - start
+        except (pytesseract.TesseractNotFoundError, RuntimeError) as e:
+            print(f"{backend.name:>12} unavailable: {e}")
+            continue
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            backend.image_to_string(processed)
+        mean = (time.perf_counter() - start) / args.calls
+        print(f"{backend.name:>12} {first:13.3f} {mean:8.3f} {1 / mean:8.1f}")
+
+
+def _recompressed(image, scale, quality):
+    height, width = image.shape[:2]
+    small = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    return cv2.imdecode(cv2.imencode('.jpg', small, [cv2.IMWRITE_JPEG_QUALITY, quality])[1], cv2.IMREAD_COLOR)
+
+
+def bench_ocr_cache(args):
+    """Check that the OCR cache serves an owner's copies of a prescription and nothing else"""
+    original = render_prescription(1)
+    settings = settings_key(15, 2.0)
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for max_distance in (0, args.max_distance):
+            cache = OcrResultCache(os.path.join(tmp, f"ocr_cache_{max_distance}.db"), max_distance=max_distance)
+            cache.store('alice', image_digest(original), original, settings, "original")
+            checks = [
+                ("same image", 'alice', original, "original"),
+                ("same image, other user", 'bob', original, None),
+                ("resized JPEG copy", 'alice', _recompressed(original, 0.5, 60),
+                 "original" if max_distance else None),
+                ("other patient, same letterhead", 'alice', render_prescription(1, 1, OTHER_PATIENT_LINES), None),
+                ("other doses, same letterhead", 'alice', render_prescription(1, 2, OTHER_DOSES_LINES), None),
+            ]
+            print(f"max_distance {max_distance}:")
+            for label, owner, image, expected in checks:
+                found = cache.lookup(owner, image_digest(image), image, settings)
+                distance = hamming_distance(perceptual_hash(original), perceptual_hash(image))
+                ink = ink_difference(ink_mask(original), ink_mask(image))
+                ok = found == expected
+                failures += not ok
+                print(f"  {'ok' if ok else 'FAIL'}  {label}: pHash distance {distance}, "
+                      f"ink difference {ink:.3f}, got {found!r}")
+    if failures:
+        sys.exit(1)
+
+
+def _seed_database(path, journal_mode, users=1000):
+    conn = sqlite3.connect(path)
+    conn.execute(f'PRAGMA journal_mode={journal_mode}')
+    conn.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT UNIQUE, last_login TIMESTAMP)')
+    conn.execute('''
+        CREATE TABLE mr_visits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, mr_id INTEGER, doctor_id INTEGER,
+            visit_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, visit_purpose TEXT
+        )
+    ''')
+    conn.executemany('INSERT INTO users (id, username) VALUES (?, ?)',
+                     [(i, f"user{i}") for i in range(users)])
+    conn.commit()
+    conn.close()
+
+
+def _db_operation(conn, rng):
+    # Mostly logins and profile reads, with the occasional visit being recorded
+    if rng.random() < 0.2:
+        conn.execute('INSERT INTO mr_visits (mr_id, doctor_id, visit_purpose) VALUES (?, ?, ?)',
+                     (rng.randrange(50), rng.randrange(1000), "Product detailing"))
+        conn.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?', (rng.randrange(1000),))
+        conn.commit()
+    else:
+        conn.execute('SELECT id, last_login FROM users WHERE username = ?',
+                     (f"user{rng.randrange(1000)}",)).fetchone()
+        conn.execute('SELECT COUNT(*) FROM mr_visits WHERE mr_id = ?', (rng.randrange(50),)).fetchone()
+
+
+def bench_db_concurrency(args):
+    """Throughput of a connection per call vs the shared WAL connection pool"""
+    def per_call(path):
+        def run(rng):
+            # What auth.py used to do for every function call
+            conn = sqlite3.connect(path)
+            try:
+                _db_operation(conn, rng)
+            finally:
+                conn.close()
+        return run
+
+    def pooled(path):
+        pool = ConnectionPool(path)
+        def run(rng):
+            with pool.connection() as conn:
+                _db_operation(conn, rng)
+        return run
+
+    modes = [('per-call', 'DELETE', per_call), ('pool+WAL', 'WAL', pooled)]
+    print(f"{'mode':>9} {'threads':>8} {'ops/s':>9} {'locked errors':>14}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, journal_mode, factory in modes:
+            path = os.path.join(tmp, f"{label}.db")
+            _seed_database(path, journal_mode)
+            run = factory(path)
+            errors = []
+
+            def worker(seed):
+                rng = random.Random(seed)
+                for _ in range(args.operations):
+                    try:
+                        run(rng)
+                    except sqlite3.OperationalError as e:
+                        errors.append(e)
+
+            threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(args.threads)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            completed = args.threads * args.operations - len(errors)
+            print(f"{label:>9} {args.threads:8d} {completed / elapsed:9.0f} {len(errors):14d}")
+
+
+# Ways get_mr_statistics has counted this month's visits: a strftime
+# filter, a range scan over the index, and now a rollup read
+STRFTIME_MONTHLY_VISITS_QUERY = '''
+    SELECT COUNT(*) FROM mr_visits
+    WHERE mr_id = ? AND strftime('%Y-%m', visit_date) = strftime('%Y-%m', 'now')
+'''
+RANGE_MONTHLY_VISITS_QUERY = '''
+    SELECT COUNT(*) FROM mr_visits
+    WHERE mr_id = ?
+    AND visit_date >= date('now', 'start of month')
+    AND visit_date < date('now', 'start of month', '+1 month')
+'''
+ACTIVE_DOCTORS_QUERY = '''
+    SELECT COUNT(*) FROM mr_doctor_assignments WHERE mr_id = ? AND status = 'active'
+'''
+
+# (label, query, parameters, index the plan must use)
+PLAN_CHECKS = [
+    ("current doctors", CURRENT_DOCTORS_QUERY, (7,), 'INTEGER PRIMARY KEY'),
+    ("monthly visits", MONTHLY_VISITS_QUERY, ('7',), 'USING PRIMARY KEY'),
+    ("active doctors count", ACTIVE_DOCTORS_QUERY, (7,), 'idx_mr_assignments_mr_status'),
+    ("monthly visits count", RANGE_MONTHLY_VISITS_QUERY, (7,), 'idx_mr_visits_mr_date'),
+    ("doctor discount codes", 'SELECT code FROM discount_codes WHERE doctor_id = ?', (7,),
+     'idx_discount_codes_doctor'),
+    ("visit history first page", *visit_history_query(7), 'idx_mr_visits_mr_date'),
+    ("visit history later page", *visit_history_query(7, after=('2024-06-01 00:00:00', 10 ** 9)),
+     'idx_mr_visits_mr_date'),
+    ("visit history by doctor", *visit_history_query(7, doctor_id=11, start_date='2024-01-01'),
+     'idx_mr_visits_mr_doctor_date'),
+    ("doctor search by username", USERNAME_SEARCH_QUERY, ('sm', 'sm\U0010ffff', 7, 20),
+     'idx_users_doctor_username'),
+    ("doctor search by name", FULL_NAME_SEARCH_QUERY, ('sm', 'sm\U0010ffff', 7, 20),
+     'idx_users_doctor_full_name'),
+    ("doctor search assignment check", USERNAME_SEARCH_QUERY, ('sm', 'sm\U0010ffff', 7, 20),
+     'idx_mr_assignments_mr_doctor'),
+    ("visit report", *visit_report_query('2024-05'), 'idx_medical_representatives_report'),
+    ("visit report by territory", *visit_report_query('2024-05', 'North'), 'idx_medical_representatives_report'),
+    ("visit report by company", *visit_report_query('2024-05', company='Acme'),
+     'idx_medical_representatives_report_company'),
+    ("visit report by both", *visit_report_query('2024-05', 'North', 'Acme'), 'idx_mr_visits_mr_date'),
+]
+
+# (label, query, parameters, pattern) for queries that sort a small result
+# on purpose; the outer loop must match the pattern instead of walking a table
+SORTED_PLAN_CHECKS = [
+    # Either assignment index on mr_id bounds the sort to one MR's doctors
+    ("assigned doctors, nothing typed", ASSIGNED_DOCTORS_QUERY, (7, 20),
+     r'^SEARCH a USING (COVERING )?INDEX idx_mr_assignments_\w+ \(mr_id=\?'),
+]
+
+# What keyset pagination replaces: skipping rows with OFFSET
+OFFSET_VISIT_HISTORY_QUERY = '''
+    SELECT id, visit_date FROM mr_visits WHERE mr_id = ?
+    ORDER BY visit_date DESC, id DESC LIMIT 50 OFFSET ?
+'''
+
+
+def _seed_visits(conn, visits, mrs=500):
+    rng = random.Random(0)
+    conn.executemany(
+        '''INSERT INTO mr_visits (mr_id, doctor_id, visit_date)
+           VALUES (?, ?, datetime('now', 'start of month', ? || ' seconds'))''',
+        # Spread over roughly the last year and this month
+        ((rng.randrange(mrs), rng.randrange(5000), -rng.randrange(365 * 86400) + 20 * 86400)
+         for _ in range(visits))
+    )
+    conn.executemany(
+        'INSERT INTO mr_doctor_assignments (mr_id, doctor_id, status) VALUES (?, ?, ?)',
+        ((rng.randrange(mrs), rng.randrange(5000), rng.choice(['active', 'inactive']))
+         for _ in range(visits // 10))
+    )
+    rollups.rebuild(conn.cursor())
+    conn.commit()
+
+
+def _timed_query(conn, query, params, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        conn.execute(query, params).fetchall()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_query_plans(args):
+    """Check that the dashboard queries use their indexes and time them"""
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        pool = ConnectionPool(os.path.join(tmp, 'app.db'))
+        migrate(pool)
+        with pool.connection() as conn:
+            _seed_visits(conn, args.visits)
+            conn.execute('ANALYZE')
+            for label, query, params, index in PLAN_CHECKS:
+                plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params)]
+                # Pages and counts must come straight off the index, never a sort
+                used = any(index in detail for detail in plan) and not any('TEMP B-TREE' in detail for detail in plan)
+                failures += not used
+                print(f"{'ok' if used else 'FAIL':>4} {label}: {'; '.join(plan)}")
+            for label, query, params, pattern in SORTED_PLAN_CHECKS:
+                plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params)]
+                used = re.search(pattern, plan[0]) is not None
+                failures += not used
+                print(f"{'ok' if used else 'FAIL':>4} {label}: {'; '.join(plan)}")
+
+            strftime_filter = _timed_query(conn, STRFTIME_MONTHLY_VISITS_QUERY, (7,))
+            range_scan = _timed_query(conn, RANGE_MONTHLY_VISITS_QUERY, (7,))
+            rollup = _timed_query(conn, MONTHLY_VISITS_QUERY, ('7',))
+            print(f"monthly visits over {args.visits} rows: strftime filter {strftime_filter * 1000:.3f} ms, "
+                  f"range scan {range_scan * 1000:.3f} ms, rollup {rollup * 1000:.3f} ms")
+
+            # One MR with a long history; its deepest page reached by OFFSET and by keyset
+            mr_id, visits = 1000000, args.visits // 2
+            conn.executemany(
+                "INSERT INTO mr_visits (mr_id, doctor_id, visit_date) VALUES (?, ?, datetime('now', ? || ' minutes'))",
+                ((mr_id, i % 300, -i) for i in range(visits))
+            )
+            conn.commit()
+            offset = max(visits - 50, 0)
+            cursor = conn.execute(
+                'SELECT visit_date, id FROM mr_visits WHERE mr_id = ? '
+                'ORDER BY visit_date DESC, id DESC LIMIT 1 OFFSET ?', (mr_id, max(offset - 1, 0))
+            ).fetchone()
+            first_page = _timed_query(conn, *visit_history_query(mr_id))
+            offset_page = _timed_query(conn, OFFSET_VISIT_HISTORY_QUERY, (mr_id, offset))
+            keyset_page = _timed_query(conn, *visit_history_query(mr_id, after=cursor))
+            print(f"visit history for an MR with {visits} visits: first page {first_page * 1000:.3f} ms, "
+                  f"last page by OFFSET {offset_page * 1000:.3f} ms, by keyset {keyset_page * 1000:.3f} ms")
+    if failures:
+        sys.exit(1)
+
+
+def _redeem(code, attempts):
+    redeemed = sum(validate_discount_code(code)[0] for _ in range(attempts))
+    # Pool workers are terminated rather than exiting, so flush explicitly
+    write_behind = get_write_behind()
+    if write_behind:
+        write_behind.flush()
+    return redeemed
+
+
+def bench_discount_redemption(args):
+    """Redeem one code from many processes at once and check it never exceeds max_uses"""
+    code = "STRESS01"
+    # Workers are spawned, so they pick the setting up from the environment
+    os.environ['WRITE_BEHIND'] = '1' if args.write_behind else '0'
+    attempts = args.max_uses * 3 // args.processes + 1
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # app.db is opened relative to the working directory, here and in the workers
+        os.chdir(tmp)
+        try:
+            init_db()
+            create_discount_code(1, code, max_uses=args.max_uses)
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(args.processes, initializer=os.chdir, initargs=(tmp,)) as pool:
+                # Let every worker finish starting up before the clock starts
+                pool.map(abs, range(args.processes * 4))
+                start = time.perf_counter()
+                redeemed = sum(pool.starmap(_redeem, [(code, attempts)] * args.processes))
+            elapsed = time.perf_counter() - start
+            with sqlite3.connect('app.db') as conn:
+                times_used, reserved_uses = conn.execute(
+                    'SELECT times_used, reserved_uses FROM discount_codes WHERE code = ?', (code,)
+                ).fetchone()
+        finally:
+            os.chdir(cwd)
+
+    total = attempts * args.processes
+    print(f"{total} attempts from {args.processes} processes in {elapsed:.2f} s ({total / elapsed:.0f}/s)")
+    print(f"max_uses {args.max_uses}, successful redemptions {redeemed}, times_used {times_used}, "
+          f"reserved_uses {reserved_uses}")
+    if redeemed != args.max_uses or times_used != args.max_uses or reserved_uses:
+        print("FAIL: redemptions overshot or undershot max_uses")
+        sys.exit(1)
+
+
+def bench_discount_codes(args):
+    """Bulk discount code issuance for many doctors in one transaction"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            init_db()
+            start = time.perf_counter()
+            success, codes = issue_discount_codes(range(args.doctors))
+            elapsed = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    if not success:
+        print(f"FAIL: {codes}")
+        sys.exit(1)
+    unique = len(set(codes.values()))
+    print(f"{args.doctors} codes in {elapsed:.3f} s ({args.doctors / elapsed:.0f}/s), {unique} unique")
+    print("sample:", ", ".join(list(codes.values())[:5]))
+    if unique != args.doctors:
+        sys.exit(1)
+
+
+FIRST_NAMES = ["Asha", "Ben", "Chen", "Divya", "Elena", "Farid", "Grace", "Hiro", "Ines", "Jamal",
+               "Kavya", "Liam", "Maya", "Nikhil", "Olga", "Priya", "Quinn", "Rahul", "Sara", "Tomas"]
+LAST_NAMES = ["Anand", "Brown", "Costa", "Desai", "Evans", "Fischer", "Gupta", "Haddad", "Iyer", "Jones",
+              "Khan", "Lopez", "Mehta", "Nair", "Okafor", "Patel", "Rao", "Smith", "Tanaka", "Walker"]
+
+
+def bench_doctor_search(args):
+    """Doctor picker searches over many doctors, cold and cached, and cache invalidation"""
+    rng = random.Random(0)
+    mr_id = 1
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            init_db()
+            names = [(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)) for _ in range(args.doctors)]
+            with transaction() as conn:
+                # Seeded directly; hashing a password per doctor is not what is measured
+                conn.executemany(
+                    "INSERT INTO users (username, password, email, full_name) VALUES (?, '-', ?, ?)",
+                    ((f"{last.lower()}{i}", f"doctor{i}@example.com", f"{first} {last}")
+                     for i, (first, last) in enumerate(names))
+                )
+                assigned = rng.sample(range(1, args.doctors + 1), args.assigned)
+                conn.executemany(
+                    'INSERT INTO mr_doctor_assignments (mr_id, doctor_id) VALUES (?, ?)',
+                    ((mr_id, doctor_id) for doctor_id in assigned)
+                )
+            assigned = set(assigned)
+
+            directory = DoctorDirectory()
+            prefixes = ["", "s", "sm", "smith1", "pri", "Priya P", "okafor12", "zz"]
+            for label, repeat in (("cold", 1), ("cached", 100)):
+                timings = []
+                for prefix in prefixes:
+                    if label == "cold":
+                        directory.clear()
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        rows = directory.search(mr_id, prefix)
+                    timings.append((time.perf_counter() - start) / repeat)
+                    wrong = [row for row in rows if row[0] not in assigned or not (
+                        row[1].lower().startswith(prefix.lower()) or row[2].lower().startswith(prefix.lower()))]
+                    if wrong:
+                        print(f"FAIL: '{prefix}' returned {wrong[:3]}")
+                        sys.exit(1)
+                print(f"{label:>6}: " + ", ".join(
+                    f"'{prefix}' {timing * 1000:.3f} ms" for prefix, timing in zip(prefixes, timings)))
+
+            # A newly assigned doctor shows up in an already cached search;
+            # assign_doctor invalidates the app's shared directory
+            newcomer = next(i for i in range(1, args.doctors + 1) if i not in assigned)
+            username = f"{names[newcomer - 1][1].lower()}{newcomer - 1}"
+            before = doctor_directory.search(mr_id, username)
+            assign_doctor(mr_id, newcomer)
+            after = doctor_directory.search(mr_id, username)
+        finally:
+            os.chdir(cwd)
+    found = [doctor_label(row) for row in after if row[0] == newcomer]
+    print(f"after assigning {username}: {found or 'not found'} (before: {len(before)} matches)")
+    if not found:
+        sys.exit(1)
+
+
+def bench_bulk_import(args):
+    """Visits recorded one call at a time versus the same visits bulk imported from CSV"""
+    rng = random.Random(0)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            init_db()
+            register_mr("mr1", "Passw0rd!mr", "mr1@example.com", "MR One", "555", "North", "Acme", "Cardio")
+            with transaction() as conn:
+                conn.executemany(
+                    "INSERT INTO users (username, password, email) VALUES (?, '-', ?)",
+                    ((f"doctor{i}", f"doctor{i}@example.com") for i in range(args.doctors))
+                )
+                mr_id = conn.execute('SELECT id FROM medical_representatives').fetchone()[0]
+                doctor_ids = [row[0] for row in conn.execute("SELECT id FROM users WHERE user_type = 'doctor'")]
+                conn.executemany('INSERT INTO mr_doctor_assignments (mr_id, doctor_id) VALUES (?, ?)',
+                                 ((mr_id, doctor_id) for doctor_id in doctor_ids))
+
+            single = min(args.visits, 2000)
+            start = time.perf_counter()
+            for _ in range(single):
+                record_doctor_visit(mr_id, rng.choice(doctor_ids), "Follow-up", None, None, None)
+            per_call = (time.perf_counter() - start) / single
+
+            lines = ["mr_id,doctor_id,visit_date,visit_purpose"]
+            lines += [f"{mr_id},{rng.choice(doctor_ids)},2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d} "
+                      f"{rng.randrange(24):02d}:00:00,Follow-up" for _ in range(args.visits)]
+            # A few bad rows, which must be reported without stopping the import
+            lines += [f"{mr_id},0,2024-01-01,Unknown doctor", f"{mr_id},{doctor_ids[0]},yesterday,Bad date"]
+            data = ("\n".join(lines) + "\n").encode()
+            start = time.perf_counter()
+            result = import_visits(data, 'csv')
+            bulk = time.perf_counter() - start
+
+            with transaction() as conn:
+                c = conn.cursor()
+                before = c.execute('SELECT * FROM mr_visit_rollups ORDER BY 1, 2, 3, 4').fetchall()
+                rollups.rebuild(c)
+                consistent = before == c.execute('SELECT * FROM mr_visit_rollups ORDER BY 1, 2, 3, 4').fetchall()
+        finally:
+            os.chdir(cwd)
+    print(f"record_doctor_visit: {per_call * 1000:.3f} ms per visit ({1 / per_call:.0f}/s)")
+    print(f"import_visits: {result['imported']} visits in {bulk:.3f} s ({result['imported'] / bulk:.0f}/s), "
+          f"{len(result['errors'])} rows rejected: {result['errors']}")
+    print(f"rollups {'match' if consistent else 'DO NOT match'} a rebuild")
+    if not consistent or result['imported'] != args.visits or len(result['errors']) != 2:
+        sys.exit(1)
+
+
+def bench_report_export(args):
+    """Export a month of visits as CSV and Excel and track peak Python memory"""
+    rng = random.Random(0)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            init_db()
+            with transaction() as conn:
+                conn.executemany(
+                    '''INSERT INTO medical_representatives (user_id, full_name, phone, territory, company)
+                       VALUES (0, ?, '-', ?, ?)''',
+                    ((f"MR {i}", f"Territory {i % 20}", f"Company {i % 7}") for i in range(args.mrs))
+                )
+                conn.executemany(
+                    '''INSERT INTO mr_visits (mr_id, doctor_id, visit_date, visit_purpose)
+                       VALUES (?, ?, datetime('2024-05-01', ? || ' seconds'), 'Follow-up')''',
+                    ((rng.randrange(1, args.mrs + 1), rng.randrange(5000), rng.randrange(31 * 86400))
+                     for _ in range(args.visits))
+                )
+            for fmt in ('csv', 'xls'):
+                path = os.path.join(tmp, f"report.{fmt}")
+                tracemalloc.start()
+                start = time.perf_counter()
+                written = export_report(path, 'visits', fmt, '2024-05')
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                with open(path, 'rb') as f:
+                    lines = sum(1 for _ in f)
+                print(f"{fmt}: {args.visits} visits, {written / 1e6:.1f} MB in {elapsed:.2f} s "
+                      f"({args.visits / elapsed:.0f} rows/s), {lines} lines, peak Python memory {peak / 1e6:.2f} MB")
+        finally:
+            os.chdir(cwd)
+
+
+def _all_history(mr_id, **filters):
+    pages, cursor = [], None
+    while True:
+        rows, cursor = get_visit_history(mr_id, cursor, **filters)
+        pages.append(rows)
+        if cursor is None:
+            return pages
+
+
+def bench_archive(args):
+    """Archive a year of visits and check that history, reports and rollups read the same"""
+    rng = random.Random(0)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            init_db()
+            register_mr("mr1", "Passw0rd!mr", "mr1@example.com", "MR One", "555", "North", "Acme", "Cardio")
+            with transaction() as conn:
+                conn.executemany(
+                    "INSERT INTO users (username, password, email) VALUES (?, '-', ?)",
+                    ((f"doctor{i}", f"doctor{i}@example.com") for i in range(100))
+                )
+                mr_id = conn.execute('SELECT id FROM medical_representatives').fetchone()[0]
+                doctor_ids = [row[0] for row in conn.execute("SELECT id FROM users WHERE user_type = 'doctor'")]
+                # Two years of visits, one MR in three being the one whose history is read
+                conn.executemany(
+                    '''INSERT INTO mr_visits (mr_id, doctor_id, visit_date, status)
+                       VALUES (?, ?, datetime('now', ? || ' seconds'), 'completed')''',
+                    ((mr_id if rng.random() < 0.3 else mr_id + 1, rng.choice(doctor_ids),
+                      -rng.randrange(730 * 86400)) for _ in range(args.visits))
+                )
+                c = conn.cursor()
+                rollups.rebuild(c)
+                month = c.execute("SELECT strftime('%Y-%m', 'now', '-18 months')").fetchone()[0]
+                window = c.execute("SELECT date('now', '-15 months'), date('now', '-9 months')").fetchone()
+                hot_before = c.execute('SELECT COUNT(*) FROM mr_visits').fetchone()[0]
+
+            def snapshot():
+                report = BytesIO()
+                export_report(report, 'visits', 'csv', month)
+                start = time.perf_counter()
+                first_page = get_visit_history(mr_id)
+                elapsed = time.perf_counter() - start
+                ranged = _all_history(mr_id, start_date=window[0], end_date=window[1])
+                return _all_history(mr_id), ranged, report.getvalue(), first_page, elapsed
+
+            before = snapshot()
+            start = time.perf_counter()
+            moved = archive_old_visits(12)
+            elapsed = time.perf_counter() - start
+            after = snapshot()
+
+            # A visit logged late for an archived month shows up at once and is moved by the next run
+            import_visits(f"mr_id,doctor_id,visit_date\n{mr_id},{doctor_ids[0]},{month}-15 12:00:00\n".encode(), 'csv')
+            late = BytesIO()
+            export_report(late, 'visits', 'csv', month)
+            rerun = archive_old_visits(12)
+
+            with transaction() as conn:
+                c = conn.cursor()
+                counts = c.execute('SELECT * FROM mr_visit_rollups ORDER BY 1, 2, 3, 4').fetchall()
+                rollups.rebuild(c, [archived for archived, _ in archived_months(c)])
+                rollups_kept = counts == c.execute('SELECT * FROM mr_visit_rollups ORDER BY 1, 2, 3, 4').fetchall()
+                hot_after = c.execute('SELECT COUNT(*) FROM mr_visits').fetchone()[0]
+        finally:
+            os.chdir(cwd)
+
+    checks = {
+        "full history": before[0] == after[0],
+        "date-filtered history": before[1] == after[1],
+        f"{month} report": before[2] == after[2],
+        "first history page": before[3] == after[3],
+        "late visit reported": late.getvalue().count(b'\n') == before[2].count(b'\n') + 1,
+        "rerun moves only the late visit": sum(count for _, count in rerun) == 1,
+        "rollups survive a rebuild": rollups_kept,
+    }
+    print(f"archived {len(moved)} months, {sum(count for _, count in moved)} visits in {elapsed:.2f} s; "
+          f"mr_visits {hot_before} -> {hot_after} rows")
+    print(f"first history page {before[4] * 1000:.2f} ms before, {after[4] * 1000:.2f} ms after; "
+          f"{sum(map(len, after[0]))} visits over {len(after[0])} pages")
+    for label, ok in checks.items():
+        print(f"  {'ok' if ok else 'FAIL'}  {label}")
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+def bench_logins(args):
+    """Login throughput under concurrency, and how a cheap request fares meanwhile"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            init_db()
+            users = [(f"user{i}", f"Passw0rd!{i}") for i in range(args.threads)]
+            for username, password in users:
+                register_user(username, password, f"{username}@example.com")
+            # The first login of each user upgrades its hash; measure the steady state
+            for username, password in users:
+                login_user(username, password)
+
+            latencies = []
+            rejected = []
+            done = threading.Event()
+
+            def login(username, password):
+                for _ in range(args.logins):
+                    start = time.perf_counter()
+                    success, message, _, _ = login_user(username, password)
+                    latencies.append(time.perf_counter() - start)
+                    if not success:
+                        rejected.append(message)
+
+            def cheap_requests(samples):
+                # Stands in for other users' reruns doing quick pure-Python work
+                while not done.is_set():
+                    start = time.perf_counter()
+                    sum(range(20000))
+                    samples.append(time.perf_counter() - start)
+                    time.sleep(0.005)
+
+            samples = []
+            side = threading.Thread(target=cheap_requests, args=(samples,))
+            side.start()
+            threads = [threading.Thread(target=login, args=user) for user in users]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            done.set()
+            side.join()
+        finally:
+            os.chdir(cwd)
+
+    latencies.sort()
+    samples.sort()
+    total = len(latencies)
+    print(f"{total} logins from {args.threads} threads in {elapsed:.2f} s: "
+          f"{(total - len(rejected)) / elapsed:.1f} logins/s, {len(rejected)} rejected as busy")
+    print(f"login latency p50 {latencies[total // 2] * 1000:.0f} ms, "
+          f"p95 {latencies[int(total * 0.95)] * 1000:.0f} ms")
+    if samples:
+        print(f"cheap request latency during the burst p50 {samples[len(samples) // 2] * 1000:.2f} ms, "
+              f"p95 {samples[int(len(samples) * 0.95)] * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prescription app benchmarks")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    normalization = subparsers.add_parser('normalization', help=bench_normalization.__doc__)
+    normalization.add_argument('--scales', type=float, nargs='+', default=[1, 2, 3],
+                               help="Text scale factors to render (1 is roughly 1.5 MP)")
+    normalization.add_argument('--repeat', type=int, default=1)
+    normalization.add_argument('--denoise', type=int, default=15)
+    normalization.add_argument('--contrast', type=float, default=2.0)
+    normalization.set_defaults(func=bench_normalization)
+
+    backends = subparsers.add_parser('ocr-backends', help=bench_ocr_backends.__doc__)
+    backends.add_argument('--calls', type=int, default=20)
+    backends.add_argument('--denoise', type=int, default=15)
+    backends.add_argument('--contrast', type=float, default=2.0)
+    backends.set_defaults(func=bench_ocr_backends)
+
+    cache = subparsers.add_parser('ocr-cache', help=bench_ocr_cache.__doc__)
+    cache.add_argument('--max-distance', type=int, default=7,
+                       help="pHash distance for the near-duplicate run")
+    cache.set_defaults(func=bench_ocr_cache)
+
+    database = subparsers.add_parser('db-concurrency', help=bench_db_concurrency.__doc__)
+    database.add_argument('--threads', type=int, default=8)
+    database.add_argument('--operations', type=int, default=500,
+                          help="Operations per thread, 20%% of them writes")
+    database.set_defaults(func=bench_db_concurrency)
+
+    plans = subparsers.add_parser('query-plans', help=bench_query_plans.__doc__)
+    plans.add_argument('--visits', type=int, default=200000)
+    plans.set_defaults(func=bench_query_plans)
+
+    redemption = subparsers.add_parser('discount-redemption', help=bench_discount_redemption.__doc__)
+    redemption.add_argument('--processes', type=int, default=8)
+    redemption.add_argument('--max-uses', type=int, default=100)
+    redemption.add_argument('--write-behind', action='store_true',
+                            help="Redeem through the write-behind buffer's leases")
+    redemption.set_defaults(func=bench_discount_redemption)
+
+    issuance = subparsers.add_parser('discount-codes', help=bench_discount_codes.__doc__)
+    issuance.add_argument('--doctors', type=int, default=10000)
+    issuance.set_defaults(func=bench_discount_codes)
+
+    doctors = subparsers.add_parser('doctor-search', help=bench_doctor_search.__doc__)
+    doctors.add_argument('--doctors', type=int, default=50000)
+    doctors.add_argument('--assigned', type=int, default=2000, help="Doctors assigned to the MR")
+    doctors.set_defaults(func=bench_doctor_search)
+
+    bulk = subparsers.add_parser('bulk-import', help=bench_bulk_import.__doc__)
+    bulk.add_argument('--visits', type=int, default=50000)
+    bulk.add_argument('--doctors', type=int, default=500)
+    bulk.set_defaults(func=bench_bulk_import)
+
+    report = subparsers.add_parser('report-export', help=bench_report_export.__doc__)
+    report.add_argument('--visits', type=int, default=500000)
+    report.add_argument('--mrs', type=int, default=300)
+    report.set_defaults(func=bench_report_export)
+
+    archiving = subparsers.add_parser('archive', help=bench_archive.__doc__)
+    archiving.add_argument('--visits', type=int, default=200000)
+    archiving.set_defaults(func=bench_archive)
+
+    logins = subparsers.add_parser('logins', help=bench_logins.__doc__)
+    logins.add_argument('--threads', type=int, default=32)
+    logins.add_argument('--logins', type=int, default=5, help="Logins per thread")
+    logins.set_defaults(func=bench_logins)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
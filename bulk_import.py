@@ -0,0 +1,341 @@
+"""
+Bulk import of MR visits and doctor assignments from CSV or JSON Lines.
+
+Input is streamed and handled ``chunk_size`` rows at a time. Each row is
+validated on its own, and a row that fails is reported with its line
+number and skipped, never the whole file. A file that stops being
+readable part way, not UTF-8 or not valid CSV, keeps what came before and
+reports one error where reading stopped. The rows that pass are loaded
+into a temporary table, and one write transaction per chunk applies them
+with set-based statements:
+
+- references to unknown MRs or doctors are rejected
+- the rows are inserted
+- the visit rollups, last_visit_date and current_doctors are updated
+
+A chunk costs a handful of statements however many rows it holds, instead
+of a transaction per visit.
+
+    python bulk_import.py visits visits.csv
+    python bulk_import.py assignments assignments.jsonl
+
+Visit columns: mr_id, doctor_id, visit_date, and optionally visit_purpose,
+discussion_points, feedback, next_visit_date and status (default
+'completed'). visit_date is taken as UTC, like CURRENT_TIMESTAMP.
+Assignment columns: mr_id, doctor_id, and optionally status ('active' or
+'inactive', default 'active') and notes. Importing an assignment that
+already exists updates it, so re-importing a file is harmless.
+"""
+import argparse
+import csv
+import io
+import json
+import sqlite3
+from datetime import datetime, timezone
+from itertools import islice
+
+import rollups
+from auth import init_db
+from db import transaction
+from doctor_directory import doctor_directory
+
+CHUNK_SIZE = 1000
+ASSIGNMENT_STATUSES = ('active', 'inactive')
+
+
+def _open(source):
+    if isinstance(source, str):
+        return open(source, newline='', encoding='utf-8-sig')
+    if isinstance(source, (bytes, bytearray)):
+        return io.StringIO(source.decode('utf-8-sig'), newline='')
+    return source
+
+
+def _format_of(source, fmt):
+    if fmt:
+        return fmt
+    name = source if isinstance(source, str) else getattr(source, 'name', '')
+    return 'jsonl' if str(name).lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def _records(stream, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row, None
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, None, f"Invalid JSON: {e}"
+                continue
+            if isinstance(row, dict):
+                yield line_number, row, None
+            else:
+                yield line_number, None, "Expected a JSON object"
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+
+
+def read_rows(source, fmt=None):
+    """
+    Yield (line_number, row_dict, error) for each record in a CSV or JSON Lines
+    source. A file that is not UTF-8 or not valid CSV can't be read past the
+    problem, so that ends with one error for the line after the last record.
+    """
+    fmt = _format_of(source, fmt)
+    stream = None
+    line_number = 0
+    try:
+        stream = _open(source)
+        for line_number, row, error in _records(stream, fmt):
+            yield line_number, row, error
+    except UnicodeDecodeError as e:
+        yield line_number + 1, None, f"File is not UTF-8 text, nothing read from here on: {e}"
+    except csv.Error as e:
+        yield line_number + 1, None, f"File is not valid CSV, nothing read from here on: {e}"
+    finally:
+        if stream is not None and stream is not source:
+            stream.close()
+
+
+def _text(row, field):
+    value = row.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _integer(row, field):
+    value = _text(row, field)
+    if value is None:
+        raise ValueError(f"{field} is required")
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{field} must be a whole number, got '{value}'")
+
+
+def _timestamp(row, field):
+    value = _text(row, field)
+    if value is None:
+        raise ValueError(f"{field} is required")
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{field} must be a date or date and time, got '{value}'")
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    # The format CURRENT_TIMESTAMP writes, so imported and recorded visits sort together
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _date(row, field):
+    value = _text(row, field)
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value).date().isoformat()
+    except ValueError:
+        raise ValueError(f"{field} must be a date, got '{value}'")
+
+
+def _mr_id(row, mr_id):
+    if mr_id is None:
+        return _integer(row, 'mr_id')
+    if _text(row, 'mr_id') is not None and _integer(row, 'mr_id') != mr_id:
+        raise ValueError("mr_id does not match the importing MR")
+    return mr_id
+
+
+def _visit(row, mr_id=None):
+    return (
+        _mr_id(row, mr_id),
+        _integer(row, 'doctor_id'),
+        _timestamp(row, 'visit_date'),
+        _text(row, 'visit_purpose'),
+        _text(row, 'discussion_points'),
+        _text(row, 'feedback'),
+        _date(row, 'next_visit_date'),
+        _text(row, 'status') or 'completed',
+    )
+
+
+def _assignment(row, mr_id=None):
+    status = (_text(row, 'status') or 'active').lower()
+    if status not in ASSIGNMENT_STATUSES:
+        raise ValueError(f"status must be one of {', '.join(ASSIGNMENT_STATUSES)}, got '{status}'")
+    return _mr_id(row, mr_id), _integer(row, 'doctor_id'), status, _text(row, 'notes')
+
+
+def _reject_unknown_references(c, table):
+    """Drop staged rows naming an unknown MR or doctor and return their errors"""
+    c.execute(f'''
+        SELECT t.line, mr.id IS NULL, u.id IS NULL
+        FROM {table} t
+        LEFT JOIN medical_representatives mr ON mr.id = t.mr_id
+        LEFT JOIN users u ON u.id = t.doctor_id AND u.user_type = 'doctor'
+        WHERE mr.id IS NULL OR u.id IS NULL
+    ''')
+    errors = []
+    for line, unknown_mr, unknown_doctor in c.fetchall():
+        problems = (["unknown mr_id"] if unknown_mr else []) + (["unknown doctor_id"] if unknown_doctor else [])
+        errors.append((line, ", ".join(problems)))
+    if errors:
+        c.executemany(f'DELETE FROM {table} WHERE line = ?', [(line,) for line, _ in errors])
+    return errors
+
+
+def _load_visits(c, rows):
+    c.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS visit_import (
+            line INTEGER PRIMARY KEY, mr_id INTEGER, doctor_id INTEGER, visit_date TEXT,
+            visit_purpose TEXT, discussion_points TEXT, feedback TEXT,
+            next_visit_date TEXT, status TEXT
+        )
+    ''')
+    c.execute('DELETE FROM temp.visit_import')
+    c.executemany('INSERT INTO temp.visit_import VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    errors = _reject_unknown_references(c, 'temp.visit_import')
+
+    c.execute('''
+        INSERT INTO mr_visits
+        (mr_id, doctor_id, visit_date, visit_purpose, discussion_points, feedback, next_visit_date, status)
+        SELECT mr_id, doctor_id, visit_date, visit_purpose, discussion_points, feedback,
+               next_visit_date, status
+        FROM temp.visit_import
+        ORDER BY line
+    ''')
+    imported = c.rowcount
+    rollups.add_visits_from(c, 'temp.visit_import')
+    # Offline logs arrive late, so only ever move last_visit_date forward
+    c.execute('''
+        UPDATE mr_doctor_assignments
+        SET last_visit_date = latest.visit_date
+        FROM (
+            SELECT mr_id, doctor_id, MAX(visit_date) AS visit_date
+            FROM temp.visit_import
+            GROUP BY mr_id, doctor_id
+        ) AS latest
+        WHERE mr_doctor_assignments.mr_id = latest.mr_id
+        AND mr_doctor_assignments.doctor_id = latest.doctor_id
+        AND (mr_doctor_assignments.last_visit_date IS NULL
+             OR mr_doctor_assignments.last_visit_date < latest.visit_date)
+    ''')
+    return imported, errors, set()
+
+
+def _load_assignments(c, rows):
+    c.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS assignment_import (
+            line INTEGER PRIMARY KEY, mr_id INTEGER, doctor_id INTEGER, status TEXT, notes TEXT
+        )
+    ''')
+    c.execute('DELETE FROM temp.assignment_import')
+    c.executemany('INSERT INTO temp.assignment_import VALUES (?, ?, ?, ?, ?)', rows)
+    errors = _reject_unknown_references(c, 'temp.assignment_import')
+    # The last row for a pair wins
+    c.execute('''
+        DELETE FROM temp.assignment_import
+        WHERE line NOT IN (SELECT MAX(line) FROM temp.assignment_import GROUP BY mr_id, doctor_id)
+    ''')
+
+    c.execute('''
+        UPDATE mr_doctor_assignments
+        SET status = t.status, notes = COALESCE(t.notes, mr_doctor_assignments.notes)
+        FROM temp.assignment_import t
+        WHERE mr_doctor_assignments.mr_id = t.mr_id AND mr_doctor_assignments.doctor_id = t.doctor_id
+    ''')
+    c.execute('''
+        INSERT INTO mr_doctor_assignments (mr_id, doctor_id, status, notes)
+        SELECT t.mr_id, t.doctor_id, t.status, t.notes
+        FROM temp.assignment_import t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM mr_doctor_assignments a
+            WHERE a.mr_id = t.mr_id AND a.doctor_id = t.doctor_id
+        )
+        ORDER BY t.line
+    ''')
+    c.execute('SELECT COUNT(*) FROM temp.assignment_import')
+    imported = c.fetchone()[0]
+    # Recount rather than adjust, since updated rows may or may not have been active
+    c.execute('''
+        UPDATE medical_representatives
+        SET current_doctors = (
+            SELECT COUNT(*) FROM mr_doctor_assignments a
+            WHERE a.mr_id = medical_representatives.id AND a.status = 'active'
+        )
+        WHERE id IN (SELECT mr_id FROM temp.assignment_import)
+    ''')
+    c.execute('SELECT DISTINCT mr_id FROM temp.assignment_import')
+    return imported, errors, {row[0] for row in c.fetchall()}
+
+
+def _import(records, parse, load, chunk_size):
+    result = {'imported': 0, 'errors': []}
+    changed_mrs = set()
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        rows = []
+        for line, record, error in chunk:
+            if error is None:
+                try:
+                    rows.append((line,) + parse(record))
+                except ValueError as e:
+                    error = str(e)
+            if error:
+                result['errors'].append((line, error))
+        if not rows:
+            continue
+        try:
+            with transaction(immediate=True) as conn:
+                imported, errors, mrs = load(conn.cursor(), rows)
+        except sqlite3.Error as e:
+            imported, errors, mrs = 0, [(row[0], f"Not imported: {e}") for row in rows], set()
+        result['imported'] += imported
+        result['errors'].extend(errors)
+        changed_mrs |= mrs
+    for mr_id in changed_mrs:
+        doctor_directory.invalidate(mr_id)
+    result['errors'].sort()
+    return result
+
+
+def import_visits(source, fmt=None, mr_id=None, chunk_size=CHUNK_SIZE):
+    """
+    Import visits from a path, bytes or text stream in CSV or JSON Lines.
+    With ``mr_id``, every row is for that MR and the mr_id column is optional.
+    Returns {'imported': count, 'errors': [(line_number, message), ...]}.
+    """
+    return _import(read_rows(source, fmt), lambda row: _visit(row, mr_id), _load_visits, chunk_size)
+
+
+def import_assignments(source, fmt=None, mr_id=None, chunk_size=CHUNK_SIZE):
+    """Import doctor assignments; same arguments and result as import_visits"""
+    return _import(read_rows(source, fmt), lambda row: _assignment(row, mr_id), _load_assignments, chunk_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import MR visits or doctor assignments")
+    parser.add_argument('kind', choices=['visits', 'assignments'])
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help="Default: from the file extension")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    init_db()
+    importer = import_visits if args.kind == 'visits' else import_assignments
+    result = importer(args.path, args.format, chunk_size=args.chunk_size)
+    print(f"Imported {result['imported']} {args.kind}, {len(result['errors'])} rows rejected")
+    for line, message in result['errors']:
+        print(f"  line {line}: {message}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Collision-free discount code allocation.
+
+Each allocator keeps a counter in app.db and turns counter values into
+codes with a keyed permutation (a Feistel network over the code space,
+with cycle walking to stay inside it). Distinct counter values always give
+distinct codes, so there is nothing to retry, yet consecutive codes look
+unrelated and cannot be guessed from one another. Counter values are
+reserved in blocks with a single UPDATE, so issuing thousands of codes
+costs one round trip plus the INSERTs.
+
+The permutation key, alphabet and length are stored with the counter the
+first time an allocator is used and must not change afterwards; a
+different alphabet or length needs a new allocator name.
+"""
+import hashlib
+import hmac
+import math
+import os
+
+# No 0/O, 1/I/L, so codes survive being read out or copied by hand
+DEFAULT_ALPHABET = "23456789ABCDEFGHJKMNPQRSTUVWXYZ"
+DEFAULT_LENGTH = 8
+DEFAULT_PREFIX = "DR"
+
+FEISTEL_ROUNDS = 8
+
+
+class CodeAllocator:
+    """Hands out unique codes of ``prefix`` + ``length`` characters from ``alphabet``"""
+
+    def __init__(self, name='discount', prefix=DEFAULT_PREFIX, alphabet=DEFAULT_ALPHABET,
+                 length=DEFAULT_LENGTH):
+        if len(set(alphabet)) != len(alphabet) or len(alphabet) < 2:
+            raise ValueError("alphabet needs at least two distinct characters")
+        self.name = name
+        self.prefix = prefix
+        self.alphabet = alphabet
+        self.length = length
+        self.space = len(alphabet) ** length
+        # Feistel halves; side * side >= space, and cycle walking covers the gap
+        self.side = math.isqrt(self.space - 1) + 1
+
+    def reserve(self, c, count=1):
+        """
+        Allocate ``count`` codes using cursor ``c``, inside the caller's
+        transaction so the codes and whatever uses them commit together.
+        """
+        c.execute('''
+            INSERT OR IGNORE INTO code_allocators (name, permutation_key, alphabet, length)
+            VALUES (?, ?, ?, ?)
+        ''', (self.name, os.urandom(32), self.alphabet, self.length))
+        c.execute('''
+            UPDATE code_allocators SET next_value = next_value + ?
+            WHERE name = ?
+            RETURNING permutation_key, alphabet, length, next_value
+        ''', (count, self.name))
+        key, alphabet, length, end = c.fetchone()
+        if (alphabet, length) != (self.alphabet, self.length):
+            raise ValueError(f"Allocator '{self.name}' was created with a different alphabet or length")
+        if end > self.space:
+            raise ValueError(f"Allocator '{self.name}' has run out of codes")
+        return [self.encode(self.permute(value, key)) for value in range(end - count, end)]
+
+    def permute(self, value, key):
+        """Keyed bijection on [0, space)"""
+        while True:
+            left, right = divmod(value, self.side)
+            for round_number in range(FEISTEL_ROUNDS):
+                left, right = right, (left + self._round(key, round_number, right)) % self.side
+            value = left * self.side + right
+            # Walk the cycle until we land back inside the code space
+            if value < self.space:
+                return value
+
+    def _round(self, key, round_number, half):
+        digest = hmac.new(key, f"{round_number}:{half}".encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], 'big') % self.side
+
+    def encode(self, value):
+        base = len(self.alphabet)
+        chars = []
+        for _ in range(self.length):
+            value, digit = divmod(value, base)
+            chars.append(self.alphabet[digit])
+        return self.prefix + "".join(reversed(chars))
+
+
+# Doctor discount codes: "DR" + 8 characters, which cannot clash with the
+# older "DR" + 5 digit codes
+discount_codes = CodeAllocator()
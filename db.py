@@ -0,0 +1,136 @@
+"""
+Shared SQLite connection layer for app.db.
+
+Connections are opened once and reused from a small pool instead of being
+connected and closed on every call. Each one is set up for concurrent use:
+WAL journaling lets readers run alongside a writer, a busy timeout makes
+writers wait for the lock instead of failing with "database is locked",
+and the page cache, memory map and statement cache are sized for an app
+that keeps repeating the same handful of queries.
+"""
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_PATH = 'app.db'
+POOL_SIZE = 8
+
+# Seconds a connection waits for a lock before raising "database is locked"
+BUSY_TIMEOUT = 10
+CACHED_STATEMENTS = 256
+# Page cache per connection in KiB (negative values are KiB for PRAGMA cache_size)
+CACHE_SIZE_KIB = 16 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def connect(path=DB_PATH):
+    """Open a connection with the app's pragmas applied"""
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT,
+        cached_statements=CACHED_STATEMENTS,
+        # Pooled connections move between Streamlit script threads
+        check_same_thread=False
+    )
+    conn.execute('PRAGMA journal_mode=WAL')
+    # Durable across application crashes; WAL makes NORMAL safe against corruption
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KIB}')
+    conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+
+class ConnectionPool:
+    """Fixed-size pool of configured connections to one database"""
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        # Most recently used first, so a quiet app keeps reusing one warm connection
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=BUSY_TIMEOUT):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return connect(self.path)
+                except Exception:
+                    self._created -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a database connection")
+
+    def release(self, conn):
+        # Never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        """Close the idle connections, e.g. before replacing the database file"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """
+        Connection whose work is committed when the block finishes and rolled
+        back if it raises. ``immediate`` takes the write lock up front, for
+        read-then-write blocks that must not interleave with other writers.
+        """
+        with self.connection() as conn:
+            if immediate:
+                conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+
+def get_pool():
+    """Process-wide pool for app.db"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+def connection():
+    """Borrow a pooled app.db connection for the duration of a ``with`` block"""
+    return get_pool().connection()
+
+
+def transaction(immediate=False):
+    """Run a ``with`` block as one app.db transaction on a pooled connection"""
+    return get_pool().transaction(immediate=immediate)
@@ -0,0 +1,132 @@
+"""
+Doctor lookup for the MR dashboard's doctor picker.
+
+Searches an MR's active doctors by username or full name prefix. A search
+is an index range read over users (idx_users_doctor_username or
+idx_users_doctor_full_name), with each candidate checked against
+idx_mr_assignments_mr_doctor, so it stays fast with tens of thousands of
+doctors and never sorts.
+
+Results are cached per MR and search text. assign_doctor and
+update_assignment_status drop an MR's entries as soon as its assignments
+change in this process; entries also expire after ``CACHE_TTL`` seconds so
+changes made by other processes show up.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from db import connection
+
+CACHE_TTL = 60
+MAX_CACHE_ENTRIES = 5000
+DEFAULT_LIMIT = 20
+
+# Sorts after every string that starts with the prefix
+_PREFIX_END = '\U0010ffff'
+
+# Prefix searches, kept here so benchmarks.py can check their query plans
+USERNAME_SEARCH_QUERY = '''
+    SELECT u.id, u.username, u.full_name
+    FROM users u
+    WHERE u.user_type = 'doctor'
+    AND u.username >= ? COLLATE NOCASE AND u.username < ? COLLATE NOCASE
+    AND EXISTS (
+        SELECT 1 FROM mr_doctor_assignments a
+        WHERE a.mr_id = ? AND a.doctor_id = u.id AND a.status = 'active'
+    )
+    ORDER BY u.username COLLATE NOCASE
+    LIMIT ?
+'''
+
+FULL_NAME_SEARCH_QUERY = '''
+    SELECT u.id, u.username, u.full_name
+    FROM users u
+    WHERE u.user_type = 'doctor'
+    AND u.full_name >= ? COLLATE NOCASE AND u.full_name < ? COLLATE NOCASE
+    AND EXISTS (
+        SELECT 1 FROM mr_doctor_assignments a
+        WHERE a.mr_id = ? AND a.doctor_id = u.id AND a.status = 'active'
+    )
+    ORDER BY u.full_name COLLATE NOCASE
+    LIMIT ?
+'''
+
+# With nothing typed yet, start from the MR's own assignments instead of
+# walking every doctor
+ASSIGNED_DOCTORS_QUERY = '''
+    SELECT DISTINCT u.id, u.username, u.full_name
+    FROM mr_doctor_assignments a
+    -- CROSS JOIN keeps the assignments as the outer loop; sorting those few rows is cheap
+    CROSS JOIN users u ON u.id = a.doctor_id
+    WHERE a.mr_id = ? AND a.status = 'active' AND u.user_type = 'doctor'
+    ORDER BY u.username COLLATE NOCASE
+    LIMIT ?
+'''
+
+
+def doctor_label(doctor):
+    """Display text for a (doctor_id, username, full_name) row"""
+    _, username, full_name = doctor
+    return f"{full_name} ({username})" if full_name else username
+
+
+class DoctorDirectory:
+    """Cached prefix search over each MR's active doctors"""
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=MAX_CACHE_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # (mr_id, text, limit) -> (expires_at, rows), least recently used first
+        self._entries = OrderedDict()
+        # Bumped on invalidation, so a search that raced with it is not cached
+        self._generations = {}
+
+    def search(self, mr_id, text, limit=DEFAULT_LIMIT):
+        """Up to ``limit`` (doctor_id, username, full_name) rows whose username or name starts with ``text``"""
+        text = text.strip()
+        key = (mr_id, text, limit)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+            generation = self._generations.get(mr_id, 0)
+
+        rows = self._query(mr_id, text, limit)
+
+        with self._lock:
+            if self._generations.get(mr_id, 0) == generation:
+                self._entries[key] = (now + self.ttl, rows)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return rows
+
+    def _query(self, mr_id, text, limit):
+        with connection() as conn:
+            if not text:
+                return conn.execute(ASSIGNED_DOCTORS_QUERY, (mr_id, limit)).fetchall()
+            bounds = (text, text + _PREFIX_END, mr_id, limit)
+            by_username = conn.execute(USERNAME_SEARCH_QUERY, bounds).fetchall()
+            by_name = conn.execute(FULL_NAME_SEARCH_QUERY, bounds).fetchall()
+        # A doctor can match on both username and name
+        merged = {row[0]: row for row in by_username + by_name}
+        return sorted(merged.values(), key=lambda row: doctor_label(row).lower())[:limit]
+
+    def invalidate(self, mr_id):
+        """Forget every cached search for ``mr_id``"""
+        with self._lock:
+            self._generations[mr_id] = self._generations.get(mr_id, 0) + 1
+            for key in [key for key in self._entries if key[0] == mr_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+
+doctor_directory = DoctorDirectory()
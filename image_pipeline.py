@@ -0,0 +1,235 @@
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+import cv2
+import numpy as np
+
+# Upper bound on memory held by cached preprocessing stages
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+
+# Resampling applied before the expensive filters.
+# target_text_height: median glyph height (px) Tesseract reads best at
+# min_scale/max_scale: limits on resampling (the default never enlarges)
+# max_pixels: hard cap on the working resolution whatever the text size
+# tolerance: relative scale change below which resampling is skipped
+NormalizationSettings = namedtuple(
+    'NormalizationSettings',
+    ['target_text_height', 'min_scale', 'max_scale', 'max_pixels', 'tolerance']
+)
+DEFAULT_NORMALIZATION = NormalizationSettings(
+    target_text_height=30,
+    min_scale=0.2,
+    max_scale=1.0,
+    max_pixels=8_000_000,
+    tolerance=0.15
+)
+
+# Long side of the thumbnail used to measure text height
+_ESTIMATE_SIDE = 2048
+
+
+class StageCache:
+    """Byte-bounded LRU cache of intermediate preprocessing stages"""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = value.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = value
+            self.current_bytes += size
+            # Evict least recently used stages until we fit again
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared cache used by the Streamlit preview; module state survives reruns
+preview_cache = StageCache()
+
+
+def bytes_digest(data):
+    """Content hash of raw uploaded file bytes"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def image_digest(image):
+    """Content hash of a decoded image array"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.shape}{image.dtype.str}".encode('utf-8'))
+    h.update(np.ascontiguousarray(image).data)
+    return h.hexdigest()
+
+
+def _cached(cache, key, compute):
+    if cache is None:
+        return compute()
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        # Cached stages are shared between reruns, so guard against mutation
+        value.setflags(write=False)
+        cache.put(key, value)
+    return value
+
+
+def grayscale_stage(image):
+    """Convert to grayscale"""
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def estimate_text_height(gray):
+    """
+    Estimate the median glyph height in pixels from connected components of
+    a thresholded thumbnail. Returns None when no text-like blobs are found.
+    """
+    # Halving with pyrDown is much cheaper than an arbitrary INTER_AREA resize
+    small = gray
+    factor = 1.0
+    while max(small.shape[:2]) > _ESTIMATE_SIDE:
+        small = cv2.pyrDown(small)
+        factor /= 2
+
+    binary = cv2.adaptiveThreshold(
+        small, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15
+    )
+    count, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    heights = stats[1:count, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:count, cv2.CC_STAT_WIDTH]
+    areas = stats[1:count, cv2.CC_STAT_AREA]
+
+    # Keep glyph-sized blobs: drop specks, rules, borders and photos
+    max_height = small.shape[0] / 10
+    glyphs = (heights >= 3) & (heights <= max_height) & (areas >= 6) & (widths <= heights * 4)
+    if glyphs.sum() < 10:
+        return None
+    return float(np.median(heights[glyphs])) / factor
+
+
+def normalization_scale(gray, settings=DEFAULT_NORMALIZATION):
+    """Scale factor that brings text to the target height within the limits"""
+    height, width = gray.shape[:2]
+    scale = 1.0
+    text_height = estimate_text_height(gray)
+    if text_height:
+        scale = settings.target_text_height / text_height
+    scale = min(max(scale, settings.min_scale), settings.max_scale)
+
+    # Never exceed the pixel budget, whatever the text size suggests
+    pixel_scale = (settings.max_pixels / float(height * width)) ** 0.5
+    scale = min(scale, pixel_scale)
+    if abs(scale - 1.0) < settings.tolerance:
+        return 1.0
+    return scale
+
+
+def normalize_stage(gray, settings=DEFAULT_NORMALIZATION):
+    """Resample to the working resolution Tesseract is tuned for"""
+    if settings is None:
+        return gray
+    scale = normalization_scale(gray, settings)
+    if scale == 1.0:
+        return gray
+    interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_CUBIC
+    return cv2.resize(gray, None, fx=scale, fy=scale, interpolation=interpolation)
+
+
+def blur_stage(gray):
+    """Apply Gaussian blur to reduce noise"""
+    return cv2.GaussianBlur(gray, (3, 3), 0)
+
+
+def binarize_stage(blurred):
+    """Apply adaptive thresholding with reduced block size for better detail"""
+    return cv2.adaptiveThreshold(
+        blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.THRESH_BINARY_INV, 21, 10
+    )
+
+
+def denoise_stage(binary, denoise_strength):
+    """Denoise, reconnect broken strokes and sharpen edges"""
+    # Denoise with strength parameter
+    denoised = cv2.fastNlMeansDenoising(binary, None, denoise_strength, 7, 21)
+
+    # Apply dilation to connect broken text
+    kernel = np.ones((2, 2), np.uint8)
+    dilated = cv2.dilate(denoised, kernel, iterations=1)
+
+    # Enhance edges
+    edges = cv2.Laplacian(dilated, cv2.CV_8U, ksize=3)
+    return cv2.addWeighted(dilated, 1.5, edges, -0.5, 0)
+
+
+def contrast_stage(sharpened, contrast_strength):
+    """Apply contrast enhancement and invert back to black text on white"""
+    enhanced = cv2.convertScaleAbs(sharpened, alpha=contrast_strength, beta=10)
+    return cv2.bitwise_not(enhanced)
+
+
+def normalized_grayscale(image, cache=None, image_key=None, normalization=DEFAULT_NORMALIZATION):
+    """
+    Grayscale image at the working resolution, i.e. the input to the
+    blur/threshold/denoise stages. It shares coordinates with the output of
+    enhance_image, so crops of one line up with the other.
+    """
+    if cache is not None and image_key is None:
+        image_key = image_digest(image)
+    gray = _cached(cache, (image_key, 'gray'), lambda: grayscale_stage(image))
+    return _cached(
+        cache, (image_key, normalization, 'normalized'),
+        lambda: normalize_stage(gray, normalization)
+    )
+
+
+def enhance_image(image, denoise_strength, contrast_strength, cache=None, image_key=None,
+                  normalization=DEFAULT_NORMALIZATION):
+    """
+    Run the preprocessing stages on a BGR image.
+
+    When a cache is given every stage is memoized under the image content
+    hash (or ``image_key`` if the caller already has one), so changing only
+    the contrast reuses the denoised stage instead of recomputing it.
+    Pass ``normalization=None`` to keep the uploaded resolution.
+    """
+    if cache is not None and image_key is None:
+        image_key = image_digest(image)
+    contrast_strength = round(float(contrast_strength), 3)
+
+    normalized = normalized_grayscale(image, cache, image_key, normalization)
+    # Everything after normalization depends on the settings used for it
+    key = (image_key, normalization)
+    blurred = _cached(cache, key + ('blurred',), lambda: blur_stage(normalized))
+    binary = _cached(cache, key + ('binary',), lambda: binarize_stage(blurred))
+    sharpened = _cached(
+        cache, key + ('denoised', denoise_strength),
+        lambda: denoise_stage(binary, denoise_strength)
+    )
+    return _cached(
+        cache, key + ('enhanced', denoise_strength, contrast_strength),
+        lambda: contrast_stage(sharpened, contrast_strength)
+    )
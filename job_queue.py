@@ -0,0 +1,226 @@
+"""
+Local background job queue for OCR work.
+
+Jobs are queued per user and handed to a process pool round-robin, one
+user at a time, so a user who submits a 200-image batch only gets every
+Nth worker slot while others are waiting instead of the whole pool. At
+most ``max_workers`` jobs are in the pool at once; everything else waits
+here, which keeps the ordering under our control. The backlog is bounded
+overall and per user, and submissions beyond it are rejected immediately.
+
+Jobs submitted with ``threaded=True`` are called with a thread budget as
+``parallel``. A job that starts while nobody else is waiting gets every
+free slot, so one prescription on an idle server still reads its regions
+in parallel. With others waiting it gets one slot. The job holds its slots
+until it finishes, so the pool never runs more OCR threads than
+``max_workers`` in total.
+
+The Streamlit script thread only ever submits jobs and polls their
+status, so a rerun never waits on OCR.
+"""
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures.process import BrokenProcessPool
+
+from batch_processing import create_executor, default_worker_count
+
+DEFAULT_MAX_BACKLOG = 1000
+DEFAULT_MAX_PER_USER = 250
+
+# Finished jobs are kept this long (seconds) for their owners to collect
+RESULT_TTL = 30 * 60
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+class JobQueue:
+    """Bounded, per-user fair queue in front of a process pool"""
+
+    def __init__(self, max_workers=None, max_backlog=DEFAULT_MAX_BACKLOG,
+                 max_per_user=DEFAULT_MAX_PER_USER, executor_factory=create_executor):
+        self.max_workers = max_workers or default_worker_count()
+        self.max_backlog = max_backlog
+        self.max_per_user = max_per_user
+        self._executor_factory = executor_factory
+        self._executor = None
+        self._condition = threading.Condition()
+        self._queues = OrderedDict()
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._running = 0
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, user, fn, *args, threaded=False, **kwargs):
+        """
+        Queue ``fn(*args, **kwargs)`` for ``user``. ``fn`` and its arguments
+        must be picklable. With ``threaded``, ``fn`` is also passed its thread
+        budget as ``parallel``. Returns ``(True, job_id)`` or ``(False, message)``.
+        """
+        with self._condition:
+            self._prune()
+            if self.backlog() >= self.max_backlog:
+                return False, "The server is busy right now. Please try again shortly."
+            user_queue = self._queues.get(user)
+            if user_queue is not None and len(user_queue) >= self.max_per_user:
+                return False, f"You already have {len(user_queue)} prescriptions waiting. Please wait for them to finish."
+
+            job_id = f"job-{next(self._ids)}"
+            self._jobs[job_id] = {
+                'id': job_id,
+                'user': user,
+                'status': QUEUED,
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'result': None,
+                'error': None,
+                'threaded': threaded,
+                'slots': 0,
+                'call': (fn, args, kwargs)
+            }
+            self._queues.setdefault(user, deque()).append(job_id)
+            self._condition.notify_all()
+            return True, job_id
+
+    def status(self, job_id):
+        """Snapshot of a job, with its queue position while waiting, or None"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snapshot = {key: value for key, value in job.items() if key != 'call'}
+            snapshot['position'] = self._position(job) if job['status'] == QUEUED else None
+            return snapshot
+
+    def cancel(self, job_id):
+        """Drop a job that has not started yet"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != QUEUED:
+                return False
+            self._queues[job['user']].remove(job_id)
+            if not self._queues[job['user']]:
+                del self._queues[job['user']]
+            job['status'] = CANCELLED
+            job['finished_at'] = time.time()
+            job.pop('call', None)
+            return True
+
+    def backlog(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _position(self, job):
+        """Approximate number of jobs that will start before this one"""
+        own = self._queues[job['user']]
+        index = own.index(job['id'])
+        # Round-robin serves at most index + 1 jobs of every other user first
+        others = sum(
+            min(len(queue), index + 1)
+            for user, queue in self._queues.items() if user != job['user']
+        )
+        return index + others + 1
+
+    def _prune(self):
+        cutoff = time.time() - RESULT_TTL
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['finished_at'] is not None and job['finished_at'] < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _next_job(self):
+        # Take the next job of the user at the front, then send them to the back
+        user, queue = next(iter(self._queues.items()))
+        job = self._jobs[queue.popleft()]
+        if queue:
+            self._queues.move_to_end(user)
+        else:
+            del self._queues[user]
+        return job
+
+    def _get_executor(self):
+        with self._condition:
+            if self._executor is None:
+                self._executor = self._executor_factory(self.max_workers)
+            return self._executor
+
+    def _reset_executor(self, broken):
+        """Drop a broken pool so the jobs still waiting get a fresh one"""
+        if broken is None:
+            return
+        with self._condition:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def _dispatch_loop(self):
+        while True:
+            with self._condition:
+                while self._running >= self.max_workers or not self._queues:
+                    self._condition.wait()
+                job = self._next_job()
+                job['status'] = RUNNING
+                job['started_at'] = time.time()
+                fn, args, kwargs = job.pop('call')
+                # Idle slots go to a threaded job only while nobody else is waiting
+                job['slots'] = self.max_workers - self._running if job['threaded'] and not self._queues else 1
+                if job['threaded']:
+                    kwargs = dict(kwargs, parallel=job['slots'])
+                self._running += job['slots']
+
+            executor = None
+            try:
+                executor = self._get_executor()
+                future = executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool as e:
+                self._reset_executor(executor)
+                self._complete(job['id'], error=str(e))
+                continue
+            except Exception as e:
+                # Fail this job only; the dispatcher has to keep serving the rest
+                self._complete(job['id'], error=str(e))
+                continue
+            future.add_done_callback(
+                lambda f, job_id=job['id'], executor=executor: self._on_done(job_id, executor, f)
+            )
+
+    def _on_done(self, job_id, executor, future):
+        try:
+            self._complete(job_id, result=future.result())
+        except BrokenProcessPool as e:
+            # A worker died; start a fresh pool for the jobs still waiting
+            self._reset_executor(executor)
+            self._complete(job_id, error=str(e))
+        except Exception as e:
+            self._complete(job_id, error=str(e))
+
+    def _complete(self, job_id, result=None, error=None):
+        with self._condition:
+            job = self._jobs.get(job_id)
+            self._running -= job['slots'] if job is not None else 1
+            if job is not None:
+                job['status'] = FAILED if error else DONE
+                job['result'] = result
+                job['error'] = error
+                job['finished_at'] = time.time()
+            self._condition.notify_all()
+
+
+def get_job_queue():
+    """Process-wide job queue, shared by every session and kept across reruns"""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
@@ -0,0 +1,101 @@
+"""
+Shared JWT signing keys.
+
+Keys live in the jwt_keys table of app.db, so every app process on the
+host signs and verifies with the same ring and a restart no longer logs
+everyone out. Tokens carry the signing key's ID in their ``kid`` header.
+The newest key signs for ``ROTATION_INTERVAL``; after that the next
+process to sign creates a replacement under BEGIN IMMEDIATE, so exactly
+one new key appears however many processes notice at once. Old keys keep
+verifying until every token they signed has expired, then are deleted.
+"""
+import os
+import secrets
+import threading
+import time
+
+import jwt
+
+from db import connection, transaction
+
+ALGORITHM = 'HS256'
+TOKEN_LIFETIME = 24 * 60 * 60
+ROTATION_INTERVAL = int(os.environ.get('JWT_ROTATION_DAYS', '7')) * 24 * 60 * 60
+# How often a process re-reads the ring to pick up keys made elsewhere
+REFRESH_INTERVAL = 60
+
+_key_ring = None
+_key_ring_lock = threading.Lock()
+
+
+class KeyRing:
+    """In-process view of the jwt_keys table"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._signing = None
+        self._loaded_at = 0
+
+    def _load(self, now):
+        with connection() as conn:
+            rows = conn.execute(
+                'SELECT kid, secret, signs_until FROM jwt_keys WHERE retire_at > ?', (now,)
+            ).fetchall()
+        self._keys = {kid: secret for kid, secret, _ in rows}
+        signing = [(signs_until, kid) for kid, _, signs_until in rows if signs_until > now]
+        self._signing = max(signing) if signing else None
+        self._loaded_at = now
+
+    def _rotate(self, now):
+        with transaction(immediate=True) as conn:
+            c = conn.cursor()
+            # Another process may have rotated while we waited for the lock
+            c.execute('SELECT COUNT(*) FROM jwt_keys WHERE signs_until > ?', (now,))
+            if c.fetchone()[0] == 0:
+                c.execute('''
+                    INSERT INTO jwt_keys (kid, secret, created_at, signs_until, retire_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (secrets.token_hex(8), os.urandom(32), now, now + ROTATION_INTERVAL,
+                      now + ROTATION_INTERVAL + TOKEN_LIFETIME))
+            c.execute('DELETE FROM jwt_keys WHERE retire_at <= ?', (now,))
+
+    def signing_key(self):
+        """(kid, secret) of the key new tokens are signed with"""
+        now = int(time.time())
+        with self._lock:
+            if self._signing is None or self._signing[0] <= now or now - self._loaded_at > REFRESH_INTERVAL:
+                self._load(now)
+                if self._signing is None:
+                    self._rotate(now)
+                    self._load(now)
+            kid = self._signing[1]
+            return kid, self._keys[kid]
+
+    def verification_key(self, kid):
+        """Secret for ``kid``, re-reading the ring once for keys made by other processes"""
+        now = int(time.time())
+        with self._lock:
+            if kid not in self._keys and now != self._loaded_at:
+                self._load(now)
+            return self._keys.get(kid)
+
+    def sign(self, payload):
+        kid, secret = self.signing_key()
+        return jwt.encode(payload, secret, algorithm=ALGORITHM, headers={'kid': kid})
+
+    def decode(self, token):
+        """Verified payload; raises jwt.InvalidTokenError (or a subclass) otherwise"""
+        kid = jwt.get_unverified_header(token).get('kid')
+        secret = self.verification_key(kid) if kid else None
+        if secret is None:
+            raise jwt.InvalidTokenError("Unknown signing key")
+        return jwt.decode(token, secret, algorithms=[ALGORITHM])
+
+
+def get_key_ring():
+    global _key_ring
+    with _key_ring_lock:
+        if _key_ring is None:
+            _key_ring = KeyRing()
+        return _key_ring
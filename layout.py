@@ -0,0 +1,81 @@
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+TextRegion = namedtuple('TextRegion', ['x', 'y', 'width', 'height'])
+
+
+def _ink_mask(processed_image):
+    """Binary mask of dark text pixels on a processed (black on white) page"""
+    _, mask = cv2.threshold(processed_image, 127, 255, cv2.THRESH_BINARY_INV)
+    return mask
+
+
+def _glyph_mask(mask):
+    """
+    Keep only glyph-sized components of the ink mask so specks left over
+    from denoising do not grow into regions. Returns the cleaned mask and
+    the median glyph height, or ``(None, None)`` when there is no text.
+    """
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    heights = stats[:, cv2.CC_STAT_HEIGHT]
+    areas = stats[:, cv2.CC_STAT_AREA]
+    candidates = (areas >= 6) & (heights >= 3) & (heights <= mask.shape[0] / 10)
+    candidates[0] = False
+    if not candidates.any():
+        return None, None
+
+    glyph_height = float(np.median(heights[candidates]))
+    keep = candidates & (heights >= glyph_height * 0.4)
+    return np.where(keep[labels], 255, 0).astype(np.uint8), glyph_height
+
+
+def sort_reading_order(regions):
+    """Sort regions top-to-bottom, then left-to-right within a row"""
+    rows = []
+    for region in sorted(regions, key=lambda r: r.y):
+        row = rows[-1] if rows else None
+        # Regions that overlap the row vertically by half their height share it
+        if row and region.y < row[0] + (row[1] - row[0]) / 2 and region.y + region.height / 2 < row[1]:
+            row[2].append(region)
+            row[1] = max(row[1], region.y + region.height)
+        else:
+            rows.append([region.y, region.y + region.height, [region]])
+    return [region for _, _, row in rows for region in sorted(row, key=lambda r: r.x)]
+
+
+def detect_text_regions(processed_image, padding=None):
+    """
+    Find blocks of text (letterhead, patient block, Rx lines, ...) on a
+    processed page by smearing glyphs together with morphology and taking
+    the connected components of the result. Regions come back in reading order.
+    """
+    mask, glyph_height = _glyph_mask(_ink_mask(processed_image))
+    if mask is None:
+        return []
+
+    # Join characters into words and lines, and lines closer than about one
+    # line of spacing into the same block
+    kernel = cv2.getStructuringElement(
+        cv2.MORPH_RECT,
+        (max(3, int(glyph_height * 2)), max(3, int(glyph_height * 1.2)))
+    )
+    blocks = cv2.dilate(mask, kernel, iterations=1)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(blocks, connectivity=8)
+
+    height, width = mask.shape[:2]
+    padding = int(glyph_height / 2) if padding is None else padding
+    regions = []
+    for x, y, w, h, _ in stats[1:count]:
+        # Skip blobs too small to hold a glyph
+        if h < glyph_height * 0.8 or w < glyph_height:
+            continue
+        x0, y0 = max(0, x - padding), max(0, y - padding)
+        x1, y1 = min(width, x + w + padding), min(height, y + h + padding)
+        regions.append(TextRegion(int(x0), int(y0), int(x1 - x0), int(y1 - y0)))
+    return sort_reading_order(regions)
+
+
+def crop_region(image, region):
+    return image[region.y:region.y + region.height, region.x:region.x + region.width]
@@ -0,0 +1,319 @@
+"""
+Versioned schema migrations for app.db.
+
+The schema version lives in ``PRAGMA user_version``. Each numbered
+migration runs once per database, in its own transaction opened with
+BEGIN IMMEDIATE, which holds SQLite's write lock across every process
+using the file. The version is re-read under that lock, so when several
+app processes start together exactly one of them applies each migration
+and the rest see it already done.
+
+Migrations hold the SQL they ran when they were written rather than
+calling into other modules, so replaying one on a new database always does
+the same thing however those modules have changed since.
+"""
+import sqlite3
+
+from db import get_pool
+
+
+def _initial_schema(c):
+    """Tables as created by the original init_db, including the user_type upgrade"""
+    # Check if user_type column exists in users table
+    c.execute("PRAGMA table_info(users)")
+    columns = [column[1] for column in c.fetchall()]
+    
+    # If users table doesn't exist or needs to be updated
+    if 'user_type' not in columns:
+        # Create temporary table with new schema
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS users_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL,
+                email TEXT UNIQUE NOT NULL,
+                user_type TEXT DEFAULT 'doctor',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_login TIMESTAMP
+            )
+        ''')
+    
+        # Copy data from old table if it exists
+        try:
+            c.execute('''
+                INSERT INTO users_new (id, username, password, email, created_at, last_login)
+                SELECT id, username, password, email, created_at, last_login FROM users
+            ''')
+            # Drop old table
+            c.execute('DROP TABLE users')
+            # Rename new table to users
+            c.execute('ALTER TABLE users_new RENAME TO users')
+        except sqlite3.OperationalError:
+            # If old table doesn't exist, just rename the new table
+            c.execute('ALTER TABLE users_new RENAME TO users')
+    else:
+        # Create users table if it doesn't exist
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL,
+                email TEXT UNIQUE NOT NULL,
+                user_type TEXT DEFAULT 'doctor',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_login TIMESTAMP
+            )
+        ''')
+    
+    # Create medical_representatives table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS medical_representatives (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            full_name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            territory TEXT NOT NULL,
+            company TEXT NOT NULL,
+            specialization TEXT,
+            target_doctors INTEGER DEFAULT 0,
+            current_doctors INTEGER DEFAULT 0,
+            monthly_visits INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_updated TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Create mr_doctor_assignments table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS mr_doctor_assignments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            mr_id INTEGER NOT NULL,
+            doctor_id INTEGER NOT NULL,
+            assignment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'active',
+            last_visit_date TIMESTAMP,
+            notes TEXT,
+            FOREIGN KEY (mr_id) REFERENCES medical_representatives (id),
+            FOREIGN KEY (doctor_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Create mr_visits table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS mr_visits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            mr_id INTEGER NOT NULL,
+            doctor_id INTEGER NOT NULL,
+            visit_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            visit_purpose TEXT,
+            discussion_points TEXT,
+            feedback TEXT,
+            next_visit_date TIMESTAMP,
+            status TEXT DEFAULT 'completed',
+            FOREIGN KEY (mr_id) REFERENCES medical_representatives (id),
+            FOREIGN KEY (doctor_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Create discount_codes table
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS discount_codes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE NOT NULL,
+            doctor_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expiry_date TIMESTAMP,
+            times_used INTEGER DEFAULT 0,
+            max_uses INTEGER DEFAULT 100,
+            discount_percentage INTEGER DEFAULT 20,
+            is_active BOOLEAN DEFAULT 1,
+            FOREIGN KEY (doctor_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Update any existing users without user_type to have 'doctor' as default
+    c.execute('''
+        UPDATE users 
+        SET user_type = 'doctor' 
+        WHERE user_type IS NULL
+    ''')
+
+
+def _dashboard_indexes(c):
+    """Indexes behind the MR dashboard statistics and per-doctor lookups"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_mr_visits_mr_date ON mr_visits (mr_id, visit_date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_mr_assignments_mr_status ON mr_doctor_assignments (mr_id, status)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_discount_codes_doctor ON discount_codes (doctor_id)')
+
+
+def _visit_rollups(c):
+    """Rollup tables for MR metrics, backfilled from existing visits and assignments"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS mr_visit_rollups (
+            scope TEXT NOT NULL,
+            scope_key TEXT NOT NULL,
+            period TEXT NOT NULL,
+            period_start TEXT NOT NULL,
+            visits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, scope_key, period, period_start)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_mr_visit_rollups_rank
+        ON mr_visit_rollups (scope, period, period_start, visits)
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_medical_representatives_territory ON medical_representatives (territory)')
+
+    # Backfill every scope and period from the visits so far
+    scope_keys = {'mr': "CAST(v.mr_id AS TEXT)", 'territory': "mr.territory", 'company': "mr.company"}
+    period_starts = {'day': "date(v.visit_date)", 'month': "date(v.visit_date, 'start of month')"}
+    c.execute('DELETE FROM mr_visit_rollups')
+    for scope, key in scope_keys.items():
+        for period, start in period_starts.items():
+            c.execute(f'''
+                INSERT INTO mr_visit_rollups (scope, scope_key, period, period_start, visits)
+                SELECT ?, {key}, ?, {start}, COUNT(*)
+                FROM mr_visits v
+                LEFT JOIN medical_representatives mr ON mr.id = v.mr_id
+                WHERE {key} IS NOT NULL AND {start} IS NOT NULL
+                GROUP BY {key}, {start}
+            ''', (scope, period))
+    c.execute('''
+        UPDATE medical_representatives
+        SET current_doctors = (
+            SELECT COUNT(*) FROM mr_doctor_assignments a
+            WHERE a.mr_id = medical_representatives.id AND a.status = 'active'
+        )
+    ''')
+
+
+def _discount_expiry_timestamps(c):
+    """Numeric expiry and last attempt outcome so redemption is a single UPDATE"""
+    c.execute('ALTER TABLE discount_codes ADD COLUMN expiry_ts INTEGER')
+    c.execute('ALTER TABLE discount_codes ADD COLUMN last_attempt_ok INTEGER')
+    # expiry_date holds str(datetime.now() + ...), i.e. server local time
+    c.execute('''
+        UPDATE discount_codes
+        SET expiry_ts = CAST(strftime('%s', expiry_date, 'utc') AS INTEGER)
+        WHERE expiry_date IS NOT NULL
+    ''')
+
+
+def _code_allocators(c):
+    """Counters behind collision-free discount codes"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS code_allocators (
+            name TEXT PRIMARY KEY,
+            permutation_key BLOB NOT NULL,
+            alphabet TEXT NOT NULL,
+            length INTEGER NOT NULL,
+            next_value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+
+def _discount_reservations(c):
+    """Uses leased out by write-behind buffers and not yet redeemed or returned"""
+    c.execute('ALTER TABLE discount_codes ADD COLUMN reserved_uses INTEGER NOT NULL DEFAULT 0')
+
+
+def _jwt_keys(c):
+    """Shared JWT signing keys"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS jwt_keys (
+            kid TEXT PRIMARY KEY,
+            secret BLOB NOT NULL,
+            created_at INTEGER NOT NULL,
+            signs_until INTEGER NOT NULL,
+            retire_at INTEGER NOT NULL
+        )
+    ''')
+
+
+def _visit_history_indexes(c):
+    """Index for an MR's visit history filtered by doctor"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_mr_visits_mr_doctor_date ON mr_visits (mr_id, doctor_id, visit_date)')
+
+
+def _doctor_search(c):
+    """Doctor names and the indexes behind the doctor picker"""
+    c.execute('ALTER TABLE users ADD COLUMN full_name TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_doctor_username ON users (user_type, username COLLATE NOCASE)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_doctor_full_name ON users (user_type, full_name COLLATE NOCASE)')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_mr_assignments_mr_doctor
+        ON mr_doctor_assignments (mr_id, doctor_id, status)
+    ''')
+
+
+def _report_indexes(c):
+    """Indexes that let reports stream in order without sorting"""
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_medical_representatives_report
+        ON medical_representatives (territory, company, full_name)
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_medical_representatives_report_company
+        ON medical_representatives (company, territory, full_name)
+    ''')
+
+
+def _visit_archive(c):
+    """Bookkeeping for monthly visit archives"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS archive_state (
+            month TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            visits INTEGER NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Finds the months to archive and their rows without walking every MR
+    c.execute('CREATE INDEX IF NOT EXISTS idx_mr_visits_date ON mr_visits (visit_date)')
+
+
+# (version, description, apply) in order; append new migrations, never edit applied ones
+MIGRATIONS = [
+    (1, "Initial schema", _initial_schema),
+    (2, "Dashboard indexes", _dashboard_indexes),
+    (3, "Visit rollups", _visit_rollups),
+    (4, "Discount expiry timestamps", _discount_expiry_timestamps),
+    (5, "Code allocators", _code_allocators),
+    (6, "Discount reservations", _discount_reservations),
+    (7, "JWT key ring", _jwt_keys),
+    (8, "Visit history indexes", _visit_history_indexes),
+    (9, "Doctor search", _doctor_search),
+    (10, "Report indexes", _report_indexes),
+    (11, "Visit archive", _visit_archive),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(pool=None):
+    """Apply pending migrations and return the resulting schema version"""
+    pool = pool or get_pool()
+    with pool.connection() as conn:
+        version = schema_version(conn)
+        for number, description, apply in MIGRATIONS:
+            if number <= version:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Another process may have migrated while we waited for the lock
+                version = schema_version(conn)
+                if number > version:
+                    apply(conn.cursor())
+                    conn.execute(f'PRAGMA user_version = {number}')
+                    version = number
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise sqlite3.DatabaseError(f"Migration {number} ({description}) failed: {e}") from e
+        return version
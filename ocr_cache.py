@@ -0,0 +1,278 @@
+"""
+Persistent cache of structured OCR results.
+
+Results are keyed by their owner (the uploading user), the exact content
+hash of the upload and the extraction settings, so a re-upload of the same
+file returns the stored process_prescription_text output without
+denoising or OCR. One owner never sees another's results.
+
+Near-duplicate lookup is off by default (``max_distance`` 0): prescriptions
+on the same letterhead get perceptual hashes (pHash) as close as those of
+two copies of one photo. When it is turned on, the pHash is split into 8
+one-byte bands held in an indexed side table. Two hashes within Hamming
+distance d < 8 share at least one band exactly, so probing the band index
+finds every candidate within ``max_distance`` without scanning the table.
+A candidate is only returned if its ink mask, the binarized page at
+``INK_SIDE`` pixels, differs from the upload's by at most
+``MAX_INK_DIFFERENCE``. That accepts resized or recompressed copies of a
+file and rejects different writing on the same letterhead.
+"""
+import json
+import sqlite3
+import time
+
+import cv2
+import numpy as np
+
+from image_pipeline import DEFAULT_NORMALIZATION
+
+# Lives next to app.db
+OCR_CACHE_DB = 'ocr_cache.db'
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_DISTANCE = 0
+
+# Bumped when entries change shape; older caches are discarded
+SCHEMA_VERSION = 2
+
+# Long side of the ink mask near-duplicates are confirmed with, and the
+# share of inked pixels that may differ (resized copies stay under 0.05,
+# different writing on one letterhead is above 0.1)
+INK_SIDE = 256
+MAX_INK_DIFFERENCE = 0.06
+
+BANDS = 8
+BAND_BITS = 64 // BANDS
+
+
+def perceptual_hash(image):
+    """64-bit DCT perceptual hash of a BGR or grayscale image"""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    # Ignore the DC term so overall brightness does not matter
+    bits = low > np.median(low[1:])
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def ink_mask(image):
+    """Binarized ink of a BGR or grayscale image, scaled to INK_SIDE on its long side"""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    height, width = image.shape[:2]
+    scale = INK_SIDE / float(max(height, width))
+    small = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                       interpolation=cv2.INTER_AREA)
+    return cv2.adaptiveThreshold(small, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+                                 cv2.THRESH_BINARY_INV, 15, 10) > 0
+
+
+def ink_difference(a, b):
+    """Share of the inked pixels in either mask that are not inked in both"""
+    if a.shape != b.shape:
+        return 1.0
+    inked = np.count_nonzero(a | b)
+    return np.count_nonzero(a ^ b) / inked if inked else 0.0
+
+
+def _encode_mask(mask):
+    # PNG keeps the shape and squeezes a mostly blank page to a few KB
+    return cv2.imencode('.png', mask.astype(np.uint8) * 255)[1].tobytes()
+
+
+def _decode_mask(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE) > 0
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def _to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def _bands(phash):
+    mask = (1 << BAND_BITS) - 1
+    return [(band, (phash >> (band * BAND_BITS)) & mask) for band in range(BANDS)]
+
+
+def settings_key(denoise_strength, contrast_strength, detect_regions=True,
+                 normalization=DEFAULT_NORMALIZATION):
+    """Everything besides the image that changes the extracted text"""
+    return json.dumps([
+        denoise_strength, round(float(contrast_strength), 3), bool(detect_regions),
+        list(normalization) if normalization else None
+    ])
+
+
+class OcrResultCache:
+    """SQLite-backed, per-owner OCR result cache with size-based eviction"""
+
+    def __init__(self, path=OCR_CACHE_DB, max_bytes=DEFAULT_MAX_BYTES,
+                 max_distance=DEFAULT_MAX_DISTANCE):
+        if max_distance >= BANDS:
+            raise ValueError(f"max_distance must be below {BANDS}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_distance = max_distance
+        self._initialized = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            self._init_schema(conn)
+            self._initialized = True
+        return conn
+
+    def _init_schema(self, conn):
+        c = conn.cursor()
+        c.execute('PRAGMA journal_mode=WAL')
+        c.execute('PRAGMA user_version')
+        if c.fetchone()[0] < SCHEMA_VERSION:
+            # Entries from before owners and ink masks cannot be served safely
+            c.execute('DROP TABLE IF EXISTS ocr_phash_bands')
+            c.execute('DROP TABLE IF EXISTS ocr_results')
+            c.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS ocr_results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                owner TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                phash INTEGER NOT NULL,
+                ink BLOB NOT NULL,
+                settings TEXT NOT NULL,
+                result TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                UNIQUE (owner, content_hash, settings)
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS ocr_phash_bands (
+                band INTEGER NOT NULL,
+                value INTEGER NOT NULL,
+                result_id INTEGER NOT NULL,
+                PRIMARY KEY (band, value, result_id),
+                FOREIGN KEY (result_id) REFERENCES ocr_results (id) ON DELETE CASCADE
+            ) WITHOUT ROWID
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_ocr_phash_bands_result ON ocr_phash_bands (result_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_ocr_results_last_used ON ocr_results (last_used)')
+        conn.commit()
+
+    def lookup(self, owner, content_hash, image, settings):
+        """Stored result of ``owner`` for this image, or a confirmed near-duplicate of it, else None"""
+        if owner is None:
+            return None
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            c.execute('''
+                SELECT id, result FROM ocr_results
+                WHERE owner = ? AND content_hash = ? AND settings = ?
+            ''', (owner, content_hash, settings))
+            row = c.fetchone()
+
+            if row is None and self.max_distance > 0:
+                phash = perceptual_hash(image)
+                band_filter = " OR ".join(["(b.band = ? AND b.value = ?)"] * BANDS)
+                params = [v for pair in _bands(phash) for v in pair]
+                c.execute(f'''
+                    SELECT DISTINCT r.id, r.result, r.phash, r.ink
+                    FROM ocr_phash_bands b
+                    JOIN ocr_results r ON r.id = b.result_id
+                    WHERE ({band_filter}) AND r.owner = ? AND r.settings = ?
+                ''', params + [owner, settings])
+                candidates = []
+                for result_id, result, stored, ink in c.fetchall():
+                    distance = hamming_distance(phash, _to_unsigned(stored))
+                    if distance <= self.max_distance:
+                        candidates.append((distance, result_id, result, ink))
+                # A close pHash only makes a candidate; the ink has to match too
+                mask = ink_mask(image) if candidates else None
+                for _, result_id, result, ink in sorted(candidates, key=lambda candidate: candidate[:2]):
+                    if ink_difference(mask, _decode_mask(ink)) <= MAX_INK_DIFFERENCE:
+                        row = (result_id, result)
+                        break
+
+            if row is None:
+                return None
+            c.execute('UPDATE ocr_results SET last_used = ? WHERE id = ?', (time.time(), row[0]))
+            conn.commit()
+            return row[1]
+        finally:
+            conn.close()
+
+    def store(self, owner, content_hash, image, settings, result):
+        """Save a result for ``owner`` and evict least recently used entries over the size limit"""
+        # Without an owner there is nobody the result could safely be returned to
+        if owner is None:
+            return
+        phash = perceptual_hash(image)
+        ink = _encode_mask(ink_mask(image))
+        size = len(result.encode('utf-8')) + len(ink) + len(owner) + len(content_hash) + len(settings)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        conn = self._connect()
+        c = conn.cursor()
+        try:
+            c.execute('PRAGMA foreign_keys = ON')
+            c.execute('''
+                INSERT INTO ocr_results
+                (owner, content_hash, phash, ink, settings, result, size_bytes, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (owner, content_hash, settings) DO UPDATE SET
+                    phash = excluded.phash, ink = excluded.ink, result = excluded.result,
+                    size_bytes = excluded.size_bytes, last_used = excluded.last_used
+                RETURNING id
+            ''', (owner, content_hash, _to_signed(phash), ink, settings, result, size, now, now))
+            result_id = c.fetchone()[0]
+            c.execute('DELETE FROM ocr_phash_bands WHERE result_id = ?', (result_id,))
+            c.executemany(
+                'INSERT INTO ocr_phash_bands (band, value, result_id) VALUES (?, ?, ?)',
+                [(band, value, result_id) for band, value in _bands(phash)]
+            )
+
+            c.execute('SELECT COALESCE(SUM(size_bytes), 0) FROM ocr_results')
+            excess = c.fetchone()[0] - self.max_bytes
+            if excess > 0:
+                # Drop the least recently used results until we are back under the limit
+                c.execute('''
+                    SELECT id, size_bytes FROM ocr_results
+                    WHERE id != ? ORDER BY last_used
+                ''', (result_id,))
+                evict = []
+                for old_id, old_size in c:
+                    if excess <= 0:
+                        break
+                    evict.append((old_id,))
+                    excess -= old_size
+                # Band rows go with them through ON DELETE CASCADE
+                c.executemany('DELETE FROM ocr_results WHERE id = ?', evict)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def clear(self):
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM ocr_phash_bands')
+            conn.execute('DELETE FROM ocr_results')
+            conn.commit()
+        finally:
+            conn.close()
+
+
+# Shared by the app and batch workers; entries are scoped to their owner
+ocr_cache = OcrResultCache()
@@ -0,0 +1,155 @@
+"""
+OCR backends.
+
+The tesserocr backend keeps a warm Tesseract engine per worker thread, so
+the language data is loaded once and images are handed over as in-memory
+buffers. When tesserocr is not installed, or cannot load its language
+data, we fall back to pytesseract, which starts the tesseract binary and
+round-trips the image through a temporary file on every call.
+"""
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pytesseract
+
+try:
+    import tesserocr
+except (ImportError, ValueError):
+    # tesserocr installs signal handlers on import, which fails off the main
+    # thread (e.g. in a Streamlit script thread); pool workers still get it
+    tesserocr = None
+
+# 'auto' prefers the in-process engine; 'tesserocr' or 'pytesseract' force one
+OCR_BACKEND = os.environ.get('OCR_BACKEND', 'auto')
+OCR_LANGUAGE = os.environ.get('OCR_LANGUAGE', 'eng')
+
+# Assume a single uniform block of text
+DEFAULT_PSM = 6
+
+_backend = None
+_backend_lock = threading.Lock()
+
+# A recognised word with its confidence (0-100) and bounding box. ``line``
+# identifies the text line the word belongs to within the OCR'd image.
+OcrWord = namedtuple('OcrWord', ['text', 'confidence', 'left', 'top', 'width', 'height', 'line'])
+
+
+class PytesseractBackend:
+    """Runs the tesseract binary through pytesseract for every call"""
+
+    name = 'pytesseract'
+
+    def __init__(self, language=OCR_LANGUAGE):
+        self.language = language
+
+    def image_to_string(self, image, psm=DEFAULT_PSM):
+        return pytesseract.image_to_string(
+            image, lang=self.language, config=f'--oem 3 --psm {psm}'
+        )
+
+    def image_to_words(self, image, psm=DEFAULT_PSM):
+        data = pytesseract.image_to_data(
+            image, lang=self.language, config=f'--oem 3 --psm {psm}',
+            output_type=pytesseract.Output.DICT
+        )
+        words = []
+        for i, text in enumerate(data['text']):
+            # Level 5 rows are words; the others describe pages, blocks and lines
+            if data['level'][i] != 5 or not text.strip():
+                continue
+            words.append(OcrWord(
+                text.strip(), float(data['conf'][i]),
+                data['left'][i], data['top'][i], data['width'][i], data['height'][i],
+                (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+            ))
+        return words
+
+
+class TesserocrBackend:
+    """In-process Tesseract engine, created once per thread and reused"""
+
+    name = 'tesserocr'
+
+    def __init__(self, language=OCR_LANGUAGE):
+        self.language = language
+        self._local = threading.local()
+
+    def _api(self):
+        # PyTessBaseAPI is not thread-safe, so every thread gets its own
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            api = tesserocr.PyTessBaseAPI(lang=self.language, oem=tesserocr.OEM.DEFAULT)
+            self._local.api = api
+        return api
+
+    def _set_image(self, api, image, psm):
+        """Pass the grayscale pixel buffer straight to Tesseract"""
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        api.SetPageSegMode(psm)
+        api.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+
+    def image_to_string(self, image, psm=DEFAULT_PSM):
+        api = self._api()
+        self._set_image(api, image, psm)
+        return api.GetUTF8Text()
+
+    def image_to_words(self, image, psm=DEFAULT_PSM):
+        api = self._api()
+        self._set_image(api, image, psm)
+        api.Recognize()
+
+        words = []
+        iterator = api.GetIterator()
+        if iterator is None:
+            return words
+        line = -1
+        level = tesserocr.RIL.WORD
+        for result in tesserocr.iterate_level(iterator, level):
+            if result.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+                line += 1
+            try:
+                text = result.GetUTF8Text(level)
+            except RuntimeError:
+                # Raised for empty results
+                continue
+            if not text.strip():
+                continue
+            x0, y0, x1, y1 = result.BoundingBox(level)
+            words.append(OcrWord(
+                text.strip(), float(result.Confidence(level)), x0, y0, x1 - x0, y1 - y0, line
+            ))
+        return words
+
+
+def create_backend(name=OCR_BACKEND):
+    """Create the configured backend, falling back to pytesseract"""
+    if name not in ('auto', 'tesserocr', 'pytesseract'):
+        raise ValueError(f"Unknown OCR backend: {name}")
+
+    if name != 'pytesseract':
+        if tesserocr is not None:
+            backend = TesserocrBackend()
+            try:
+                # Load the language data now rather than on the first request
+                backend._api()
+                return backend
+            except RuntimeError:
+                if name == 'tesserocr':
+                    raise
+        elif name == 'tesserocr':
+            raise RuntimeError("tesserocr is not installed")
+
+    return PytesseractBackend()
+
+
+def get_ocr_backend():
+    """Process-wide OCR backend, created on first use"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend()
+        return _backend
@@ -0,0 +1,274 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from layout import TextRegion, crop_region, detect_text_regions
+from ocr_engine import DEFAULT_PSM, get_ocr_backend
+
+# Words Tesseract is less sure about than this (0-100) count as uncertain
+LOW_CONFIDENCE = 60
+
+# Page segmentation modes tried when re-reading a single uncertain word
+SINGLE_WORD_PSM = 8
+SINGLE_LINE_PSM = 7
+
+_region_executor = None
+_region_executor_lock = threading.Lock()
+
+
+def ocr_stage(processed_image, psm=DEFAULT_PSM):
+    """Run OCR on an image that has already been through preprocessing"""
+    return get_ocr_backend().image_to_string(processed_image, psm=psm)
+
+
+def get_region_executor():
+    """Thread pool for OCR of individual regions (the OCR engines release the GIL)"""
+    global _region_executor
+    with _region_executor_lock:
+        if _region_executor is None:
+            _region_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _region_executor
+
+
+def run_in_threads(fn, items, parallel=True):
+    """
+    ``[fn(item) for item in items]`` on the region thread pool. ``parallel``
+    is True to use every core, False to run inline, or the number of calls
+    to keep in flight at once, e.g. a job queue worker's thread budget.
+    """
+    items = list(items)
+    cores = os.cpu_count() or 1
+    limit = cores if parallel is True else int(parallel)
+    if limit <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    if limit >= cores:
+        return list(get_region_executor().map(fn, items))
+    slots = threading.BoundedSemaphore(limit)
+
+    def bounded(item):
+        with slots:
+            return fn(item)
+    return list(get_region_executor().map(bounded, items))
+
+
+def ocr_regions_stage(processed_image, regions=None, parallel=True, psm=DEFAULT_PSM):
+    """
+    OCR each text region separately and return ``(region_index, line)``
+    pairs in reading order. Falls back to the whole page when no regions
+    are found. ``parallel`` is as for run_in_threads; pass False or a
+    thread budget inside pool workers that share the cores.
+    """
+    if regions is None:
+        regions = detect_text_regions(processed_image)
+    crops = [crop_region(processed_image, region) for region in regions] or [processed_image]
+
+    texts = run_in_threads(lambda crop: ocr_stage(crop, psm), crops, parallel)
+
+    return [
+        (index, line.strip())
+        for index, text in enumerate(texts)
+        for line in text.split('\n')
+        if line.strip()
+    ]
+
+
+def _region_words(processed_image, region_index, region, psm):
+    """OCR one region and move the word boxes into page coordinates"""
+    words = get_ocr_backend().image_to_words(crop_region(processed_image, region), psm=psm)
+    return [
+        word._replace(left=word.left + region.x, top=word.top + region.y, line=(region_index, word.line))
+        for word in words
+    ]
+
+
+def ocr_words_stage(processed_image, regions=None, parallel=True, psm=DEFAULT_PSM):
+    """
+    Word-level OCR with confidences and page-coordinate boxes. Regions are
+    read in parallel like ocr_regions_stage; each word's ``line`` is a
+    ``(region_index, line)`` pair.
+    """
+    if regions is None:
+        regions = detect_text_regions(processed_image)
+    if not regions:
+        height, width = processed_image.shape[:2]
+        regions = [TextRegion(0, 0, width, height)]
+
+    jobs = [(processed_image, index, region, psm) for index, region in enumerate(regions)]
+    results = run_in_threads(lambda job: _region_words(*job), jobs, parallel)
+    return [word for words in results for word in words]
+
+
+def _word_crop(image, word, margin):
+    height, width = image.shape[:2]
+    x0, y0 = max(0, word.left - margin), max(0, word.top - margin)
+    x1 = min(width, word.left + word.width + margin)
+    y1 = min(height, word.top + word.height + margin)
+    crop = image[y0:y1, x0:x1]
+    # Tesseract reads isolated words best with a clear white border around them
+    return cv2.copyMakeBorder(crop, 10, 10, 10, 10, cv2.BORDER_CONSTANT, value=255)
+
+
+def _reocr_word(word, processed_image, gray_image):
+    """Re-read one uncertain word from small crops, keeping the most confident reading"""
+    margin = max(2, word.height // 4)
+    candidates = [
+        (_word_crop(processed_image, word, margin), SINGLE_WORD_PSM),
+        (_word_crop(processed_image, word, margin), SINGLE_LINE_PSM),
+    ]
+    if gray_image is not None:
+        # Different preprocessing: Otsu on the untouched grayscale, and the
+        # grayscale itself so Tesseract can binarize it its own way
+        gray_crop = _word_crop(gray_image, word, margin)
+        _, otsu = cv2.threshold(gray_crop, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        candidates += [(otsu, SINGLE_WORD_PSM), (gray_crop, SINGLE_WORD_PSM)]
+
+    best = word
+    backend = get_ocr_backend()
+    for crop, psm in candidates:
+        found = backend.image_to_words(crop, psm=psm)
+        if not found:
+            continue
+        confidence = float(np.mean([w.confidence for w in found]))
+        if confidence > best.confidence:
+            best = word._replace(text=" ".join(w.text for w in found), confidence=confidence)
+    return best
+
+
+def reocr_low_confidence(processed_image, words, gray_image=None, threshold=LOW_CONFIDENCE,
+                         parallel=True):
+    """
+    Re-run OCR on just the words below ``threshold`` using single-word and
+    single-line segmentation and, when ``gray_image`` (from
+    normalized_grayscale) is given, alternative binarizations. This costs a
+    few small crops rather than further full-page passes.
+    """
+    uncertain = [index for index, word in enumerate(words) if word.confidence < threshold]
+    if not uncertain:
+        return list(words)
+
+    reocr = lambda index: _reocr_word(words[index], processed_image, gray_image)
+    improved = run_in_threads(reocr, uncertain, parallel)
+
+    words = list(words)
+    for index, word in zip(uncertain, improved):
+        words[index] = word
+    return words
+
+
+def words_to_region_lines(words):
+    """Group words into ``(region_index, line)`` pairs for process_prescription_text"""
+    region_lines = []
+    for (region_index, _), line_words in groupby(words, key=lambda word: word.line):
+        region_lines.append((region_index, " ".join(word.text for word in line_words)))
+    return region_lines
+
+
+def extract_structured_text(processed_image, detect_regions=True, parallel=True):
+    """OCR a processed image and structure the result; None when no text is found"""
+    if detect_regions:
+        region_lines = ocr_regions_stage(processed_image, parallel=parallel)
+        return process_prescription_text(region_lines) if region_lines else None
+    text = ocr_stage(processed_image)
+    return process_prescription_text(text) if text.strip() else None
+
+
+def extract_structured_words(processed_image, gray_image=None, detect_regions=True, parallel=True):
+    """
+    Word-level variant of extract_structured_text that re-reads uncertain
+    words. Returns ``(text, words)``, with ``(None, [])`` when nothing is found.
+    """
+    words = ocr_words_stage(
+        processed_image, regions=None if detect_regions else [], parallel=parallel
+    )
+    if not words:
+        return None, []
+    words = reocr_low_confidence(processed_image, words, gray_image, parallel=parallel)
+    return process_prescription_text(words_to_region_lines(words)), words
+
+
+def region_lines_to_text(region_lines):
+    """Flatten region-tagged lines back into plain text"""
+    return "\n".join(line for _, line in region_lines)
+
+
+def _classify_line(lower_line):
+    """Section a line clearly belongs to, or None if it has no keywords"""
+    # Check for doctor-related information
+    if any(word in lower_line for word in ['dr.', 'dr ', 'doctor', 'clinic', 'hospital']):
+        return 'Doctor Info'
+    
+    # Check for patient-related information
+    if any(word in lower_line for word in ['name:', 'age:', 'patient', 'sex:', 'gender:']):
+        return 'Patient Info'
+    
+    # Check for medication-related information
+    if any(word in lower_line for word in ['tab.', 'tablet', 'cap.', 'capsule', 'mg', 'ml', 'syrup', 'injection']):
+        return 'Medications'
+    
+    # Check for instructions
+    if any(word in lower_line for word in ['take', 'times', 'daily', 'days', 'morning', 'night', 'afternoon']):
+        return 'Instructions'
+    
+    return None
+
+
+def process_prescription_text(text):
+    """
+    Process and structure the prescription text.
+
+    ``text`` is either the flat OCR output or a list of ``(region, line)``
+    pairs from ocr_regions_stage. With regions, lines that precede the
+    first keyword in a region are filed with that region's section instead
+    of whatever section the previous region ended in.
+    """
+    try:
+        if isinstance(text, str):
+            # Split text into lines; the whole page is one region
+            tagged_lines = [(0, line) for line in text.split('\n')]
+            region_aware = False
+        else:
+            tagged_lines = text
+            region_aware = True
+        
+        # Initialize sections
+        sections = {
+            'Doctor Info': [],
+            'Patient Info': [],
+            'Medications': [],
+            'Instructions': [],
+            'Other Details': []
+        }
+        
+        current_section = 'Other Details'
+        
+        for _, region in groupby(tagged_lines, key=itemgetter(0)):
+            lines = [line.strip() for _, line in region if line.strip()]
+            
+            if region_aware:
+                for line in lines:
+                    section = _classify_line(line.lower())
+                    if section:
+                        current_section = section
+                        break
+            
+            for line in lines:
+                # Try to categorize the line
+                current_section = _classify_line(line.lower()) or current_section
+                sections[current_section].append(line)
+        
+        # Format the structured text
+        formatted_text = ""
+        for section, lines in sections.items():
+            if lines:
+                formatted_text += f"\n{section}:\n" + "-" * 40 + "\n"
+                formatted_text += "\n".join(lines) + "\n"
+        
+        return formatted_text.strip()
+    except Exception as e:
+        # Return original text if processing fails
+        return text if isinstance(text, str) else region_lines_to_text(text)
@@ -0,0 +1,113 @@
+"""
+Password hashing on a bounded worker pool.
+
+PBKDF2 runs on a small dedicated thread pool (hashlib releases the GIL
+while it works), so a burst of logins uses at most ``HASH_WORKERS`` cores
+and Streamlit reruns for everyone else keep their CPU. At most
+``HASH_MAX_QUEUE`` hashes wait behind the running ones; past that, new
+requests fail straight away with HasherBusy instead of piling up.
+
+Hashes are stored as ``pbkdf2_sha256$<iterations>$<salt>$<hash>`` with
+base64 salt and hash, so the work factor can be raised through
+PASSWORD_ITERATIONS and older hashes, including the original raw
+salt + key blobs, are upgraded the next time their owner logs in.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+ALGORITHM = 'pbkdf2_sha256'
+ITERATIONS = int(os.environ.get('PASSWORD_ITERATIONS', '100000'))
+SALT_BYTES = 16
+
+# The original format: 32-byte salt followed by the key, 100,000 iterations
+LEGACY_SALT_BYTES = 32
+LEGACY_ITERATIONS = 100000
+
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', str(os.cpu_count() or 1)))
+HASH_MAX_QUEUE = int(os.environ.get('HASH_MAX_QUEUE', str(HASH_WORKERS * 8)))
+# How long a caller waits for its hash before giving up
+HASH_TIMEOUT = 30
+
+_executor = None
+_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_MAX_QUEUE)
+_executor_lock = threading.Lock()
+
+
+class HasherBusy(Exception):
+    """Raised when the hashing pool's queue is full"""
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='password-hash')
+        return _executor
+
+
+def _run(fn, *args):
+    # Take a queue slot without waiting, so a saturated pool rejects quickly
+    if not _slots.acquire(blocking=False):
+        raise HasherBusy("Too many sign-ins are being processed. Please try again in a moment.")
+    try:
+        future = _get_executor().submit(fn, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future.result(timeout=HASH_TIMEOUT)
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _encode(password, iterations):
+    salt = os.urandom(SALT_BYTES)
+    key = _pbkdf2(password, salt, iterations)
+    return f"{ALGORITHM}${iterations}${_b64(salt)}${_b64(key)}"
+
+
+def _parse(stored):
+    """(iterations, salt, key) of a stored hash in either format"""
+    if isinstance(stored, (bytes, memoryview)):
+        stored = bytes(stored)
+        return LEGACY_ITERATIONS, stored[:LEGACY_SALT_BYTES], stored[LEGACY_SALT_BYTES:]
+    algorithm, iterations, salt, key = stored.split('$')
+    if algorithm != ALGORITHM:
+        raise ValueError(f"Unsupported password hash algorithm: {algorithm}")
+    return int(iterations), base64.b64decode(salt), base64.b64decode(key)
+
+
+def _verify(stored, password):
+    iterations, salt, key = _parse(stored)
+    return hmac.compare_digest(_pbkdf2(password, salt, iterations), key)
+
+
+def hash_password(password, iterations=None):
+    """Hash a password on the pool; raises HasherBusy when it is saturated"""
+    return _run(_encode, password, iterations or ITERATIONS)
+
+
+def verify_password(stored_password, provided_password):
+    """Check a password against a stored hash on the pool; raises HasherBusy when saturated"""
+    return _run(_verify, stored_password, provided_password)
+
+
+def needs_rehash(stored_password):
+    """True for legacy blobs and hashes below the current work factor"""
+    if isinstance(stored_password, (bytes, memoryview)):
+        return True
+    try:
+        iterations, _, _ = _parse(stored_password)
+    except ValueError:
+        return False
+    return iterations < ITERATIONS
@@ -0,0 +1,262 @@
+"""
+Monthly visit reports per territory, company and MR, as CSV or Excel.
+
+Rows are read from a cursor ``BATCH_SIZE`` at a time and encoded as they
+arrive, so an export of millions of visits runs in constant memory. The
+queries come back already in report order by walking
+idx_medical_representatives_report (or its company-first twin) and each
+MR's idx_mr_visits_mr_date range, so SQLite never sorts the result either.
+
+Excel output is SpreadsheetML 2003 (.xls), a plain XML format Excel opens
+directly and which, unlike .xlsx, can be written as a stream.
+
+    python reports.py visits --month 2024-05 --territory North --out north.csv
+    python reports.py summary --month 2024-05 --format xls --out may.xls
+
+An export reads from one snapshot of app.db on its own connection, so a
+long one neither sees half-written data nor holds up the connection pool.
+Visits for an archived month are merged in order from its archive.
+"""
+import argparse
+import csv
+import heapq
+import io
+import re
+import sys
+from contextlib import closing
+from datetime import date
+from xml.sax.saxutils import escape
+
+import archive
+from db import connect
+
+BATCH_SIZE = 1000
+
+VISIT_COLUMNS = ["Visit Date", "Territory", "Company", "Representative", "Doctor",
+                 "Purpose", "Status", "Next Visit"]
+SUMMARY_COLUMNS = ["Territory", "Company", "Representative", "Visits"]
+
+# Characters XML 1.0 cannot contain at all
+_XML_INVALID = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def month_range(month):
+    """'YYYY-MM' to the [start, end) dates that visit_date is compared with"""
+    try:
+        year, number = (int(part) for part in month.split('-'))
+        start = date(year, number, 1)
+    except ValueError:
+        raise ValueError(f"Month must look like 2024-05, got '{month}'")
+    end = date(year + number // 12, number % 12 + 1, 1)
+    return start.isoformat(), end.isoformat()
+
+
+def _filters(territory, company):
+    conditions, params = [], []
+    if territory:
+        conditions.append('mr.territory = ?')
+        params.append(territory)
+    if company:
+        conditions.append('mr.company = ?')
+        params.append(company)
+    return ' AND '.join(conditions) or '1', params
+
+
+def visit_report_query(month, territory=None, company=None, table='mr_visits'):
+    """
+    SQL and parameters for one row per visit in ``month`` from one visits
+    table, followed by the MR and visit IDs that complete the sort key
+    """
+    start, end = month_range(month)
+    where, params = _filters(territory, company)
+    query = f'''
+        SELECT v.visit_date, mr.territory, mr.company, mr.full_name,
+               COALESCE(u.full_name, u.username), v.visit_purpose, v.status, v.next_visit_date,
+               mr.id, v.id
+        FROM medical_representatives mr
+        -- CROSS JOIN keeps MRs as the outer loop, which is what makes the order free
+        CROSS JOIN {table} v ON v.mr_id = mr.id AND v.visit_date >= ? AND v.visit_date < ?
+        LEFT JOIN users u ON u.id = v.doctor_id
+        WHERE {where}
+        ORDER BY mr.territory, mr.company, mr.full_name, mr.id, v.visit_date, v.id
+    '''
+    return query, [start, end] + params
+
+
+def summary_report_query(month, territory=None, company=None):
+    """SQL and parameters for one row per MR with their visits in ``month``, from the rollups"""
+    start, _ = month_range(month)
+    where, params = _filters(territory, company)
+    query = f'''
+        SELECT mr.territory, mr.company, mr.full_name, COALESCE(r.visits, 0)
+        FROM medical_representatives mr
+        LEFT JOIN mr_visit_rollups r
+            ON r.scope = 'mr' AND r.scope_key = CAST(mr.id AS TEXT)
+            AND r.period = 'month' AND r.period_start = ?
+        WHERE {where}
+        ORDER BY mr.territory, mr.company, mr.full_name, mr.id
+    '''
+    return query, [start] + params
+
+
+# kind -> (column headings, query builder, sheet name)
+REPORTS = {
+    'visits': (VISIT_COLUMNS, visit_report_query, "Visits"),
+    'summary': (SUMMARY_COLUMNS, summary_report_query, "Summary"),
+}
+
+
+def _fetch(cursor, batch_size):
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            return
+        yield from batch
+
+
+def _visit_order(row):
+    # Territory, company, representative, MR ID, visit date, visit ID
+    return row[1], row[2], row[3], row[8], row[0], row[9]
+
+
+def _with_archive(conn, rows, month, territory, company, batch_size):
+    """Merge the month's archived visits, if any, into the mr_visits rows"""
+    # Listed while mr_visits is being read, so a month archived meanwhile is included
+    start, _ = month_range(month)
+    archived = archive.archived_months(conn, start, start)
+    if not archived:
+        return rows
+    schema = archive.attach(conn, archived[0][1])
+    query, params = visit_report_query(month, territory, company, f'{schema}.mr_visits')
+    merged = heapq.merge(rows, _fetch(conn.execute(query, params), batch_size), key=_visit_order)
+    return _unique_visits(merged)
+
+
+def _unique_visits(rows):
+    # A visit caught mid-move can come back from both tables, next to itself
+    previous = None
+    for row in rows:
+        if row[9] != previous:
+            yield row
+        previous = row[9]
+
+
+def iter_rows(kind, month, territory=None, company=None, batch_size=BATCH_SIZE):
+    """Yield a report's rows while holding at most ``batch_size`` of them per table"""
+    columns, build_query, _ = REPORTS[kind]
+    query, params = build_query(month, territory, company)
+    with closing(connect()) as conn:
+        rows = _fetch(conn.execute(query, params), batch_size)
+        if kind == 'visits':
+            rows = _with_archive(conn, rows, month, territory, company, batch_size)
+        for row in rows:
+            yield row[:len(columns)]
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_chunks(columns, rows, batch_size=BATCH_SIZE):
+    """CSV text in pieces of ``batch_size`` rows, with a BOM so Excel reads it as UTF-8"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield '\ufeff' + buffer.getvalue()
+    for batch in _batches(rows, batch_size):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue()
+
+
+def _cell(value):
+    if value is None:
+        return '<Cell/>'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<Cell><Data ss:Type="Number">{value}</Data></Cell>'
+    return f'<Cell><Data ss:Type="String">{escape(_XML_INVALID.sub("", str(value)))}</Data></Cell>'
+
+
+def _row(values):
+    return '<Row>' + ''.join(_cell(value) for value in values) + '</Row>\n'
+
+
+def spreadsheet_chunks(columns, rows, sheet="Report", batch_size=BATCH_SIZE):
+    """SpreadsheetML 2003 workbook text in pieces of ``batch_size`` rows"""
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<?mso-application progid="Excel.Sheet"?>\n'
+        '<Workbook xmlns="urn:schemas-microsoft-com:office:spreadsheet"'
+        ' xmlns:ss="urn:schemas-microsoft-com:office:spreadsheet">\n'
+        f'<Worksheet ss:Name="{escape(sheet)}"><Table>\n'
+        + _row(columns)
+    )
+    for batch in _batches(rows, batch_size):
+        yield ''.join(_row(row) for row in batch)
+    yield '</Table></Worksheet></Workbook>\n'
+
+
+# format -> (MIME type, file extension)
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'xls': ('application/vnd.ms-excel', 'xls'),
+}
+
+
+def stream_report(kind, fmt, month, territory=None, company=None, batch_size=BATCH_SIZE):
+    """Yield the encoded report as UTF-8 bytes, one batch of rows at a time"""
+    columns, _, sheet = REPORTS[kind]
+    rows = iter_rows(kind, month, territory, company, batch_size)
+    if fmt == 'csv':
+        chunks = csv_chunks(columns, rows, batch_size)
+    elif fmt == 'xls':
+        chunks = spreadsheet_chunks(columns, rows, sheet, batch_size)
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+    for chunk in chunks:
+        yield chunk.encode('utf-8')
+
+
+def report_filename(kind, fmt, month, territory=None, company=None):
+    parts = [kind, month] + [re.sub(r'[^\w-]+', '_', part) for part in (territory, company) if part]
+    return '-'.join(parts) + '.' + FORMATS[fmt][1]
+
+
+def export_report(out, kind, fmt, month, territory=None, company=None, batch_size=BATCH_SIZE):
+    """Write a report to a path or binary file object; returns the number of bytes written"""
+    if isinstance(out, str):
+        with open(out, 'wb') as f:
+            return export_report(f, kind, fmt, month, territory, company, batch_size)
+    written = 0
+    for chunk in stream_report(kind, fmt, month, territory, company, batch_size):
+        out.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export monthly visit reports")
+    parser.add_argument('kind', choices=sorted(REPORTS))
+    parser.add_argument('--month', required=True, help="e.g. 2024-05")
+    parser.add_argument('--territory')
+    parser.add_argument('--company')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    parser.add_argument('--out', help="Default: standard output")
+    args = parser.parse_args()
+
+    out = args.out or sys.stdout.buffer
+    written = export_report(out, args.kind, args.format, args.month, args.territory, args.company)
+    if args.out:
+        print(f"Wrote {written} bytes to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
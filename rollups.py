@@ -0,0 +1,187 @@
+"""
+Visit rollups for MR performance metrics.
+
+mr_visit_rollups holds visit counts per MR, territory and company, by day
+and by month. Writers update it in the same transaction as the visit
+itself, so dashboard metrics and leaderboards are primary-key reads
+instead of COUNTs over mr_visits. Visits count towards the territory and
+company the MR belongs to when they are recorded; ``rebuild`` recomputes
+everything from mr_visits using the current ones.
+
+    python rollups.py rebuild
+"""
+import argparse
+import json
+
+from db import connection, transaction
+
+SCOPES = ('mr', 'territory', 'company')
+PERIODS = ('day', 'month')
+
+# SQL expressions for each scope key and period start, over mr_visits v
+# joined to medical_representatives mr
+_SCOPE_KEYS = {
+    'mr': "CAST(v.mr_id AS TEXT)",
+    'territory': "mr.territory",
+    'company': "mr.company",
+}
+_PERIOD_STARTS = {
+    'day': "date(v.visit_date)",
+    'month': "date(v.visit_date, 'start of month')",
+}
+_CURRENT_PERIOD_STARTS = {
+    'day': "date('now')",
+    'month': "date('now', 'start of month')",
+}
+
+
+def record_visits(c, mr_id, visit_date, count=1):
+    """Add ``count`` visits on ``visit_date`` to every rollup the MR belongs to"""
+    c.execute('SELECT territory, company FROM medical_representatives WHERE id = ?', (mr_id,))
+    row = c.fetchone()
+    keys = [('mr', str(mr_id))]
+    if row:
+        keys += [('territory', row[0]), ('company', row[1])]
+    c.execute("SELECT date(?), date(?, 'start of month')", (visit_date, visit_date))
+    day, month = c.fetchone()
+    c.executemany('''
+        INSERT INTO mr_visit_rollups (scope, scope_key, period, period_start, visits)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (scope, scope_key, period, period_start)
+        DO UPDATE SET visits = visits + excluded.visits
+    ''', [
+        (scope, key, period, start, count)
+        for scope, key in keys
+        for period, start in (('day', day), ('month', month))
+    ])
+
+
+def change_current_doctors(c, mr_id, delta):
+    """Adjust the MR's active doctor count by ``delta``"""
+    c.execute('''
+        UPDATE medical_representatives
+        SET current_doctors = MAX(current_doctors + ?, 0)
+        WHERE id = ?
+    ''', (delta, mr_id))
+
+
+def add_visits_from(c, table, where='1', params=()):
+    """
+    Add every visit in ``table`` matching ``where``, where the table has
+    mr_id and visit_date columns like mr_visits, to the rollups with one
+    statement per scope and period
+    """
+    # Count per MR and day once; every rollup is a sum over those counts
+    c.execute('DROP TABLE IF EXISTS temp.rollup_days')
+    c.execute(f'''
+        CREATE TEMP TABLE rollup_days AS
+        SELECT mr_id, date(visit_date) AS visit_date, COUNT(*) AS visits
+        FROM {table}
+        WHERE {where}
+        GROUP BY mr_id, date(visit_date)
+    ''', params)
+    for scope in SCOPES:
+        for period in PERIODS:
+            key = _SCOPE_KEYS[scope]
+            start = _PERIOD_STARTS[period]
+            c.execute(f'''
+                INSERT INTO mr_visit_rollups (scope, scope_key, period, period_start, visits)
+                SELECT ?, {key}, ?, {start}, SUM(v.visits)
+                FROM temp.rollup_days v
+                LEFT JOIN medical_representatives mr ON mr.id = v.mr_id
+                WHERE {key} IS NOT NULL AND {start} IS NOT NULL
+                GROUP BY {key}, {start}
+                ON CONFLICT (scope, scope_key, period, period_start)
+                DO UPDATE SET visits = visits + excluded.visits
+            ''', (scope, period))
+    c.execute('DROP TABLE temp.rollup_days')
+
+
+def rebuild(c, archived_months=()):
+    """
+    Recompute every rollup and current_doctors from the base tables.
+    Rollups for ``archived_months`` ('YYYY-MM') are kept as they are, since
+    most of those visits are no longer in mr_visits.
+    """
+    archived = json.dumps(list(archived_months))
+    c.execute('''
+        DELETE FROM mr_visit_rollups
+        WHERE substr(period_start, 1, 7) NOT IN (SELECT value FROM json_each(?))
+    ''', (archived,))
+    add_visits_from(c, 'mr_visits', "substr(visit_date, 1, 7) NOT IN (SELECT value FROM json_each(?))",
+                    (archived,))
+    c.execute('''
+        UPDATE medical_representatives
+        SET current_doctors = (
+            SELECT COUNT(*) FROM mr_doctor_assignments a
+            WHERE a.mr_id = medical_representatives.id AND a.status = 'active'
+        )
+    ''')
+
+
+def current_period_start(c, period='month'):
+    """Start of today's day or month, in the UTC dates visit_date is stored in"""
+    c.execute(f"SELECT {_CURRENT_PERIOD_STARTS[period]}")
+    return c.fetchone()[0]
+
+
+def get_visit_count(c, scope, scope_key, period='month', period_start=None):
+    """Visits for one scope and period, the current one by default"""
+    period_start = period_start or current_period_start(c, period)
+    c.execute('''
+        SELECT visits FROM mr_visit_rollups
+        WHERE scope = ? AND scope_key = ? AND period = ? AND period_start = ?
+    ''', (scope, str(scope_key), period, period_start))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+
+def territory_leaderboard(territory, period_start=None, limit=10):
+    """MRs in a territory ranked by visits this month, as (mr_id, full_name, visits)"""
+    with connection() as conn:
+        c = conn.cursor()
+        period_start = period_start or current_period_start(c)
+        c.execute('''
+            SELECT mr.id, mr.full_name, COALESCE(r.visits, 0) AS visits
+            FROM medical_representatives mr
+            LEFT JOIN mr_visit_rollups r
+                ON r.scope = 'mr' AND r.scope_key = CAST(mr.id AS TEXT)
+                AND r.period = 'month' AND r.period_start = ?
+            WHERE mr.territory = ?
+            ORDER BY visits DESC, mr.full_name
+            LIMIT ?
+        ''', (period_start, territory, limit))
+        return c.fetchall()
+
+
+def scope_leaderboard(scope, period='month', period_start=None, limit=10):
+    """Territories or companies ranked by visits in a period, as (name, visits)"""
+    with connection() as conn:
+        c = conn.cursor()
+        period_start = period_start or current_period_start(c, period)
+        c.execute('''
+            SELECT scope_key, visits FROM mr_visit_rollups
+            WHERE scope = ? AND period = ? AND period_start = ?
+            ORDER BY visits DESC
+            LIMIT ?
+        ''', (scope, period, period_start, limit))
+        return c.fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain MR visit rollups")
+    parser.add_argument('command', choices=['rebuild'])
+    parser.parse_args()
+    # Imported here because auth imports this module
+    from auth import init_db
+    from archive import archived_months
+    init_db()
+    with transaction(immediate=True) as conn:
+        c = conn.cursor()
+        rebuild(c, [month for month, _ in archived_months(c)])
+        count = conn.execute('SELECT COUNT(*) FROM mr_visit_rollups').fetchone()[0]
+    print(f"Rebuilt {count} rollup rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Optional write-behind buffer for last_login updates and discount redemptions.
+
+Enabled with WRITE_BEHIND=1. Instead of one small committed write per
+login or redemption, this process collects them in memory and a
+background thread flushes them in one transaction every
+``flush_interval`` seconds, or sooner once ``max_pending`` writes are
+waiting.
+
+Redemptions never go past max_uses. A process first leases a block of
+uses for a code with one conditional UPDATE that moves them into
+discount_codes.reserved_uses, only while times_used + reserved_uses stays
+within max_uses, and then redeems from that lease in memory. Each flush
+adds the redeemed count to times_used and hands every lease back, so a
+deactivated or expired code stops being redeemable here within one flush
+interval.
+
+Durability: a crash loses the buffered last_login values (at most one
+flush interval's worth) and the redemptions counted since the last flush.
+Their reserved uses stay in reserved_uses, so a crash can only make a code
+run out early, never over-redeem. ``python write_behind.py
+reset-reservations`` clears stranded reservations and must only be run
+while no app process is running.
+"""
+import argparse
+import atexit
+import os
+import threading
+import time
+
+from db import transaction
+
+WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND', '0') == '1'
+FLUSH_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', '2'))
+MAX_PENDING = 500
+# Uses leased per code at a time
+LEASE_SIZE = 10
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+class WriteBehindBuffer:
+    """Coalesces logins and redemptions in memory and writes them in batches"""
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING, lease_size=LEASE_SIZE):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.lease_size = lease_size
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._logins = {}
+        # code -> {'remaining', 'used', 'row'}; 'row' is the lease's RETURNING row
+        self._leases = {}
+        self._pending = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def record_login(self, user_id, when):
+        with self._lock:
+            # Only the latest login per user needs writing
+            if user_id not in self._logins:
+                self._pending += 1
+            self._logins[user_id] = when
+            self._maybe_wake()
+
+    def redeem(self, code, now=None):
+        """
+        Redeem one use of ``code``. Returns the same
+        (discount_percentage, redeemed, is_active, uses, max_uses) row as the
+        direct redemption UPDATE, or None for an unknown code.
+        """
+        now = now or int(time.time())
+        with self._lock:
+            lease = self._leases.get(code)
+            if lease is None or lease['remaining'] == 0 or self._expired(lease['row'], now):
+                row = self._lease(code, now)
+                if row is None:
+                    return None
+                granted = row[1]
+                if not granted:
+                    return row[:5]
+                if lease is None:
+                    lease = self._leases[code] = {'remaining': 0, 'used': 0}
+                lease['remaining'] += granted
+                lease['row'] = row
+
+            lease['remaining'] -= 1
+            lease['used'] += 1
+            self._pending += 1
+            self._maybe_wake()
+            discount_percentage, _, is_active, _, max_uses, _ = lease['row']
+            return discount_percentage, 1, is_active, None, max_uses
+
+    def _expired(self, row, now):
+        expiry_ts = row[5]
+        return expiry_ts is not None and expiry_ts <= now
+
+    def _lease(self, code, now):
+        with transaction() as conn:
+            c = conn.cursor()
+            # last_attempt_ok holds the number of uses granted; the old row
+            # values feed both SET expressions
+            c.execute('''
+                UPDATE discount_codes
+                SET last_attempt_ok = CASE
+                        WHEN is_active AND COALESCE(expiry_ts > ?, 1)
+                        THEN MAX(MIN(?, max_uses - times_used - reserved_uses), 0)
+                        ELSE 0 END,
+                    reserved_uses = reserved_uses + CASE
+                        WHEN is_active AND COALESCE(expiry_ts > ?, 1)
+                        THEN MAX(MIN(?, max_uses - times_used - reserved_uses), 0)
+                        ELSE 0 END
+                WHERE code = ?
+                RETURNING discount_percentage, last_attempt_ok, is_active,
+                          times_used + reserved_uses, max_uses, expiry_ts
+            ''', (now, self.lease_size, now, self.lease_size, code))
+            return c.fetchone()
+
+    def _maybe_wake(self):
+        if self._pending >= self.max_pending:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Left buffered and retried on the next interval
+                pass
+
+    def flush(self):
+        """Write everything buffered in one transaction and return all leases"""
+        with self._flush_lock:
+            with self._lock:
+                logins, self._logins = self._logins, {}
+                leases, self._leases = self._leases, {}
+                self._pending = 0
+            if not logins and not leases:
+                return
+            try:
+                with transaction() as conn:
+                    c = conn.cursor()
+                    c.executemany('UPDATE users SET last_login = ? WHERE id = ?',
+                                  [(when, user_id) for user_id, when in logins.items()])
+                    c.executemany('''
+                        UPDATE discount_codes
+                        SET times_used = times_used + ?,
+                            reserved_uses = MAX(reserved_uses - ?, 0)
+                        WHERE code = ?
+                    ''', [
+                        (lease['used'], lease['used'] + lease['remaining'], code)
+                        for code, lease in leases.items()
+                    ])
+            except Exception:
+                self._restore(logins, leases)
+                raise
+
+    def _restore(self, logins, leases):
+        # Put a failed batch back, without overwriting anything newer
+        with self._lock:
+            for user_id, when in logins.items():
+                self._logins.setdefault(user_id, when)
+            for code, lease in leases.items():
+                current = self._leases.get(code)
+                if current is None:
+                    self._leases[code] = lease
+                else:
+                    current['remaining'] += lease['remaining']
+                    current['used'] += lease['used']
+            self._pending = len(self._logins) + sum(lease['used'] for lease in self._leases.values())
+
+
+def get_write_behind():
+    """Process-wide buffer, or None when write-behind is disabled"""
+    global _buffer
+    if not WRITE_BEHIND_ENABLED:
+        return None
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = WriteBehindBuffer()
+        return _buffer
+
+
+def reset_reservations():
+    """Drop every outstanding lease; only safe while no app process is running"""
+    with transaction(immediate=True) as conn:
+        return conn.execute('UPDATE discount_codes SET reserved_uses = 0 WHERE reserved_uses != 0').rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain write-behind state")
+    parser.add_argument('command', choices=['reset-reservations'])
+    parser.parse_args()
+    print(f"Cleared reservations on {reset_reservations()} discount codes")
+
+
+if __name__ == "__main__":
+    main()